@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for copying a book (CopyEngine.copytree).
+
+Creates a synthetic EPUB workspace in a temporary directory, and compares copying it the way
+Filesystem.storeBook used to (shutil.copytree followed by fix_permissions), with copying it
+with the CopyEngine (permissions set while copying), with and without hardlinks.
+
+Usage: python benchmarks/copytree.py [number of files] [target directory]
+
+Use a target directory on another filesystem (i.e. a network share) to measure that case.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from core.utils.copy_engine import CopyEngine  # noqa: E402
+from core.utils.filesystem import Filesystem  # noqa: E402
+
+
+def create_workspace(path, files):
+    # mostly small XHTML files, and some bigger images
+    os.makedirs(os.path.join(path, "EPUB", "images"))
+    os.makedirs(os.path.join(path, "META-INF"))
+    with open(os.path.join(path, "mimetype"), "w") as f:
+        f.write("application/epub+zip")
+    for i in range(files):
+        if i % 10 == 0:
+            with open(os.path.join(path, "EPUB", "images", "image-{}.jpg".format(i)), "wb") as f:
+                f.write(os.urandom(512 * 1024))
+        else:
+            with open(os.path.join(path, "EPUB", "chapter-{}.xhtml".format(i)), "w") as f:
+                f.write("<p>text</p>\n" * 500)
+
+
+def measure(name, fn, target):
+    start = time.perf_counter()
+    fn()
+    duration = time.perf_counter() - start
+    shutil.rmtree(target)
+    print("{:<50} {:8.1f} ms".format(name, duration * 1000))
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    target_dir = sys.argv[2] if len(sys.argv) > 2 else None
+
+    path = tempfile.mkdtemp(prefix="copytree-")
+    target_parent = tempfile.mkdtemp(prefix="copytree-target-", dir=target_dir)
+    try:
+        source = os.path.join(path, "workspace")
+        target = os.path.join(target_parent, "workspace")
+        create_workspace(source, files)
+        print("{} files in {}, copying to {}\n".format(files, source, target_parent))
+
+        def legacy():
+            shutil.copytree(source, target, ignore=Filesystem.ignored_names)
+            Filesystem.fix_permissions(target)
+
+        measure("shutil.copytree + fix_permissions", legacy, target)
+        measure("CopyEngine.copytree (permissions while copying)",
+                lambda: CopyEngine.copytree(source, target, file_mode=0o664, dir_mode=0o777), target)
+        measure("CopyEngine.copytree (hardlinks)", lambda: CopyEngine.copytree(source, target, hardlink=True), target)
+    finally:
+        shutil.rmtree(path)
+        shutil.rmtree(target_parent)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for the directory checksums (Filesystem.path_md5 and Filesystem.path_tree_md5).
+
+Creates a synthetic book with 10 000 files (by default) in a temporary directory, and compares
+the previous os.walk-based implementation of path_md5 with the current one. Also verifies that
+the current implementation gives the same checksums as the previous implementation.
+
+Also compares matching the ignore patterns with shutil.ignore_patterns and with Filesystem.ignored_names.
+
+Usage: python benchmarks/path_md5.py [number of files] [files per directory]
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from core.utils.filesystem import Filesystem  # noqa: E402
+
+legacy_ignore_patterns = shutil.ignore_patterns(*Filesystem.ignore_patterns)  # fnmatch for each pattern, on every call
+
+
+def legacy_path_md5(path, shallow):
+    # the os.walk-based implementation of Filesystem.path_md5, before it used os.scandir
+    attributes = []
+    modified = 0
+    if not os.path.exists(path):
+        return Filesystem.empty_md5, 0
+
+    if os.path.isfile(path) and not Filesystem.should_ignore(path):
+        stat = os.stat(path)
+        attributes.extend([path, round(stat.st_mtime), stat.st_size, stat.st_mode])
+        modified = stat.st_mtime
+
+    if not shallow or not modified:
+        for dirPath, subdirList, fileList in os.walk(path):
+            fileList.sort()
+            subdirList.sort()
+            ignore = legacy_ignore_patterns(dirPath, fileList + subdirList)
+            for s in reversed(range(len(subdirList))):
+                if subdirList[s] in ignore:
+                    del subdirList[s]
+            for f in fileList:
+                if f in ignore:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirPath, f))
+                    attributes.extend([os.path.join(dirPath, f), round(stat.st_mtime), stat.st_size, stat.st_mode])
+                    modified = max(modified, stat.st_mtime)
+                except FileNotFoundError:
+                    attributes.extend([os.path.join(dirPath, f), 0, 0, 0])
+                if shallow:
+                    break
+
+    md5 = hashlib.md5(str(attributes).encode()).hexdigest() if attributes else Filesystem.empty_md5
+    return md5, modified
+
+
+def create_book(path, files, files_per_dir):
+    # a book with a few levels of directories, and some files that should be ignored
+    for i in range(files):
+        directory = os.path.join(path, "level-{}".format(i // (files_per_dir * 10)), "dir-{}".format(i // files_per_dir))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "file-{}.xhtml".format(i)), "w") as f:
+            f.write("x" * (i % 100))
+    for name in ["Thumbs.db", ".DS_Store", "backup.xhtml~"]:
+        with open(os.path.join(path, "level-0", name), "w") as f:
+            f.write("ignored")
+    os.symlink(os.path.join(path, "level-0"), os.path.join(path, "symlink"))
+
+
+def measure(name, fn, repeat=5):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    print("{:<40} {:8.1f} ms (best of {})".format(name, min(durations) * 1000, repeat))
+    return result
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    files_per_dir = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    path = tempfile.mkdtemp(prefix="path_md5-")
+    try:
+        create_book(path, files, files_per_dir)
+        print("{} files in {}\n".format(files, path))
+
+        for shallow in [False, True]:
+            legacy = measure("legacy path_md5 (shallow={})".format(shallow), lambda: legacy_path_md5(path, shallow))
+            current = measure("path_md5 (shallow={})".format(shallow), lambda: Filesystem.path_md5(path, shallow))
+            assert legacy == current, "path_md5 is not compatible with the legacy implementation: {} != {}".format(legacy, current)
+
+        _, _, _, tree = measure("path_tree_md5 (full walk)", lambda: Filesystem.path_tree_md5(path, prune=False))
+        measure("path_tree_md5 (pruned, nothing changed)", lambda: Filesystem.path_tree_md5(path, tree=tree))
+
+        names = [str(i) for i in range(50000)] + ["{}.swp".format(i) for i in range(100)] + ["Thumbs.db", ".DS_Store", "._123"]
+        legacy = measure("shutil.ignore_patterns (50k names)", lambda: legacy_ignore_patterns(path, names))
+        current = measure("Filesystem.ignored_names (50k names)", lambda: Filesystem.ignored_names(path, names))
+        assert legacy == current, "the compiled ignore patterns do not match the same names as shutil.ignore_patterns"
+
+        print("\nchecksums are identical to the legacy implementation")
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
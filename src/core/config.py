@@ -1,4 +1,6 @@
 import copy
+import os
+import tempfile
 
 
 class Config():
@@ -11,3 +13,13 @@ class Config():
     @staticmethod
     def set(name, value):
         Config.config[name] = value
+
+    @staticmethod
+    def get_cache_dir():
+        cache_dir = Config.get("cache_dir", None)
+        if not cache_dir:
+            cache_dir = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "prodsys-cache"))
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            Config.set("cache_dir", cache_dir)
+        return cache_dir
@@ -4,31 +4,44 @@
 import logging
 import os
 import pickle
-import tempfile
 import threading
 import time
 import traceback
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from threading import RLock, Thread
 
 from core.config import Config
+from core.utils.deep_scan_scheduler import DeepScanScheduler
 from core.utils.filesystem import Filesystem
+from core.utils.inotify import Inotify
+from core.utils.kv_store import KeyValueStore
 from core.utils.report import Report
+from core.utils.scan_engine import ScanEngine
 
 
 class Directory():
     """
     Base class for monitoring directories.
 
+    On local filesystems, changes are detected with inotify: events are mapped to the book
+    they belong to, and only that book is rescanned. A full scan is then only done once in a
+    while (safety_scan_interval), in case an event is lost. On network filesystems (SMB, NFS),
+    where inotify does not see changes made by other hosts, the directory is polled.
+
+    Directories do not have their own threads for this: the scanning is done in small steps by the
+    shared ScanEngine, and the event handlers are called from the ScanEngine event thread.
+
     TODO: this does not handle "parentdirs"
     """
 
     # instance variables
     threads = None
-    _bookMonitorThread = None
+    _started = False
     _md5 = None
     _md5_lock = None
+    _stems = None  # { "123": {"123.epub"} }, updated together with _md5
     dir_id = None
     dir_id_is_generated = None
     dir_path = None
@@ -38,8 +51,18 @@ class Directory():
     starting = None
     inactivity_timeout = None
     cache_file = None
+    _store = None  # KeyValueStore with the checksums in cache_file
+    _changed = None  # books with checksums that have changed since they were last stored
+    _store_lock = None
     last_availability_check_time = None
+    _scan_pass = None  # the pass of _scan_books that is in progress (see _begin_scan_pass)
     suggested_for_rescan = None
+    backend = None  # "inotify" or "poll"
+    _watches = None  # { wd: path relative to dir_path }, or None when not watching with inotify
+    _dirty = None  # { book: time of first event }, books with inotify events that have not been rescanned yet
+    _last_dirty_check = 0
+    _last_safety_scan = 0
+    deep_scan_scheduler = None
 
     # static variables
     _static_lock = RLock()  # lock for changing the static variables
@@ -49,6 +72,18 @@ class Directory():
     dirs_ranked = []  # calculated in run.py
     dirs_flat = {}  # calculated in run.py
 
+    watcher = os.getenv("DIRECTORY_WATCHER", "auto")  # "auto", "inotify" or "poll"
+    safety_scan_interval = int(os.getenv("DIRECTORY_SAFETY_SCAN_INTERVAL", 600))  # seconds between full scans when using inotify
+    init_workers = int(os.getenv("DIRECTORY_INIT_WORKERS", 8))  # books that are checksummed in parallel during the initial scan
+    checkpoint_interval = 30  # seconds between each time the checksums are stored during the initial scan
+    checksum_version = 2  # the version of the checksums (see Filesystem.path_tree_md5)
+    full_deep_scan_interval = int(os.getenv("DIRECTORY_FULL_DEEP_SCAN_INTERVAL", 24 * 60 * 60))  # max. seconds before unchanged directories are walked again
+    poll_deep_scan_interval = int(os.getenv("DIRECTORY_POLL_DEEP_SCAN_INTERVAL", 10 * 60))  # the same, when polling (without inotify)
+    dirty_check_interval = 1  # min. seconds between each time books with inotify events are rescanned
+    scan_slice_time = float(os.getenv("DIRECTORY_SCAN_SLICE_TIME", 1))  # max. seconds of each step of a scan, before letting other directories run
+    inotify_mask = (Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_MODIFY | Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE
+                    | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF)
+
     def __init__(self, dir_path, inactivity_timeout=10):
         self.dir_id, self.dir_id_is_generated = Directory.get_id(dir_path)
         self.dir_path = os.path.normpath(dir_path)
@@ -59,17 +94,22 @@ class Directory():
         self.inactivity_timeout = inactivity_timeout
         self.last_availability_check_time = 0
         self.suggested_for_rescan = []
+        self._watches = None
+        self._dirty = {}
+        self.backend = self._choose_backend()
+        self.deep_scan_scheduler = DeepScanScheduler()
 
         self._md5_lock = RLock()
         with self._md5_lock:
             self._md5 = {}
+            self._stems = {}
+            self._changed = set()
+
+        self._store_lock = RLock()
 
         self.threads = []
 
-        self._bookMonitorThread = Thread(target=self._monitor_book_events_thread, name="event in {}".format(self.dir_id))
-        self._bookMonitorThread.setDaemon(True)
-        self._bookMonitorThread.start()
-        self.threads.append(self._bookMonitorThread)
+        ScanEngine.add(self.dir_id, self._scan_step)
 
     @staticmethod
     def get_id(dir_path):
@@ -141,6 +181,7 @@ class Directory():
 
         if dir is not None:
             dir.shouldRun = False
+            ScanEngine.remove(dir.dir_id)  # waits for the current scan step to finish
 
             is_alive = True
             while is_alive:
@@ -155,94 +196,195 @@ class Directory():
                 if dir_path in Directory.dirs:
                     del Directory.dirs[dir_path]
 
+            dir._stop_inotify()
+            if dir._store is not None:
+                dir._store.close()
+
+    def _choose_backend(self):
+        if Directory.watcher == "poll" or not Inotify.available():
+            return "poll"
+        if Directory.watcher == "auto" and Filesystem.is_network_path(self.dir_path):
+            return "poll"
+        return "inotify"
+
     def set_inactivity_timeout(self, inactivity_timeout):
         self.inactivity_timeout = inactivity_timeout
 
     def initialize_checksums(self):
+        return self._initialize_checksums()
+
+    @staticmethod
+    def get_stem(name):
+        """Returns the identifier part of a book name (i.e. "123" for "123.epub" or "subdir/123.epub")"""
+        return name.split("/")[-1].split(".")[0]
+
+    @staticmethod
+    def build_stem_index(names):
+        """Returns a dict with the names of books, indexed by their stems ({ "123": "123.epub" })"""
+        stems = {}
+        for name in names:
+            stems.setdefault(Directory.get_stem(name), set()).add(name)
+        return {stem: Directory._preferred_name(stem, stems[stem]) for stem in stems}
+
+    @staticmethod
+    def _preferred_name(stem, names):
+        # if there are multiple books with the same stem, prefer the one without a file extension
+        return stem if stem in names else sorted(names)[0]
+
+    def get_stem_index(self):
+        """Returns a dict with the names of the books in this directory, indexed by their stems"""
         with self._md5_lock:
-            return self._initialize_checksums()
+            return {stem: Directory._preferred_name(stem, self._stems[stem]) for stem in self._stems}
+
+    def get_checksum(self, name):
+        """Returns the last known deep checksum of a book, or None if it is not known (yet)"""
+        with self._md5_lock:
+            md5 = self._md5.get(name)
+            return md5["deep"] if md5 else None
+
+    def _reindex(self):
+        self._stems = {}
+        for name in self._md5:
+            self._stems.setdefault(Directory.get_stem(name), set()).add(name)
+
+    def _forget(self, name):
+        del self._md5[name]
+        self._changed.add(name)
+        self.deep_scan_scheduler.forget(name)
+        stem = Directory.get_stem(name)
+        if stem in self._stems:
+            self._stems[stem].discard(name)
+            if not self._stems[stem]:
+                del self._stems[stem]
 
     def _initialize_checksums(self):
-        cache_dir = Config.get("cache_dir", None)
-        if not cache_dir:
-            cache_dir = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "prodsys-cache"))
-            if not os.path.isdir(cache_dir):
-                os.makedirs(cache_dir, exist_ok=True)
-            Config.set("cache_dir", cache_dir)
+        cache_dir = Config.get_cache_dir()
 
+        md5 = {}
         self.cache_file = None
         if not self.dir_id_is_generated:
-            self.cache_file = os.path.join(cache_dir, "dir.{}.md5.pickle".format(self.dir_id))
-            if os.path.isfile(self.cache_file):
-                try:
-                    with open(self.cache_file, 'rb') as f:
-                        self._md5 = pickle.load(f)
-                except Exception as e:
-                    logging.exception("Cache file found, but could not parse it", e)
-            else:
-                logging.debug("Can't find cache file")
+            self.cache_file = os.path.join(cache_dir, "dir.{}.md5.sqlite".format(self.dir_id))
+            try:
+                self._store = KeyValueStore(self.cache_file)
+                md5 = self._store.items()
+                if not md5:
+                    md5 = self._migrate_pickle(os.path.join(cache_dir, "dir.{}.md5.pickle".format(self.dir_id)))
+            except Exception:
+                logging.exception("Could not open cache file: {}".format(self.cache_file))
+                self._store = None
 
-        if self._md5:
+        if md5:
             logging.debug("Loaded directory status from cache file, doing a partial rescan")
-
         else:
             logging.debug("Directory status not cached, doing a full rescan")
-            self._md5 = {}
 
-        dir_list = Filesystem.list_book_dir(self.dir_path)
+        with self._md5_lock:
+            md5.update(self._md5)  # books that have been scanned while loading the cache
+            self._md5 = md5
+            self._reindex()
+
+        dir_list = ScanEngine.list_book_dir(self.dir_path, max_age=0)
+        dir_set = set(dir_list)
         self.status_text = "Looking for created/deleted"
 
-        for book in list(self._md5.keys()):  # list(….keys()) to avoid "RuntimeError: dictionary changed size during iteration"
-            if not self.shouldRun:
-                self._md5 = {}
-                return  # break loop if we're shutting down the system
-            if book not in dir_list:
-                logging.debug("{} is in cache but not in directory: deleting from cache".format(book))
-                del self._md5[book]
-
-        md5_count = 0
-        self.status_text = "0 / {}".format(len(dir_list))
-        for book in dir_list:
-            if not self.shouldRun:
-                self._md5 = {}
-                return  # break loop if we're shutting down the system
-            if book not in self._md5:
-                logging.debug("{} is in directory but not in cache: adding to cache".format(book))
-                self._update_md5(book)
-            md5_count += 1
-            self.status_text = "{} / {}".format(md5_count, len(dir_list))
-            if md5_count == 1 or md5_count % 100 == 0:
-                logging.info(self.status_text)
-            if md5_count % 10 == 0:
-                self.store_checksums(while_starting=True)  # if for some reason the system crashes, we don't have to start all over again
+        with self._md5_lock:
+            for book in list(self._md5.keys()):  # list(….keys()) to avoid "RuntimeError: dictionary changed size during iteration"
+                if book not in dir_set:
+                    logging.debug("{} is in cache but not in directory: deleting from cache".format(book))
+                    self._forget(book)
+            missing = [book for book in dir_list if book not in self._md5]
+
+        # Checksum the books that are not in the cache in parallel, as most of the time is spent
+        # waiting for the filesystem (especially on network shares). The lock is only held while
+        # storing each result, so that events for books that are already scanned can be handled
+        # in the meantime. The checksums are stored regularly, so that if the system is restarted,
+        # the scan continues where it left off.
+        md5_count = len(dir_list) - len(missing)
+        self.status_text = "{} / {}".format(md5_count, len(dir_list))
+        last_checkpoint = time.time()
+        executor = ThreadPoolExecutor(max_workers=Directory.init_workers, thread_name_prefix="checksum in {}".format(self.dir_id))
+        try:
+            futures = {executor.submit(self._compute_md5, book): book for book in missing}
+            for future in as_completed(futures):
+                if not self.shouldRun:
+                    break  # break loop if we're shutting down the system
+
+                book = futures[future]
+                try:
+                    entry = future.result()
+                except Exception:
+                    logging.exception("Could not compute checksum for {}".format(os.path.join(self.dir_path, book)))
+                    continue
+
+                with self._md5_lock:
+                    if book not in self._md5:
+                        logging.debug("{} is in directory but not in cache: adding to cache".format(book))
+                        self._md5[book] = entry
+                        self._changed.add(book)
+                        self._stems.setdefault(Directory.get_stem(book), set()).add(book)
+
+                md5_count += 1
+                self.status_text = "{} / {}".format(md5_count, len(dir_list))
+                if md5_count == 1 or md5_count % 100 == 0:
+                    logging.info(self.status_text)
+                if time.time() - last_checkpoint >= Directory.checkpoint_interval:
+                    self.store_checksums(while_starting=True)  # if for some reason the system crashes, we don't have to start all over again
+                    last_checkpoint = time.time()
+
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
 
         self.store_checksums(while_starting=True)
+        if not self.shouldRun:
+            return
+
         self.starting = False
         self.status_text = None
         return
 
+    def _migrate_pickle(self, pickle_file):
+        # the checksums used to be stored as a pickled dict
+        if not os.path.isfile(pickle_file):
+            logging.debug("Can't find cache file")
+            return {}
+        try:
+            with open(pickle_file, 'rb') as f:
+                md5 = pickle.load(f)
+            self._store.update(md5)
+            os.remove(pickle_file)
+            logging.info("Migrated {} to {}".format(pickle_file, self.cache_file))
+            return md5
+        except Exception:
+            logging.exception("Cache file found, but could not parse it: {}".format(pickle_file))
+            return {}
+
     def store_checksums(self, while_starting=False):
         if not while_starting and self.is_starting():
             # Cache is not complete yet. Cache will not be saved
             return
 
-        with self._md5_lock:
-            return self._store_checksums()
+        return self._store_checksums()
 
     def _store_checksums(self):
-        if not self.cache_file:
+        if self._store is None:
             # No cache file defined. Cannot cache directory checksums
             return
 
-        if not os.path.exists(os.path.dirname(self.cache_file)):
-            os.makedirs(os.path.dirname(self.cache_file))
+        # Only write the books that have changed since the last time. The checksum lock is only held
+        # while copying the changes, and the store lock makes sure that the changes are written in order.
+        with self._store_lock:
+            with self._md5_lock:
+                changed = {name: dict(self._md5[name]) for name in self._changed if name in self._md5}
+                deleted = [name for name in self._changed if name not in self._md5]
+                self._changed = set()
 
-        if len(self._md5) == 0:
-            # No checksums in cache. Cache will not be saved
-            return
-
-        with open(self.cache_file, 'wb') as f:
-            pickle.dump(self._md5, f, -1)
+            try:
+                self._store.update(changed, deleted)
+            except Exception:
+                with self._md5_lock:
+                    self._changed.update(changed.keys())
+                    self._changed.update(deleted)
+                raise
 
     def is_starting(self):
         return self.starting
@@ -287,164 +429,418 @@ class Directory():
             self.book_event_handlers.append(fn)
 
     def notify_book_event_handlers(self, name, event_type):
-        for fn in self.book_event_handlers:
-            fn(name, event_type)
+        # the handlers are called from a separate thread, so that they are never called while holding the checksum lock
+        ScanEngine.post(self._dispatch_book_event, name, event_type)
+
+    def _dispatch_book_event(self, name, event_type):
+        if not self.shouldRun:
+            return
+
+        for fn in list(self.book_event_handlers):
+            try:
+                fn(name, event_type)
+            except Exception:
+                logging.exception("An error occured while handling the event \"{}\" for {}".format(event_type, name))
 
     def suggest_rescan(self, name):
         with self._md5_lock:
             self.suggested_for_rescan.append(name)
+        ScanEngine.wake(self.dir_id)
 
-    def _update_md5(self, name):
+    def _update_md5(self, name, touch=False):
+        # Recompute the checksums of a book. The filesystem is accessed without holding the lock.
+        # If touch is True, the book is considered modified now.
         assert self.dir_path is not None, "Cannot get MD5 checksum for {} when there is no input directory".format(name)
+        assert "/" not in name
 
-        path = os.path.join(self.dir_path, name)
+        with self._md5_lock:
+            previous = self._md5.get(name)
 
-        assert "/" not in name
+        entry = self._compute_md5(name, previous=previous)
+        if touch:
+            entry["modified"] = max(entry["modified"], int(time.time()))
+        return self._swap_md5(name, previous, entry)
 
+    def _swap_md5(self, name, previous, entry):
+        # Replace the checksums of a book, unless they have been replaced by another thread since `previous`
+        # was read (in which case that thread has handled the change). Returns whether they were replaced.
+        with self._md5_lock:
+            if self._md5.get(name) is not previous:
+                return False
+            self._md5[name] = entry
+            self._changed.add(name)
+            self._stems.setdefault(Directory.get_stem(name), set()).add(name)
+            return True
+
+    def _book_created(self, book):
+        if not self._swap_md5(book, None, self._compute_md5(book)):
+            return False  # added by another thread
+        self.notify_book_event_handlers(book, "created")
+        logging.debug("book created: {}".format(book))
+        return True
+
+    def _book_deleted(self, book):
+        with self._md5_lock:
+            if book not in self._md5:
+                return False
+            self._forget(book)
+        self.notify_book_event_handlers(book, "deleted")
+        logging.debug("book deleted: {}".format(book))
+        return True
+
+    def _deep_check(self, book, verbose=True, prune=False, max_age=None):
+        # Check the size/time etc. of the files in the book. Returns True if the book was modified.
+        # With prune=True, only directories with a changed mtime, or that have not been walked
+        # for `max_age` seconds (default: full_deep_scan_interval), are walked (see Filesystem.path_tree_md5).
         with self._md5_lock:
-            shallow_md5, _ = Filesystem.path_md5(path=path, shallow=True, expect=self._md5[name]["shallow"] if name in self._md5 else None)
-            deep_md5, modified = Filesystem.path_md5(path=path, shallow=False, expect=self._md5[name]["deep"] if name in self._md5 else None)
-            modified = max(modified if modified else 0, self._md5[name]["modified"] if name in self._md5 else 0)
-            self._md5[name] = {
-                "shallow": shallow_md5,
-                "shallow_checked": int(time.time()),
-                "deep": deep_md5,
-                "deep_checked": int(time.time()),
-                "modified": modified,
-            }
-
-    def _monitor_book_events_thread(self):
-        self.initialize_checksums()
-
-        while self.shouldRun:
+            previous = self._md5.get(book)
+        if previous is None:
+            return False
+
+        entry = self._compute_md5(book, previous=previous, prune=prune, max_age=max_age, verbose=verbose)
+        if previous.get("version") == Directory.checksum_version:
+            modified = entry["deep"] != previous["deep"]
+        else:
+            # the checksums are from an older version: compare them the old way once, and then replace them
+            old_md5, _ = Filesystem.path_md5(path=os.path.join(self.dir_path, book), shallow=False)
+            modified = old_md5 != previous["deep"]
+
+        with self._md5_lock:
+            if self._md5.get(book) is not previous:
+                return False  # changed by another thread, which has handled it
+            if modified:
+                entry["modified"] = max(entry["modified"], int(time.time()))
+            self._md5[book] = entry
+            self._changed.add(book)
+
+        if modified:
+            self.notify_book_event_handlers(book, "modified")
+        return modified
+
+    def _compute_md5(self, name, previous=None, prune=False, max_age=None, verbose=True):
+        # the tree from the previous walk is stored with the checksums, so that unchanged directories can be skipped
+        same_version = previous is not None and previous.get("version") == Directory.checksum_version
+        shallow_md5, deep_md5, modified, tree = Filesystem.path_tree_md5(os.path.join(self.dir_path, name),
+                                                                         tree=previous.get("tree") if same_version else None,
+                                                                         prune=prune,
+                                                                         max_age=max_age if max_age else Directory.full_deep_scan_interval,
+                                                                         expect=previous["deep"] if same_version and verbose else None)
+        modified = max(modified if modified else 0, previous["modified"] if previous else 0)
+        return {
+            "version": Directory.checksum_version,
+            "shallow": shallow_md5,
+            "shallow_checked": int(time.time()),
+            "deep": deep_md5,
+            "deep_checked": previous["deep_checked"] if prune and same_version else int(time.time()),  # time of last full walk
+            "modified": modified,
+            "tree": tree,
+        }
+
+    def _start(self):
+        if self.backend == "inotify":
+            self._start_inotify()  # start watching before the initial scan, so that no changes are lost
+
+        # books are checksummed in the background, and events are handled for the books that are scanned
+        initializeThread = Thread(target=self.initialize_checksums, name="init {}".format(self.dir_id))
+        initializeThread.setDaemon(True)
+        initializeThread.start()
+        self.threads.append(initializeThread)
+        self._started = True
+
+    def _scan_step(self):
+        # Called by the ScanEngine. Returns the number of seconds until the next step (or None when stopped).
+        if not self.shouldRun:
+            return None
+
+        try:
+            if not self._started:
+                self._start()
+                return 0
+
+            if self.backend == "inotify":
+                return self._watch_book_events()
+            else:
+                return self._poll_book_events()
+
+        except Exception:
+            logging.exception("En feil oppstod ved overvåking av {}".format(self.dir_path))
+            try:
+                Report.emailPlainText("En feil oppstod ved overvåking av {}".format(self.dir_path),
+                                      traceback.format_exc(),
+                                      recipients=[])
+            except Exception:
+                logging.exception("Could not e-mail exception")
+            return 1
+
+    def _start_inotify(self):
+        # the inotify instance is shared by all directories (see ScanEngine.add_watch)
+        try:
+            self._watches = {}
+            self._add_watches("")
+            logging.debug("Watching {} with inotify ({} directories)".format(self.dir_path, len(self._watches)))
+        except OSError:
+            # i.e. fs.inotify.max_user_watches is reached
+            logging.exception("Could not watch {} with inotify, polling it instead".format(self.dir_path))
+            self._stop_inotify()
+            self.backend = "poll"
+
+    def _stop_inotify(self):
+        if self._watches is not None:
+            ScanEngine.rm_watches(self.dir_id)
+        self._watches = None
+
+    def _add_watches(self, relpath):
+        # watch the directory and all its subdirectories (inotify is not recursive)
+        for dirpath, subdirs, _ in os.walk(os.path.join(self.dir_path, relpath)):
             try:
-                # books that are recently changed (check often in case of new file changes)
+                wd = ScanEngine.add_watch(self.dir_id, dirpath, Directory.inotify_mask | Inotify.IN_ONLYDIR)
+            except FileNotFoundError:
+                continue  # deleted while walking
+            relpath = os.path.relpath(dirpath, self.dir_path)
+            self._watches[wd] = relpath if relpath != "." else ""
+
+    def _handle_inotify_events(self, events):
+        for wd, mask, cookie, name in events:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                logging.warning("Lost inotify events for {}, doing a full scan".format(self.dir_path))
+                self._last_safety_scan = 0
+                continue
+
+            relpath = self._watches.get(wd)
+            if relpath is None:
+                continue
+
+            if relpath == "" and mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF | Inotify.IN_UNMOUNT | Inotify.IN_IGNORED):
+                logging.warning("{} is no longer available for inotify".format(self.dir_path))
+                self._stop_inotify()
+                return
+
+            if mask & Inotify.IN_IGNORED:
+                del self._watches[wd]  # the subdirectory was deleted
+                continue
+
+            path = os.path.join(relpath, name) if name else relpath
+            if not path:
+                continue  # the directory itself was changed (i.e. permissions)
+
+            if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                try:
+                    self._add_watches(path)
+                except OSError:
+                    logging.exception("Could not watch {} with inotify, polling {} instead".format(path, self.dir_path))
+                    self._stop_inotify()
+                    self.backend = "poll"
+                    return
+
+            book = path.split(os.sep)[0]
+            if book not in self._dirty:
+                self._dirty[book] = time.time()
+
+    def _rescan_book(self, book):
+        # rescan a single book, and notify the event handlers if it has been created, modified or deleted
+        if not os.path.exists(os.path.join(self.dir_path, book)):
+            return self._book_deleted(book)
+
+        with self._md5_lock:
+            known = book in self._md5
+        if not known:
+            if not Filesystem.is_book_name(self.dir_path, book):
+                return False
+            return self._book_created(book)
+
+        if self._deep_check(book):
+            logging.debug("book modified: {}".format(book))
+            return True
+        return False
+
+    def _watch_book_events(self):
+        if self._watches is None:
+            # the directory has been unmounted or deleted: poll until it is available again
+            if self.is_available():
+                self._start_inotify()
+                self._last_safety_scan = 0
+            if self._watches is None:
+                return self._poll_book_events()
+
+        # the ScanEngine wakes us up when there are events (and waits a bit, so that bursts are handled together)
+        self._handle_inotify_events(ScanEngine.read_events(self.dir_id))
+
+        # books that have explicitly been requested for rescan
+        if self.suggested_for_rescan:
+            with self._md5_lock:
+                suggested = self.suggested_for_rescan
+                self.suggested_for_rescan = []
+                for book_id in suggested:
+                    # if book is a file, then it can have a file extension
+                    for book in self._stems.get(Directory.get_stem(book_id), {book_id}):
+                        self._dirty.setdefault(book, time.time())
+
+        if self._dirty and time.time() - self._last_dirty_check >= Directory.dirty_check_interval:
+            self._last_dirty_check = time.time()
+            dirty = self._dirty
+            self._dirty = {}
+            for book in sorted(dirty, key=lambda b: dirty[b]):
+                if not self.shouldRun:
+                    break
                 with self._md5_lock:
-                    recently_changed = sorted([book for book in self._md5 if time.time() - self._md5[book]["modified"] < self.inactivity_timeout],
-                                              key=lambda rc: self._md5[rc]["modified"])
-                    if recently_changed:
-                        for book in recently_changed:
-                            deep_md5, _ = Filesystem.path_md5(path=os.path.join(self.dir_path, book), shallow=False)
-                            self._md5[book]["deep_checked"] = int(time.time())
-                            if deep_md5 != self._md5[book]["deep"]:
-                                self._md5[book]["modified"] = int(time.time())
-                                self._update_md5(book)
-                                logging.debug("book modified (and was recently modified, might be in the middle of a copy operation): {}".format(book))
-                                self.notify_book_event_handlers(book, "modified")
-
-                        time.sleep(0.1)  # a small nap
-                        continue
-
-                time.sleep(1)  # unless anything has recently changed, give the system time to breathe between each iteration
-
-                if not self.is_available():
-                    time.sleep(5)
+                    known = book in self._md5
+                if self.starting and not known:
+                    self._dirty[book] = dirty[book]  # not scanned yet, check it again when the initial scan is done
                     continue
+                self._rescan_book(book)
+
+        if not self.starting:  # if the initial scan is not done yet, it takes care of the rest
+            if self._scan_pass is not None or time.time() - self._last_safety_scan >= Directory.safety_scan_interval and self.is_available():
+                if self._scan_pass is None:
+                    self._last_safety_scan = time.time()
+                if not self._scan_books():
+                    return 0  # continue the scan as soon as the other directories have had their turn
+
+            else:
+                self._deep_scan_books()  # also stores the checksums if anything has changed
 
-                dirlist = Filesystem.list_book_dir(self.dir_path)
-                sorted_dirlist = []
-                should_deepscan = []
+        if self._dirty:
+            return max(0, Directory.dirty_check_interval - (time.time() - self._last_dirty_check))
+        return 1
 
-                # books that have explicitly been requested for rescan should be rescanned first
-                if self.suggested_for_rescan:
-                    for book_id in self.suggested_for_rescan:
-                        book_path = os.path.join(self.dir_path, book_id)
+    def _poll_book_events(self):
+        # books that are recently changed (check often in case of new file changes)
+        with self._md5_lock:
+            recently_changed = sorted([book for book in self._md5 if time.time() - self._md5[book]["modified"] < self.inactivity_timeout],
+                                      key=lambda rc: self._md5[rc]["modified"])
+        if recently_changed:
+            for book in recently_changed:
+                if self._deep_check(book, verbose=False):
+                    logging.debug("book modified (and was recently modified, might be in the middle of a copy operation): {}".format(book))
+
+            return 0.1  # a small nap
 
-                        if os.path.exists(book_path):
-                            sorted_dirlist.append(book_id)
-                            should_deepscan.append(book_id)
+        if not self.is_available():
+            return 5
 
-                        else:
-                            # if book is a file, then it can have a file extension
-                            for dirname in dirlist:
-                                if Path(dirname).stem == book_id:
-                                    sorted_dirlist.append(dirname)
-                                    should_deepscan.append(dirname)
-                                    break
+        if not self._scan_books():
+            return 0  # continue the scan as soon as the other directories have had their turn
+        return 1  # unless anything has recently changed, give the system time to breathe between each iteration
 
-                    # empty list after having put the suggestions at the front of the queue
-                    self.suggested_for_rescan = []
+    def _begin_scan_pass(self):
+        dirlist = ScanEngine.list_book_dir(self.dir_path)
+        sorted_dirlist = []
+        should_deepscan = []
 
-                    # add the remaining books to the list
+        # books that have explicitly been requested for rescan should be rescanned first
+        with self._md5_lock:
+            suggested = self.suggested_for_rescan
+            self.suggested_for_rescan = []
+        if suggested:
+            for book_id in suggested:
+                book_path = os.path.join(self.dir_path, book_id)
+
+                if os.path.exists(book_path):
+                    sorted_dirlist.append(book_id)
+                    should_deepscan.append(book_id)
+
+                else:
+                    # if book is a file, then it can have a file extension
                     for dirname in dirlist:
-                        if dirname not in sorted_dirlist:
+                        if Path(dirname).stem == book_id:
                             sorted_dirlist.append(dirname)
-                    if len(dirlist) != len(sorted_dirlist):
-                        logging.warning("len(dirlist) != len(sorted_dirlist)")
-                        logging.warning("dirlist: {}".format(dirlist))
-                        logging.warning("sorted_dirlist: {}".format(sorted_dirlist))
-                    dirlist = sorted_dirlist
-
-                # do a shallow check of files and folders (i.e. don't check file sizes, modification times etc. in subdirectories)
-                for book in dirlist:
-                    if not self.shouldRun:
-                        break  # break loop if we're shutting down the system (iterating books may take some time)
-
-                    with self._md5_lock:
-                        if not os.path.exists(os.path.join(self.dir_path, book)):
-                            # iterating over all books can take a lot of time,
-                            # and the book may have been deleted by the time we get to it.
-                            self.notify_book_event_handlers(book, "deleted")
-                            logging.debug("book deleted: {}".format(book))
-                            del self._md5[book]
-                            continue
-
-                        if book not in self._md5:
-                            self._update_md5(book)
-                            self.notify_book_event_handlers(book, "created")
-                            logging.debug("book created: {}".format(book))
-                            continue
-
-                        shallow_md5, _ = Filesystem.path_md5(path=os.path.join(self.dir_path, book),
-                                                             shallow=True,
-                                                             expect=self._md5[book]["shallow"] if book in self._md5 else None)
-                        if shallow_md5 != self._md5[book]["shallow"]:
-                            self._update_md5(book)
-                            self.notify_book_event_handlers(book, "modified")
-                            logging.debug("book modified (top-level dir/file modified): {}".format(book))
-                            continue
-
-                with self._md5_lock:
-                    deleted = [book for book in self._md5 if book not in dirlist]
-                    for book in deleted:
-                        self.notify_book_event_handlers(book, "deleted")
-                        logging.debug("book deleted: {}".format(book))
-                        del self._md5[book]
-                    if deleted:
-                        continue
+                            should_deepscan.append(dirname)
+                            break
+
+            # add the remaining books to the list
+            for dirname in dirlist:
+                if dirname not in sorted_dirlist:
+                    sorted_dirlist.append(dirname)
+            if len(dirlist) != len(sorted_dirlist):
+                logging.warning("len(dirlist) != len(sorted_dirlist)")
+                logging.warning("dirlist: {}".format(dirlist))
+                logging.warning("sorted_dirlist: {}".format(sorted_dirlist))
+            dirlist = sorted_dirlist
+
+        return {"dirlist": dirlist, "remaining": list(reversed(dirlist)), "deepscan": should_deepscan}
+
+    def _scan_books(self):
+        # Look for created, modified and deleted books by comparing checksums. The ScanEngine workers are shared by all
+        # directories, so a pass over a large directory is split into steps of about scan_slice_time seconds.
+        # Returns True when the pass is done, and False when it should be continued in the next step.
+        if self._scan_pass is None:
+            self._scan_pass = self._begin_scan_pass()
+        scan_pass = self._scan_pass
+        slice_end = time.time() + Directory.scan_slice_time
+        checked = 0
+
+        # Do a pruned check of files and folders (i.e. only look at files in directories whose modification time has changed).
+        # Files that are modified in place do not change the mtime of their directory. With inotify we get events for those,
+        # but when polling, the files in each directory are statted again at least every poll_deep_scan_interval seconds.
+        max_age = Directory.poll_deep_scan_interval if self._watches is None else Directory.full_deep_scan_interval
+        while scan_pass["remaining"]:
+            if not self.shouldRun:
+                return True  # stop the pass if we're shutting down the system (iterating books may take some time)
+            if checked and time.time() >= slice_end:
+                return False  # at least one book is checked in each step, so that the pass always makes progress
+
+            book = scan_pass["remaining"].pop()
+            checked += 1
+            path = os.path.join(self.dir_path, book)
+            if not os.path.exists(path):
+                # iterating over all books can take a lot of time,
+                # and the book may have been deleted by the time we get to it.
+                self._book_deleted(book)
+                continue
+
+            with self._md5_lock:
+                known = book in self._md5
+            if not known:
+                if not self.starting:  # if the initial scan is not done yet, it will add the book
+                    self._book_created(book)
+                continue
+
+            # only the directories that have changed are walked, so this is cheap when nothing has changed
+            if self._deep_check(book, prune=True, max_age=max_age):
+                logging.debug("book modified (files added, removed or renamed): {}".format(book))
+
+        self._scan_pass = None
+        dirset = set(scan_pass["dirlist"])
+        with self._md5_lock:
+            deleted = [book for book in self._md5 if book not in dirset]
+        # the listing may be shared, and a bit older than books that were created in the meantime
+        deleted = [book for book in deleted if not os.path.exists(os.path.join(self.dir_path, book))]
+        for book in deleted:
+            self._book_deleted(book)
+        if deleted:
+            return True
+
+        self.store_checksums()  # regularly store updated version of checksums
+
+        self._deep_scan_books(scan_pass["deepscan"])
+        return True
+
+    def _deep_scan_books(self, requested=None):
+        # do a full deep check (size/time etc. of all files, also in directories that have not changed) of the books
+        # that are most overdue, in case files have been modified in place. The scheduler keeps this within the IO budget.
+        requested = requested or []
+        with self._md5_lock:
+            books = list(self._md5)
+            candidates = {book: (self._md5[book]["deep_checked"], self._md5[book]["modified"]) for book in self._md5
+                          if time.time() - self._md5[book]["modified"] > self.inactivity_timeout and book not in requested}
+        for book in requested:
+            self.deep_scan_scheduler.charge(book)
+        selected = self.deep_scan_scheduler.select(candidates, books)
+
+        for book in requested + selected:
+            if not self.shouldRun:
+                break  # break loop if we're shutting down the system
 
-                self.store_checksums()  # regularly store updated version of checksums
+            if book not in self._md5:
+                self._update_md5(book)
+                continue
 
-                # do a deep check (size/time etc. of files in subdirectories) of up to 10 books that haven't been checked in a while
-                with self._md5_lock:
-                    long_time_since_checked = sorted([{"name": book, "md5": self._md5[book]} for book in self._md5
-                                                      if time.time() - self._md5[book]["modified"] > self.inactivity_timeout],
-                                                     key=lambda book: book["md5"]["deep_checked"])
-                    long_time_since_checked = [b["name"] for b in long_time_since_checked]
-                    for book in should_deepscan + long_time_since_checked[:10]:
-                        if not self.shouldRun:
-                            break  # break loop if we're shutting down the system
-
-                        deep_md5, _ = Filesystem.path_md5(path=os.path.join(self.dir_path, book),
-                                                          shallow=False,
-                                                          expect=self._md5[book]["deep"] if book in self._md5 else None)
-                        if book not in self._md5:
-                            self._update_md5(book)
-                        else:
-                            self._md5[book]["deep_checked"] = int(time.time())
-                            if deep_md5 != self._md5[book]["deep"]:
-                                self._md5[book]["modified"] = int(time.time())
-                                self._update_md5(book)
-                                self.notify_book_event_handlers(book, "modified")
-                                logging.debug("book modified: {}".format(book))
-
-                self.store_checksums()  # regularly store updated version of checksums
+            start_time = time.time()
+            if self._deep_check(book):
+                logging.debug("book modified: {}".format(book))
+            with self._md5_lock:
+                entry = self._md5.get(book)
+            if entry is not None:
+                self.deep_scan_scheduler.record(book, Filesystem.tree_size(entry.get("tree")), time.time() - start_time)
 
-            except Exception:
-                logging.exception("En feil oppstod ved overvåking av {}".format(self.dir_path))
-                try:
-                    Report.emailPlainText("En feil oppstod ved overvåking av {}".format(self.dir_path),
-                                          traceback.format_exc(),
-                                          recipients=[])
-                except Exception:
-                    logging.exception("Could not e-mail exception")
+        self.store_checksums()  # regularly store updated version of checksums
@@ -12,6 +12,7 @@ if os.environ.get("TEST", "false").lower() not in ["true", "1"]:
 import datetime
 import inspect
 import math
+import pickle
 import re
 import tempfile
 import threading
@@ -24,9 +25,20 @@ from dotmap import DotMap
 
 from core.config import Config
 from core.directory import Directory
+from core.utils.book_result_index import BookResultIndex
+from core.utils.daily_report import DailyReport
+from core.utils.duration_model import DurationModel
 from core.utils.filesystem import Filesystem
 from core.utils.metadata import Metadata
+from core.utils.metrics import Metrics
+from core.utils.queue_journal import QueueJournal
 from core.utils.report import DummyReport, Report
+from core.utils.scan_engine import ScanEngine
+from core.utils.scheduler import LoadScheduler, TokenBucket
+from core.utils.stack_sampler import StackSampler
+from core.utils.trace import Trace
+from core.utils.trigger_watcher import TriggerWatcher
+from core.utils.worker_pool import WorkerPool
 
 if sys.version_info[0] != 3 or sys.version_info[1] < 5:
     print("# This script requires Python version 3.5+")
@@ -40,11 +52,12 @@ class Pipeline():
     """
 
     _queue_lock = None
+    _cancelled = None  # threading.Event, set when the current book should stop being processed
     _md5_lock = None
     _group_locks = {}  # use this statically: Pipeline._group_locks
 
     _dir_trigger_obj = None  # store TemporaryDirectory object in instance so that it's not cleaned up
-    pipelines = []
+    pipelines = []  # the running pipelines (added in start, and removed in join)
 
     # The current book
     book = None
@@ -57,6 +70,7 @@ class Pipeline():
     dir_out = None
     dir_reports = None
     dir_trigger = None
+    dir_trigger_dirs = None
     dir_base = None
     parentdirs = {}
 
@@ -80,19 +94,46 @@ class Pipeline():
     _bookRetryInNotOutThread = None
     shouldRun = True
     stopAfterNJobs = -1
-
-    # static (shared by all pipelines)
-    _triggerDirThread = None
+    shortest_job_first = False  # handle autotriggered books with the shortest expected duration first
+    preemptive_restart = True  # cancel and restart the current book if it is modified while being processed
+    autotrigger_rate = None  # max number of autotriggered books per hour (None: use the default from LoadScheduler)
+    execution_mode = "thread"  # "thread": handle books in the pipeline thread, "process": handle books in a worker process
+
+    # bulk retries (see _retry_all_books_thread)
+    retry_all_interval = int(os.getenv("RETRY_ALL_INTERVAL", 2 * 60 * 60))  # seconds between each time all books are retried
+    retry_all_rate = float(os.getenv("RETRY_ALL_RATE", 60))  # max number of books retried per hour
+    retry_all_burst = float(os.getenv("RETRY_ALL_BURST", 10))
+
+    # stall detection (see _check_stall)
+    stall_factor = float(os.getenv("STALL_FACTOR", 3))  # a book is stalled when it takes this many times longer than expected…
+    stall_min_duration = int(os.getenv("STALL_MIN_DURATION", 600))  # …and at least this many seconds
+    stall_watchdog_timeout = int(os.getenv("STALL_WATCHDOG_TIMEOUT", 1800))  # a thread is stalled when its watchdog is silent this long
+    stall_sample_interval = int(os.getenv("STALL_SAMPLE_INTERVAL", 1800))  # min. seconds between stack samples for a pipeline
+    _monitorThread = None
+    _last_stall_sample = 0
+
+    # graceful shutdown (see drain)
+    drain_timeout = int(os.getenv("DRAIN_TIMEOUT", 1800))  # seconds the current book gets to finish
+    draining = False
+    drain_deadline = None
 
     # dynamic (reset on stop(), changes over time)
     _queue = None
+    _queue_index = None  # { name: book }, the books in _queue indexed by name
+    _journal = None  # QueueJournal, used to persist the queue across restarts
+    _worker_pool = None  # WorkerPool, used when execution_mode is "process"
     _md5 = None
     threads = None
     watchdogs = None
     progress_text = None
     progress_log = None
     progress_start = None
-    expected_processing_time = 60  # can be overridden in each pipeline
+    progress_expected = None  # expected duration of the current book
+    book_features = None  # size and number of files of the current book
+    duration_model = None
+    result_index = None  # BookResultIndex, with the last result for each book
+    book_fingerprint = None  # checksum of the current book when it was started
+    expected_processing_time = 60  # can be overridden in each pipeline (only used until we have measured some durations)
 
     # utility classes; reconfigured every time a book is processed to simplify function signatures
     utils = None
@@ -118,6 +159,8 @@ class Pipeline():
                  during_working_hours=None,
                  during_night_and_weekend=None,
                  only_when_idle=None,
+                 execution_mode=None,
+                 shortest_job_first=None,
                  _uid=None,
                  _gid=None,
                  _title=None,
@@ -150,18 +193,62 @@ class Pipeline():
         # set both variables explicitly.
         # To reduce server load, only_when_idle can be set to True, which will
         # only allow the pipeline to retry books when the whole system is idle.
+        # With AUTOTRIGGER_SCHEDULER=load, the working hours are not used. Instead,
+        # autotriggered books are handled whenever there is capacity (see LoadScheduler),
+        # unless both during_working_hours and during_night_and_weekend are False.
         self.should_retry_during_working_hours = during_working_hours if isinstance(during_working_hours, bool) else True
         self.should_retry_during_night_and_weekend = during_night_and_weekend if isinstance(during_night_and_weekend, bool) else True
         self.should_retry_only_when_idle = only_when_idle if isinstance(only_when_idle, bool) else False
 
+        # By default, books are handled in the pipeline thread. With execution_mode="process",
+        # each book is handled in a separate worker process, so that a crash or excessive
+        # memory usage while handling one book does not take down the other pipelines.
+        self.execution_mode = execution_mode if execution_mode else os.getenv("PIPELINE_EXECUTION_MODE", "thread")
+        assert self.execution_mode in ["thread", "process"], "execution_mode must be either \"thread\" or \"process\""
+
+        # Autotriggered books are normally handled in the order they were triggered. With shortest_job_first,
+        # the books with the shortest expected duration are handled first, so that a few huge books don't
+        # block hundreds of small ones.
+        self.shortest_job_first = (shortest_job_first if isinstance(shortest_job_first, bool)
+                                   else os.getenv("SHORTEST_JOB_FIRST", "false").lower() in ["1", "true"])
+
         self._queue_lock = RLock()
         self._md5_lock = RLock()
+        self._cancelled = threading.Event()
         if self.get_group_id() not in Pipeline._group_locks:
             Pipeline._group_locks[self.get_group_id()] = {"lock": RLock(), "current-uid": None}
         with self._queue_lock:
-            self._queue = []
+            self._set_queue([])
         super().__init__()
 
+    def __getstate__(self):
+        # Used when the pipeline is sent to a worker process (see WorkerPool). Only the configuration is sent;
+        # the queue, threads, locks, directory watchers and other runtime state stay in this process.
+        state = {}
+        for key, value in self.__dict__.items():
+            if key in ["utils", "book", "threads", "watchdogs", "_queue", "_queue_index", "_journal", "_worker_pool",
+                       "dir_in_obj", "dir_out_obj", "_dir_trigger_obj"]:
+                continue
+            try:
+                pickle.dumps(value)
+            except Exception:
+                continue  # not needed to handle books
+            state[key] = value
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.utils = DotMap()
+        self.utils.report = None
+        self.utils.filesystem = None
+        self.threads = []
+        self.watchdogs = {}
+        self._queue_lock = RLock()
+        self._md5_lock = RLock()
+        self._cancelled = threading.Event()
+        with self._queue_lock:
+            self._set_queue([])
+
     def start_common(self, inactivity_timeout=10, dir_in=None, dir_out=None, dir_reports=None, email_settings=None, dir_base=None, config=None):
         if not dir_in:
             dir_in = os.environ.get("DIR_IN")
@@ -218,6 +305,10 @@ class Pipeline():
         self.progress_text = ""
         self.progress_log = []
         self.progress_start = -1
+        self.progress_expected = None
+        self.duration_model = DurationModel.get(self.uid, default_duration=self.expected_processing_time)
+        self.result_index = BookResultIndex.get(self.uid)
+        LoadScheduler.bucket(self.uid, rate=self.autotrigger_rate)
 
         # make dirs available from static contexts
         if not Pipeline.dirs:
@@ -267,6 +358,14 @@ class Pipeline():
         # make trigger dir available from static contexts
         Pipeline.dirs[self.uid]["trigger"] = self.dir_trigger
 
+        # Books can also be triggered for all pipelines with the same input directory,
+        # by creating a file in $TRIGGER_DIR/dirs/<input directory relative to the base directory>.
+        self.dir_trigger_dirs = None
+        if os.getenv("TRIGGER_DIR") and self.dir_in is not None:
+            relpath = os.path.relpath(self.dir_in, Filesystem.get_base_path(self.dir_in, self.dir_base))
+            if ".." not in relpath:
+                self.dir_trigger_dirs = os.path.join(os.getenv("TRIGGER_DIR"), "dirs", relpath)
+
         type(self).dir_in = self.dir_in
         type(self).dir_out = self.dir_out
         type(self).dir_reports = self.dir_reports
@@ -287,6 +386,15 @@ class Pipeline():
         self.threads = []
         self.watchdogs = {}
 
+        # restore books that were queued or in-flight when the system was last stopped
+        self._journal = QueueJournal(self.uid)
+        self._restore_queue()
+
+        # start worker processes before starting any threads for this pipeline
+        if self.execution_mode == "process":
+            self._worker_pool = WorkerPool(self)
+            self._worker_pool.start()
+
         # start a directory watcher for the output directory
         if self.dir_out is not None:
             self.dir_out_obj = Directory.start_watching(self.dir_out)
@@ -296,17 +404,9 @@ class Pipeline():
             self.dir_in_obj = Directory.start_watching(self.dir_in, inactivity_timeout=self._inactivity_timeout)
             self.dir_in_obj.add_book_event_handler(self._add_book_to_queue)
 
-        # wait for directory watchers to be ready
-        while (self.dir_in_obj and self.dir_in_obj.is_starting()
-                or self.dir_out_obj and self.dir_out_obj.is_starting()):
-            self.progress_text = " , ".join([text for text in [
-                self.dir_in_obj.get_status_text() if self.dir_in_obj else None,
-                self.dir_out_obj.get_status_text() if self.dir_out_obj else None
-            ] if text])
-
-            time.sleep(1)
-
-        self.progress_text = ""
+        # The directory watchers do their initial scan in the background, and handle events for
+        # the books that have been scanned in the meantime. Their progress is shown by the monitor thread.
+        self._update_directory_status()
 
         self.shouldHandleBooks = True
 
@@ -323,21 +423,23 @@ class Pipeline():
                 self._bookRetryInNotOutThread.start()
                 self.threads.append(self._bookRetryInNotOutThread)
 
-        self._bookTriggerThread = Thread(target=self._monitor_book_triggers_thread, name="trigger in {}".format(self.uid))
-        self._bookTriggerThread.setDaemon(True)
-        self._bookTriggerThread.start()
-        self.threads.append(self._bookTriggerThread)
+        # trigger files are handled by the ScanEngine, which is shared by all pipelines and directories
+        TriggerWatcher.watch(self.dir_trigger, self._on_trigger_file)
+        if self.dir_trigger_dirs:
+            TriggerWatcher.watch(self.dir_trigger_dirs, self._on_dir_trigger_file)
 
         self._bookHandlerThread = Thread(target=self._handle_book_events_thread, name="book in {}".format(self.uid))
         self._bookHandlerThread.setDaemon(True)
         self._bookHandlerThread.start()
         self.threads.append(self._bookHandlerThread)
 
-        if not Pipeline._triggerDirThread:
-            Pipeline._triggerDirThread = Thread(target=Pipeline._trigger_dir_thread, name="trigger dir monitor")
-            Pipeline._triggerDirThread.setDaemon(True)
-            Pipeline._triggerDirThread.start()
-            self.threads.append(Pipeline._triggerDirThread)
+        self._monitorThread = Thread(target=self._monitor_thread, name="monitor for {}".format(self.uid))
+        self._monitorThread.setDaemon(True)
+        self._monitorThread.start()
+        self.threads.append(self._monitorThread)
+
+        if self not in Pipeline.pipelines:
+            Pipeline.pipelines.append(self)
 
         if self.dir_in is not None:
             logging.info("Pipeline \"" + str(self.title) + "\" started watching " + self.dir_in)
@@ -355,12 +457,44 @@ class Pipeline():
             if len(new_queue) < len(self._queue):
                 logging.info("Removed {} books from the queue that may have been added because the network station was unavailable.".format(
                     len(self._queue) - len(new_queue)))
-                self._queue = new_queue
+                if self._journal:
+                    for book in self._queue:
+                        if book not in new_queue:
+                            self._journal.dequeue(book["name"])
+                self._set_queue(new_queue)
 
         self.shouldRun = False
+        self.draining = False
+
+        # let the worker processes know that we're shutting down
+        if self._worker_pool:
+            self._worker_pool.signal_workers()
 
         logging.info("Pipeline \"" + str(self.title) + "\" stopped")
 
+    def drain(self, timeout=None):
+        """
+        Stop gracefully: no new books are started, and the current book gets `timeout` seconds
+        (default: drain_timeout) to finish before the pipeline is stopped. Pipeline 2 jobs that
+        are still running when the pipeline stops are checkpointed, and the pipeline will
+        continue waiting for them when it starts again.
+        """
+        self.drain_deadline = time.time() + (timeout if timeout is not None else self.drain_timeout)
+        self.draining = True
+        logging.info("Pipeline \"" + str(self.title) + "\" is draining" + (" (waiting for {})".format(self.book["name"]) if self.book else ""))
+
+    def _check_drain(self):
+        if not self.draining:
+            return
+
+        if not self.book:
+            logging.info("Pipeline \"" + str(self.title) + "\" is drained")
+            self.stop()
+
+        elif time.time() > self.drain_deadline:
+            logging.info("Pipeline \"" + str(self.title) + "\" did not finish {} before the deadline".format(self.book["name"]))
+            self.stop()
+
     def run(self, inactivity_timeout=10, dir_in=None, dir_out=None, dir_reports=None, email_settings=None, dir_base=None, config=None):
         """
         Run in a blocking manner (useful from command line)
@@ -377,8 +511,11 @@ class Pipeline():
         self.join()
 
     def join(self):
+        if self in Pipeline.pipelines:
+            Pipeline.pipelines.remove(self)
+
         with self._queue_lock:
-            self._queue = []
+            self._set_queue([])
 
         if self.dir_in is not None:
             Directory.stop(self.dir_in)
@@ -389,9 +526,22 @@ class Pipeline():
                     logging.debug("joining {}".format(thread.name))
                     thread.join(timeout=60)
 
+        if self.dir_trigger:
+            TriggerWatcher.unwatch(self.dir_trigger, self._on_trigger_file)
+        if self.dir_trigger_dirs:
+            TriggerWatcher.unwatch(self.dir_trigger_dirs, self._on_dir_trigger_file)
+
         if self._dir_trigger_obj:
             self._dir_trigger_obj.cleanup()
 
+        if self._journal:
+            self._journal.close()
+
+        DailyReport.flush()
+
+        if self._worker_pool:
+            self._worker_pool.close()
+
         is_alive = True
         join_start_time = time.time()
         while is_alive:
@@ -495,30 +645,53 @@ class Pipeline():
             return True
 
     def get_progress(self):
-        # exactly 10 messages in log
-        if len(self.progress_log) > 10:
-            self.progress_log = self.progress_log[-10:]
-        while len(self.progress_log) < 10:
-            self.progress_log.append({"start": 0, "end": self.expected_processing_time})
-
         if self.progress_text:
             return self.progress_text
 
-        elif self.progress_start >= self.progress_log[-1]["end"]:
-
-            average_duration = 0
-            for p in self.progress_log:
-                average_duration += p["end"] - p["start"]
-            average_duration /= 10
-
+        elif self.book and self.progress_start > 0:
             duration = time.time() - self.progress_start
+            expected = self.progress_expected if self.progress_expected else self.expected_processing_time
 
-            percentage = math.floor((1 - math.exp(-duration/average_duration/2)) * 100)
-            return "{} %".format(percentage)
+            if duration < expected:
+                percentage = 90 * duration / expected
+            else:
+                # taking longer than expected: slowly approach 100 %
+                percentage = 90 + 9 * (1 - math.exp(-(duration - expected) / expected))
+            return "{} %".format(math.floor(percentage))
 
         else:
             return ""
 
+    def get_eta(self):
+        """Expected number of seconds until the current book is finished (None if no book is being processed)"""
+        if not self.book or self.progress_start <= 0:
+            return None
+        expected = self.progress_expected if self.progress_expected else self.expected_processing_time
+        return max(0, self.progress_start + expected - time.time())
+
+    def _record_stage_durations(self, trace):
+        # record the duration of each top-level stage in the duration model,
+        # and store the model once for the book (the total is recorded without saving)
+        durations = {}
+        for span in trace.spans:
+            durations[span.name] = durations.get(span.name, 0) + (span.wall or 0)
+        for stage in durations:
+            self.duration_model.record(durations[stage], size=self.book_features[0], files=self.book_features[1], stage=stage, save=False)
+        self.duration_model.save()
+
+    def _estimate_queue_durations(self, limit=100):
+        # Estimate the duration of up to `limit` autotriggered books in the queue.
+        # Determining the size of a book can be slow, so it's done outside the queue lock.
+        with self._queue_lock:
+            books = [b for b in self._queue if "expected_duration" not in b and Pipeline.get_main_event(b) == "autotriggered"][:limit]
+
+        for book in books:
+            if not self.shouldRun:
+                break
+            self.watchdog_bark()
+            size, files = DurationModel.book_features(book["source"])
+            book["expected_duration"] = self.duration_model.predict(size=size, files=files)
+
     @staticmethod
     def is_working_hours():
         if os.getenv("TEST", "").lower() in ["1", "true", "yes"]:
@@ -534,11 +707,29 @@ class Pipeline():
         if self.should_retry_only_when_idle and Config.get("system.idle", 0) < self._inactivity_timeout * 2:
             return False
 
+        if LoadScheduler.mode == "load":
+            if not self.should_retry_during_working_hours and not self.should_retry_during_night_and_weekend:
+                return False  # autotriggering is disabled for this pipeline
+
+            # handle autotriggered books whenever there's capacity, regardless of the time of day
+            return LoadScheduler.admit(self.uid, manual_backlog=Pipeline.get_manual_backlog())
+
         if Pipeline.is_working_hours():
             return self.should_retry_during_working_hours
         else:
             return self.should_retry_during_night_and_weekend
 
+    @staticmethod
+    def get_manual_backlog():
+        """Number of books that are waiting in the queues of all running pipelines, and are not autotriggered"""
+        backlog = 0
+        for pipeline in list(Pipeline.pipelines):
+            if not pipeline._queue:
+                continue
+            # the queue lock is not used here, to avoid deadlocks between pipelines (the queue is only read)
+            backlog += len([b for b in list(pipeline._queue) if Pipeline.get_main_event(b) != "autotriggered"])
+        return backlog
+
     # Whether or not to autotrigger a specific book
     def should_retry_book(self, source):
         return True
@@ -557,129 +748,186 @@ class Pipeline():
 
     def _add_book_to_queue(self, name, event_type):
         with self._queue_lock:
-            book_in_queue = False
-            for item in self._queue:
-                if item['name'] == name:
-                    book_in_queue = True
-                    if event_type != "autotriggered":
-                        item['last_event'] = int(time.time())
-                    if event_type not in item['events']:
-                        item['events'].append(event_type)
-                    break
-            if not book_in_queue:
-                self._queue.append({
+            item = self._queue_index.get(name)
+            if item is not None:
+                if event_type != "autotriggered":
+                    item['last_event'] = int(time.time())
+                if event_type not in item['events']:
+                    item['events'].append(event_type)
+            else:
+                item = {
                      'name': name,
                      'source': os.path.join(self.dir_in, name) if self.dir_in is not None else None,
                      'events': [event_type],
                      'last_event': int(time.time())
-                })
+                }
+                self._queue.append(item)
+                self._queue_index[name] = item
                 logging.debug("added book to queue: " + name)
+            if self._journal:
+                self._journal.enqueue(item)
 
-    def watchdog_bark(self):
-        self.watchdogs[threading.current_thread()] = time.time()
+    def _set_queue(self, queue):
+        # must be called with the queue lock held
+        self._queue = queue
+        self._queue_index = {book["name"]: book for book in queue}
 
-    @staticmethod
-    def _trigger_dir_thread():
-        _trigger_dir_obj = None
-        trigger_dir = os.getenv("TRIGGER_DIR")
-        if not trigger_dir:
-            _trigger_dir_obj = tempfile.TemporaryDirectory(prefix="produksjonssystem-", suffix="-trigger-dirs")
-            trigger_dir = _trigger_dir_obj.name
-        trigger_dir = os.path.join(trigger_dir, "dirs")
+    def _restore_queue(self):
+        pending, in_flight = self._journal.restore()
 
-        dirs = None
+        with self._queue_lock:
+            # Books that were being processed when the system stopped are flagged as interrupted,
+            # so that they are handled before the other books, and so that the report says that they were resumed.
+            for book in in_flight:
+                if book["name"] in self._queue_index:
+                    continue
+                book["interrupted"] = True
+                self._queue.append(book)
+                self._queue_index[book["name"]] = book
+                self._journal.finish(book["name"])
+                self._journal.enqueue(book)
+
+            for book in pending:
+                if book["name"] in self._queue_index:
+                    continue
+                self._queue.append(book)
+                self._queue_index[book["name"]] = book
 
-        while True:
-            time.sleep(5)
+        if pending or in_flight:
+            logging.info("Restored {} books from the queue journal ({} of them were interrupted while processing)".format(
+                len(pending) + len(in_flight), len(in_flight)))
 
-            ready = 0
-            for pipeline in Pipeline.pipelines:
-                if pipeline.running or pipeline.shouldRun and pipeline.dir_in:
-                    ready += 1
+    def watchdog_bark(self):
+        self.watchdogs[threading.current_thread()] = time.time()
 
-            if ready == 0:
-                logging.info("stopping dir trigger thread")
-                break
+    def cancel(self, reason=None):
+        """
+        Cancel processing of the current book.
 
-            if ready < len(Pipeline.pipelines):
-                # all pipelines are still not running; wait a bit...
-                continue
+        Running Pipeline 2 jobs are deleted, and child processes started with Filesystem.run_static are killed.
+        The book event handler is expected to return shortly after.
+        """
+        if not self.book or self._cancelled.is_set():
+            return
+        logging.info("Cancelling {}{}".format(self.book["name"], ": " + reason if reason else ""))
+        self._cancelled.set()
+        if self._worker_pool:
+            self._worker_pool.cancel_workers()
+
+    def is_cancelled(self):
+        return self._cancelled is not None and self._cancelled.is_set()
+
+    def _check_preemption(self):
+        # If the book that is currently being processed has been changed in the input directory,
+        # and it has not changed for a while (the inactivity timeout), then the current run is
+        # outdated. Cancel it, so that the new version is processed as soon as possible.
+        book = self.book
+        if not self.preemptive_restart or not book or self.is_cancelled():
+            return
 
-            if not dirs:
-                dirs = {}
-                for pipeline in Pipeline.pipelines:
-                    if not pipeline.dir_in:
-                        continue
+        with self._queue_lock:
+            queued = self._queue_index.get(book["name"])
+        if not queued:
+            return
 
-                    relpath = os.path.relpath(pipeline.dir_in, Filesystem.get_base_path(pipeline.dir_in, pipeline.dir_base))
+        # the book was removed from the queue when we started processing it, so these events happened after that
+        if not [e for e in queued["events"] if e not in ["autotriggered", "triggered"]]:
+            return
+        if int(time.time()) - queued["last_event"] <= self._inactivity_timeout:
+            return  # still changing
 
-                    if ".." in relpath:
-                        continue
+        self.cancel("the book was modified while being processed")
 
-                    if relpath not in dirs:
-                        dirs[relpath] = [pipeline.uid]
-                        os.makedirs(os.path.join(trigger_dir, relpath), exist_ok=True)
-                    else:
-                        dirs[relpath].append(pipeline.uid)
-
-            for relpath in dirs:
-                path = os.path.join(trigger_dir, relpath)
-                if os.path.isdir(path):
-                    for name in os.listdir(path):
-                        if name == "_name":
-                            continue
-                        triggerfile = os.path.join(path, name)
-                        if os.path.isfile(triggerfile):
-                            autotriggered = False
-                            try:
-                                with open(triggerfile, "r") as tf:
-                                    first_line = tf.readline().strip()
-                                    if first_line == "autotriggered":
-                                        autotriggered = True
-                                os.remove(triggerfile)
+    def _on_trigger_file(self, name, autotriggered):
+        self._add_book_to_queue(name, "autotriggered" if autotriggered else "triggered")
 
-                            except Exception:
-                                logging.exception("An error occured while trying to delete triggerfile: " + triggerfile)
+    def _on_dir_trigger_file(self, name, autotriggered):
+        self.trigger(name, auto=autotriggered)
 
-                            for pipeline in Pipeline.pipelines:
-                                if pipeline.uid in dirs[relpath]:
-                                    pipeline.trigger(name, auto=autotriggered)
-        if _trigger_dir_obj:
-            _trigger_dir_obj.cleanup()
+    def _update_directory_status(self):
+        # show the progress of the initial scan of the directory watchers
+        self.progress_text = " , ".join([directory.get_status_text() for directory in [self.dir_in_obj, self.dir_out_obj]
+                                         if directory and directory.is_starting() and directory.get_status_text()])
 
-    def _monitor_book_triggers_thread(self):
+    def _monitor_thread(self):
+        last_stall_check = time.time()
         self.watchdog_bark()
         while self.shouldRun:
             time.sleep(5)
             self.watchdog_bark()
 
-            if not os.path.isdir(self.dir_trigger):
-                continue
+            if self.progress_text:
+                self._update_directory_status()
 
-            if not self.shouldHandleBooks:
-                continue
+            try:
+                self._check_preemption()
+                self._check_drain()
+            except Exception:
+                logging.exception("An error occured while checking whether the current book should be restarted")
 
-            for f in os.listdir(self.dir_trigger):
-                if not self.shouldRun:
-                    break  # stop iterating if we're shutting down the system
+            if time.time() - last_stall_check >= 30:
+                last_stall_check = time.time()
+                try:
+                    self._check_stall()
+                except Exception:
+                    logging.exception("An error occured while checking for stalls in {}".format(self.uid))
 
-                if f == "_name":
-                    continue
-                triggerfile = os.path.join(self.dir_trigger, f)
-                if os.path.isfile(triggerfile):
-                    try:
-                        autotriggered = False
-                        with open(triggerfile, "r") as tf:
-                            first_line = tf.readline().strip()
-                            if first_line == "autotriggered":
-                                autotriggered = True
-                        os.remove(triggerfile)
-                        self._add_book_to_queue(f, "autotriggered" if autotriggered else "triggered")
-                    except Exception:
-                        logging.exception("An error occured while trying to delete triggerfile: " + triggerfile)
+    def _check_stall(self):
+        # When the current book takes much longer than expected, or one of the pipeline threads has
+        # stopped barking, sample the stacks of all threads and store them next to the report for the book.
+        now = time.time()
+        if now - self._last_stall_sample < self.stall_sample_interval:
+            return
+
+        book = self.book
+        reason = None
+
+        if book and self.progress_start > 0:
+            expected = self.progress_expected if self.progress_expected else self.expected_processing_time
+            if now - self.progress_start > max(expected * self.stall_factor, self.stall_min_duration):
+                reason = "slow"
+
+        for thread, last_bark in list(self.watchdogs.items()):
+            if book and thread is self._bookHandlerThread:
+                continue  # the handler thread does not bark while handling a book; that is covered by the "slow" rule above
+            if thread.is_alive() and now - last_bark > self.stall_watchdog_timeout:
+                reason = "watchdog"
+                break
+
+        if not reason:
+            return
+
+        self._last_stall_sample = now
+        Metrics.increment("stalls", pipeline=self.uid, reason=reason)
+
+        if book and self._worker_pool:
+            # the book is handled in a worker process, which will sample its own stacks
+            logging.warning("{} seems to have stalled ({}), sampling stacks in the worker process".format(self.uid, reason))
+            self._worker_pool.sample_workers()
+            return
+
+        if book and self.utils.report:
+            directory = self.utils.report.reportDir()
+        else:
+            directory = os.path.join(Config.get_cache_dir(), "stalls", self.uid)
+        path = os.path.join(directory, "stall-{}-{}.folded".format(reason, time.strftime("%Y-%m-%d_%H-%M-%S")))
+
+        logging.warning("{} seems to have stalled ({}), sampling stacks to: {}".format(self.uid, reason, path))
+        StackSampler.write_profile(path)
+
+    def _book_fingerprint(self, name):
+        # use the checksum from the directory watcher if it's known, to avoid walking the book again
+        fingerprint = self.dir_in_obj.get_checksum(name) if self.dir_in_obj else None
+        if fingerprint is None and self.dir_in is not None:
+            _, fingerprint, _, _ = Filesystem.path_tree_md5(os.path.join(self.dir_in, name), prune=False)
+        return fingerprint
 
     def _retry_all_books_thread(self):
+        # Books are retried in order of staleness (the books that have gone the longest without succeeding
+        # are retried first), at a rate limited by a token bucket so that the queue is not flooded.
+        # Books that have not changed since they last succeeded are skipped.
         last_retry = 0
+        bucket = TokenBucket(self.retry_all_rate, self.retry_all_burst)
 
         self.watchdog_bark()
         while self.shouldRun:
@@ -689,16 +937,40 @@ class Pipeline():
             if not self.dirsAvailable():
                 continue
 
-            retry_interval = 2 * 60 * 60  # 2 hours
-
-            if time.time() - last_retry < retry_interval:
+            if time.time() - last_retry < self.retry_all_interval:
                 continue
 
             last_retry = time.time()
-            for filename in Filesystem.list_book_dir(self.dir_in):
+            try:
+                filenames = ScanEngine.list_book_dir(self.dir_in, max_age=60)
+                self.result_index.prune(filenames)
+                filenames = sorted(filenames, key=lambda name: self.result_index.staleness(name), reverse=True)
+            except Exception:
+                logging.exception("En feil oppstod ved opplisting av filer i: {}".format(self.dir_in))
+                continue
+
+            triggered = 0
+            for filename in filenames:
+                self.watchdog_bark()  # iterating all books can take some time, so let's bark here
                 if not (self.dirsAvailable() and self.shouldRun):
                     break  # break loop if we're shutting down the system or directory is not available
+
+                try:
+                    if self.result_index.is_unchanged(filename, self._book_fingerprint(filename)):
+                        continue  # nothing has changed since the book last succeeded
+                except Exception:
+                    logging.exception("Could not determine whether {} has changed".format(filename))
+
+                while self.shouldRun and not bucket.consume():
+                    time.sleep(5)
+                    self.watchdog_bark()
+                if not self.shouldRun:
+                    break
+
                 self.trigger(filename)
+                triggered += 1
+
+            logging.info("Retried {} of {} books in {}".format(triggered, len(filenames), self.dir_in))
 
     def _retry_missing_books_thread(self):
         last_rescan = 0
@@ -737,29 +1009,23 @@ class Pipeline():
             filenames = None
             total = None
             try:
-                # list files and directories
-                filenames_in = Filesystem.list_book_dir(self.dir_in)
-                filenames_out = Filesystem.list_book_dir(self.dir_out, subdirs=self.parentdirs)
-
-                # only use file stems (i.e. "123" instead of "123.epub")
-                identifiers_in = [filename.split(".")[0] for filename in filenames_in]
-                identifiers_out = [filename.split("/")[-1].split(".")[0] for filename in filenames_out]
-
-                # only use identifiers that exist in the catalog
-                missing_identifiers = Metadata.filter_identifiers(identifiers_in, identifiers_out, format=self.publication_format)
+                # index files and directories by their stems (i.e. "123" for "123.epub")
+                books_in = self._get_stem_index(self.dir_in_obj, self.dir_in)
+                if self.parentdirs:
+                    books_out = {}
+                    for p in self.parentdirs:
+                        # the parentdirs are not watched, so they are listed (the listings are shared with other pipelines)
+                        books_out.update(self._get_stem_index(None, os.path.join(self.dir_out, self.parentdirs[p])))
+                else:
+                    books_out = self._get_stem_index(self.dir_out_obj, self.dir_out)
 
-                # exclude list of identifiers in output directory from identifiers in input directory
+                # exclude identifiers in output directory from identifiers in input directory,
+                # and only use identifiers that exist in the catalog
+                missing_identifiers = Metadata.filter_identifiers(list(books_in), list(books_out), format=self.publication_format)
                 missing_identifiers = Metadata.sort_identifiers(missing_identifiers)
-                filenames = []
-                for identifier in missing_identifiers:
-                    if identifier in filenames_in:
-                        filenames.append(identifier)
-                    else:
-                        # find full filename in case of file extensions (i.e. "123.epub" instead of "123")
-                        for filename in filenames_in:
-                            if identifier == filename.split(".")[0]:
-                                filenames.append(filename)
-                                break
+
+                # find full filename in case of file extensions (i.e. "123.epub" instead of "123")
+                filenames = [books_in[identifier] for identifier in missing_identifiers if identifier in books_in]
 
                 # make filenames into absolute paths
                 filenames = [os.path.join(self.dir_in, filename) for filename in filenames]
@@ -801,6 +1067,14 @@ class Pipeline():
 
             self.considering_retry_book = None
 
+    @staticmethod
+    def _get_stem_index(directory, path):
+        if directory is not None and not directory.is_starting():
+            return directory.get_stem_index()
+        else:
+            # the directory is not watched, or the watcher is not ready yet, so we have to list the directory ourselves
+            return Directory.build_stem_index(ScanEngine.list_book_dir(path))
+
     def _handle_book_events_thread(self):
         self.watchdog_bark()
         while self.shouldRun:
@@ -812,12 +1086,16 @@ class Pipeline():
                 continue
 
             self.book = None
+            interrupted = False
 
             try:
                 if self.dir_out_obj is not None and not self.dir_out_obj.is_available():
                     time.sleep(5)
                     continue
 
+                if self.shortest_job_first:
+                    self._estimate_queue_durations()
+
                 if self.dir_in is not None and not os.path.isdir(self.dir_in):
                     # when base dir is not available we should stop watching the directory,
                     # this just catches a potential race condition
@@ -846,6 +1124,10 @@ class Pipeline():
 
                     books_autotriggered = [b for b in books if Pipeline.get_main_event(b) == "autotriggered"]
                     books_autotriggered = sorted(books_autotriggered, key=lambda b: b["last_event"], reverse=False)  # process recently autotriggered books last
+                    if self.shortest_job_first:
+                        # books with no estimate yet are handled last (the sort is stable, so ties keep the order from above)
+                        books_autotriggered = sorted(books_autotriggered, key=lambda b: (b.get("expected_duration") is None,
+                                                                                         b.get("expected_duration") or 0))
 
                     books_manual = [b for b in books if Pipeline.get_main_event(b) != "autotriggered"]
                     books_manual = sorted(books_manual, key=lambda b: b["last_event"], reverse=True)  # process recently modified books first
@@ -857,16 +1139,28 @@ class Pipeline():
                         # only process books outside of working hours.
                         books.extend(books_autotriggered)
 
+                    # books that were interrupted when the system stopped are resumed first
+                    books = sorted(books, key=lambda b: not b.get("interrupted"))
+
                     if books:
                         logging.info("queue: " + ", ".join(
                             [b["name"] for b in books][:5]) + (", ... ( " + str(len(books) - 5) + " more )" if len(books) > 5 else ""))
 
+                    if self.draining:
+                        books = []  # don't start any new books while draining
+
                     self.book = None
                     if len(books):
                         self.book = books[0]
 
+                        if LoadScheduler.mode == "load" and Pipeline.get_main_event(self.book) == "autotriggered":
+                            LoadScheduler.consume(self.uid)
+
                         new_queue = [b for b in self._queue if b is not self.book]
-                        self._queue = new_queue
+                        self._set_queue(new_queue)
+
+                        if self._journal:
+                            self._journal.start(self.book)
 
                 if self.book:
                     # Determine order of creation/deletion, as well as type of book event
@@ -878,7 +1172,7 @@ class Pipeline():
 
                     # check if source directory or file should be ignored
                     elif (self.book["source"] is not None
-                            and Filesystem.shutil_ignore_patterns(os.path.dirname(self.book["source"]), [os.path.basename(self.book["source"])])):
+                            and Filesystem.should_ignore(self.book["source"])):
                         logging.info("Ignoring book: {}".format(self.book["source"]))
 
                     # trigger book event
@@ -887,10 +1181,20 @@ class Pipeline():
                         self.utils.report = Report(self)
                         self.utils.filesystem = Filesystem(self)
                         result = None
+                        if self.book.pop("interrupted", False):
+                            self.utils.report.info("Forrige behandling av boken ble avbrutt fordi systemet ble stoppet. Behandlingen fortsetter nå.")
+                        trace = Trace.begin(self.book["name"], pipeline=self.uid, event=event)
 
                         # get some basic metadata (identifier and title) from the book for reporting purposes
                         book_metadata = Metadata.get_metadata_from_book(self.utils.report, self.book["source"] if self.book["source"] else self.book["name"])
 
+                        # predict how long it will take to handle the book, based on its size and number of files
+                        self.book_features = DurationModel.book_features(self.book["source"])
+                        self.progress_expected = self.duration_model.predict(size=self.book_features[0], files=self.book_features[1])
+                        self.book_fingerprint = self._book_fingerprint(self.book["name"]) if self.book["source"] else None
+
+                        self._cancelled.clear()
+
                         try:
                             self.progress_start = time.time()
                             self.utils.report.debug("Started: {}".format(time.strftime("%Y-%m-%d %H:%M:%S")))
@@ -898,7 +1202,10 @@ class Pipeline():
                             with Pipeline._group_locks[self.get_group_id()]["lock"]:
                                 Pipeline._group_locks[self.get_group_id()]["current-uid"] = self.uid
 
-                                if event == "created":
+                                if self._worker_pool:
+                                    result = self._worker_pool.run(self.book, event, self.utils.report)
+
+                                elif event == "created":
                                     result = self.on_book_created()
 
                                 elif event == "deleted":
@@ -938,8 +1245,30 @@ class Pipeline():
                                 self.utils.report.info("{} er gammel. Vi sender derfor ikke en e-post.".format(book_metadata["identifier"]))
                                 self.utils.report.should_email = False
 
+                            interrupted = self.utils.report.interrupted
+                            if interrupted:
+                                # the book stays in the queue journal, and is resumed when the system starts again
+                                self.utils.report.info("Systemet ble stoppet mens boken ble behandlet. Behandlingen fortsetter når systemet starter igjen.")
+                                self.utils.report.should_email = False
+                                self.utils.report.should_message_slack = False
+
+                            cancelled = self.is_cancelled()
+                            if cancelled:
+                                # the book is already back in the queue, and will be processed again shortly
+                                self.utils.report.info("Boken ble endret mens den ble behandlet. Behandlingen ble avbrutt, og starter på nytt.")
+                                self.utils.report.title = self.title + ": " + self.book["name"] + " ble avbrutt og startes på nytt"
+                                self.utils.report.should_email = False
+                                self.utils.report.should_message_slack = False
+
                             progress_end = time.time()
                             self.progress_log.append({"start": self.progress_start, "end": progress_end})
+                            self.progress_log = self.progress_log[-10:]
+                            if not cancelled and not interrupted:
+                                self.duration_model.record(progress_end - self.progress_start,
+                                                           size=self.book_features[0],
+                                                           files=self.book_features[1],
+                                                           save=False)
+                                self.result_index.record(self.book["name"], result is True, fingerprint=self.book_fingerprint)
                             self.utils.report.debug("Finished: {}".format(time.strftime("%Y-%m-%d %H:%M:%S")))
 
                             if self.stopAfterNJobs > 0:
@@ -955,6 +1284,11 @@ class Pipeline():
                             except Exception:
                                 logging.exception("An error occured while sending email")
                             finally:
+                                Trace.end(trace)
+                                Trace.store(trace, self.utils.report.reportDir(), self.uid)
+                                if not cancelled and not interrupted:
+                                    self._record_stage_durations(trace)
+
                                 logpath = self.utils.report.attachLog()
                                 logging.warning("Logfile: " + logpath)
                             if self.utils.report.should_email:
@@ -971,12 +1305,21 @@ class Pipeline():
                     logging.exception("Could not e-mail exception")
 
             finally:
+                if self.book and self._journal and not interrupted:
+                    self._journal.finish(self.book["name"])
                 self.book = None
+                self._cancelled.clear()
                 time.sleep(1)
 
         self.running = False
 
-    def daily_report(self, message):
+    def daily_report(self, message=None, date=None):
+        """E-mail the daily report. Unless a message is given, it is rendered from the outcomes recorded on `date` (default: yesterday)."""
+        if message is None:
+            if date is None:
+                date = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+            message = DailyReport.render(self.dir_reports, self.uid, date)
+
         report_daily = Report(self)
         report_daily._messages["message"].append({'time': time.strftime("%Y-%m-%d %H:%M:%S"),
                                                   'severity': "INFO",
@@ -1010,76 +1353,56 @@ class Pipeline():
             logging.info(traceback.format_exc())
 
     def write_to_daily(self):
-        error = ""
-        attachment_unc = []
-        attachment_smb = []
-        attachment_title = []
-        subject = self.utils.report.title
-        for item in self.utils.report._messages["attachment"]:
+        # record the outcome of the book for the daily report
+        report = self.utils.report
+        subject = report.title
+
+        attachments = []
+        for item in report._messages["attachment"]:
             if (self.dir_out is not None and self.dir_out in item["text"]
                     or self.dir_in is not None and self.dir_in in item["text"]
                     or self.dir_reports in item["text"]):
                 base_path = Filesystem.get_base_path(item["text"], self.dir_base)
                 relpath = os.path.relpath(item["text"], base_path) if base_path else None
-                attachment_title.append("{}{}".format(relpath, ("/" if os.path.isdir(item["text"]) else "")))
                 smb, file, unc = Filesystem.networkpath(item["text"])
-                attachment_unc.append(unc)
-                attachment_smb.append(smb)
-        for u in self.utils.report._messages["message"]:
-            if (u["severity"] == "ERROR"):
-                if not(u["text"] == ""):
-                    for line in u["text"].split("\n"):
-                        if line != "":
-                            error = line
-            elif(u["severity"] == "WARN") and (error == "") and not (u["text"] == ""):
-                if not(u["text"] == ""):
-                    for line in u["text"].split("\n"):
-                        if line != "":
-                            error = line
-        timestring = datetime.datetime.now().strftime("%Y-%m-%d")
-        dir = os.path.join(self.dir_reports, "logs", "dagsrapporter", timestring)
-        if not os.path.isdir(dir):
-            os.makedirs(dir)
-        fail = False
-        if "👍😄" in subject:
-            loc = os.path.join(dir, self.uid + "-SUCCESS.txt")
-        else:
-            loc = os.path.join(dir, self.uid + "-FAIL.txt")
-            fail = True
+                attachments.append({
+                    "title": "{}{}".format(relpath, ("/" if os.path.isdir(item["text"]) else "")),
+                    "unc": unc,
+                    "smb": smb,
+                })
+
+        # use the last error, or if there are no errors, the last warning
+        error = ""
+        warning = ""
+        for message in report._messages["message"]:
+            if message["severity"] in ["ERROR", "WARN"] and message["text"]:
+                lines = [line for line in message["text"].split("\n") if line != ""]
+                if lines and message["severity"] == "ERROR":
+                    error = lines[-1]
+                elif lines:
+                    warning = lines[-1]
+
+        success = "👍😄" in subject
+        epub_identifier = None
+        for split in subject.split():
+            if split.isnumeric():
+                epub_identifier = split
+                break
 
         try:
-            epub_identifier = None
-            with open(loc, Pipeline.append_write(loc)) as today_status_file:
-                split_subject = subject.split()
-                for split in split_subject:
-                    if split.isnumeric():
-                        epub_identifier = split
-                        break
-                if self.utils.report.mailpath != ():
-                    today_status_file.write("\n[{}] {}: {} mail: {}, {}".format(
-                                                time.strftime("%H:%M:%S"),
-                                                epub_identifier,
-                                                subject,
-                                                self.utils.report.mailpath[2],
-                                                self.utils.report.mailpath[0]))
-                else:
-                    today_status_file.write("\n[{}] {}: {}".format(time.strftime("%H:%M:%S"), epub_identifier, subject))
-                if fail is True and error != "":
-                    today_status_file.write("\n" + "(li) " + error)
-                for attach_title, attach_unc, attach_smb in zip(attachment_title, attachment_unc, attachment_smb):
-                    today_status_file.write("\n(href) {}, {}, {}".format(attach_title, attach_unc, attach_smb))
-                today_status_file.write("\n")
+            DailyReport.record(self.dir_reports, self.uid, {
+                "identifier": epub_identifier,
+                "book": self.book["name"] if self.book else None,
+                "title": subject,
+                "success": success,
+                "error": None if success else (error or warning or None),
+                "mail": {"unc": report.mailpath[2], "smb": report.mailpath[0]} if report.mailpath != () else None,
+                "attachments": attachments,
+            })
 
         except Exception:
             logging.info(traceback.format_exc())
 
-    @staticmethod
-    def append_write(path):
-        if os.path.exists(path):
-            return 'a'  # append if already exists
-        else:
-            return 'w'  # make a new file if not
-
     @staticmethod
     def get_main_event(book):
         # always prefer "triggered" over other events
@@ -1154,6 +1477,7 @@ class DummyPipeline(Pipeline):
         self.utils.filesystem = Filesystem(self)
         self._queue_lock = RLock()
         self._md5_lock = RLock()
+        self._cancelled = threading.Event()
         self.shouldRun = False
         self.book = None
         self.considering_retry_book = None
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import time
+from threading import RLock
+
+from core.config import Config
+from core.utils.kv_store import KeyValueStore
+
+
+class BookResultIndex():
+    """
+    Persistent index of the results for each book in a pipeline.
+
+    For each book we store when it was last handled, when it last succeeded, and the
+    fingerprint (deep checksum) of the book as it was when it last succeeded. This is
+    used to decide which books are worth retrying, and in which order.
+
+    The index is kept in a KeyValueStore, so that recording a result only writes the entry for that book.
+    """
+
+    _indexes = {}
+    _static_lock = RLock()
+
+    uid = None
+    path = None
+    books = None
+    _store = None
+    _lock = None
+
+    def __init__(self, uid, path=None):
+        self.uid = uid
+        self.path = path if path else os.path.join(Config.get_cache_dir(), "results.{}.sqlite".format(uid))
+        self.books = {}
+        self._lock = RLock()
+        self.load()
+
+    @staticmethod
+    def get(uid):
+        """Get the (shared) result index for the pipeline with the given uid"""
+        with BookResultIndex._static_lock:
+            if uid not in BookResultIndex._indexes:
+                BookResultIndex._indexes[uid] = BookResultIndex(uid)
+            return BookResultIndex._indexes[uid]
+
+    def load(self):
+        with self._lock:
+            try:
+                self._store = KeyValueStore(self.path)
+                self.books = self._store.items()
+                if not self.books:
+                    self._migrate_json(os.path.join(os.path.dirname(self.path), "results.{}.json".format(self.uid)))
+            except Exception:
+                logging.exception("Could not load result index: {}".format(self.path))
+                self._store = None
+                self.books = {}
+
+    def _migrate_json(self, json_file):
+        # the index used to be stored as a single JSON file
+        if not os.path.isfile(json_file):
+            return
+        try:
+            with open(json_file, "r") as f:
+                self.books = json.load(f).get("books", {})
+            self._store.update(changed=self.books)
+            os.remove(json_file)
+            logging.info("Migrated {} to {}".format(json_file, self.path))
+        except Exception:
+            logging.exception("Could not migrate result index: {}".format(json_file))
+
+    def save(self, changed=None, deleted=None):
+        """Store the given entries (all entries if neither `changed` nor `deleted` is given)"""
+        with self._lock:
+            if self._store is None:
+                return
+            if changed is None and deleted is None:
+                changed = self.books
+            try:
+                self._store.update(changed={name: self.books[name] for name in (changed or [])}, deleted=deleted)
+            except Exception:
+                logging.exception("Could not store result index: {}".format(self.path))
+
+    def record(self, name, success, fingerprint=None):
+        """Record the result of handling a book. `fingerprint` is the checksum of the book that was handled."""
+        with self._lock:
+            entry = self.books.setdefault(name, {"last_run": None, "last_success": None, "fingerprint": None})
+            entry["last_run"] = time.time()
+            if success:
+                entry["last_success"] = entry["last_run"]
+                entry["fingerprint"] = fingerprint
+            self.save(changed=[name])
+
+    def last_success(self, name):
+        with self._lock:
+            entry = self.books.get(name)
+            return entry["last_success"] if entry else None
+
+    def staleness(self, name):
+        """Seconds since the book last succeeded (infinite if it never has)"""
+        last_success = self.last_success(name)
+        return time.time() - last_success if last_success else float("inf")
+
+    def is_unchanged(self, name, fingerprint):
+        """Whether the book has succeeded before, and has not changed since"""
+        with self._lock:
+            entry = self.books.get(name)
+            return bool(entry and entry["last_success"] and fingerprint and entry["fingerprint"] == fingerprint)
+
+    def prune(self, names):
+        """Forget books that are not in `names` (i.e. books that have been removed from the input directory)"""
+        names = set(names)
+        with self._lock:
+            removed = [name for name in self.books if name not in names]
+            for name in removed:
+                del self.books[name]
+            if removed:
+                self.save(deleted=removed)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_IMODE
+from threading import RLock
+
+
+class CopyEngine():
+    """
+    Copies files and directory trees.
+
+    Files in a tree are copied in parallel by a bounded pool of threads, and each file is copied
+    with the fastest method the filesystem supports:
+
+    - a reflink (FICLONE), which shares the data blocks on filesystems like btrfs and XFS,
+    - os.copy_file_range, which copies in the kernel, and lets NFS 4.2 and SMB 3 servers copy server-side,
+    - os.sendfile, and finally a plain read/write loop.
+
+    When the source and the target are on the same device, files can be hardlinked instead of copied
+    (COPY_HARDLINK=true, or hardlink=True). This is only safe when neither copy will be modified in place,
+    so it is not the default. Files are never hardlinked when their permissions should be changed,
+    as that would change the permissions of the source as well.
+
+    Permissions can be set while copying (file_mode and dir_mode), so that there is no need to walk
+    the tree again afterwards to fix them.
+
+    When a previous copy of the tree is given, files that are unchanged there are reused instead of
+    copied from the source (delta copy): they are hardlinked from the previous copy if possible, so
+    that no data has to be written.
+    """
+
+    workers = int(os.getenv("COPY_WORKERS", 8))  # files that are copied in parallel
+    hardlink = os.getenv("COPY_HARDLINK", "false").lower() == "true"
+    chunk_size = 8 * 1024 * 1024  # bytes per copy_file_range / sendfile / read call
+
+    FICLONE = 0x40049409  # from linux/fs.h
+
+    # (source device, target device) pairs where a method has failed, so that it's not tried again
+    _lock = RLock()
+    _no_reflink = set()
+    _no_copy_file_range = set()
+    _no_sendfile = set()
+
+    @staticmethod
+    def copy_file(src, dst, file_mode=None, preserve_times=True, hardlink=None):
+        """
+        Copy the file `src` to `dst` (or into `dst`, if it is a directory).
+
+        The permissions are set to `file_mode`, or copied from `src` if it is None.
+        If preserve_times is True, the access and modification times are copied as well (like shutil.copy2).
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        hardlink = CopyEngine.hardlink if hardlink is None else hardlink
+
+        src_stat = os.stat(src)
+        mode = file_mode if file_mode is not None else S_IMODE(src_stat.st_mode)
+
+        if hardlink and mode == S_IMODE(src_stat.st_mode) and CopyEngine._link(src, dst, src_stat):
+            return dst
+
+        src_fd = os.open(src, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, mode)
+            try:
+                CopyEngine._copy_data(src_fd, dst_fd, (src_stat.st_dev, os.fstat(dst_fd).st_dev), src_stat.st_size)
+
+                # set the metadata after the data is written (and even though the file was created with the mode, because of umask)
+                os.fchmod(dst_fd, mode)
+                if preserve_times:
+                    os.utime(dst_fd, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+        return dst
+
+    @staticmethod
+    def _link(src, dst, src_stat):
+        try:
+            if os.stat(os.path.dirname(os.path.abspath(dst))).st_dev != src_stat.st_dev:
+                return False
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.link(src, dst)
+            return True
+        except OSError:
+            logging.debug("Could not hardlink {} to {}, copying it instead".format(src, dst), exc_info=True)
+            return False
+
+    @staticmethod
+    def _copy_data(src_fd, dst_fd, devices, size):
+        if devices not in CopyEngine._no_reflink:
+            try:
+                fcntl.ioctl(dst_fd, CopyEngine.FICLONE, src_fd)
+                return
+            except OSError:
+                with CopyEngine._lock:
+                    CopyEngine._no_reflink.add(devices)  # not supported, or source and target are on different filesystems
+
+        if hasattr(os, "copy_file_range") and devices not in CopyEngine._no_copy_file_range:
+            if CopyEngine._copy_loop(lambda: os.copy_file_range(src_fd, dst_fd, CopyEngine.chunk_size),
+                                     devices, CopyEngine._no_copy_file_range, size):
+                return
+            CopyEngine._rewind(src_fd, dst_fd)
+
+        if devices not in CopyEngine._no_sendfile:
+            if CopyEngine._copy_loop(lambda: os.sendfile(dst_fd, src_fd, None, CopyEngine.chunk_size),
+                                     devices, CopyEngine._no_sendfile, size):
+                return
+            CopyEngine._rewind(src_fd, dst_fd)
+
+        while True:
+            data = os.read(src_fd, CopyEngine.chunk_size)
+            if not data:
+                break
+            view = memoryview(data)
+            while view:
+                view = view[os.write(dst_fd, view):]
+
+    @staticmethod
+    def _copy_loop(copy_chunk, devices, unsupported, size):
+        # Copy until the end of the file with the given method. Returns False if the method is
+        # not supported here, or if it did not copy the whole file, so that another method can be used.
+        copied = 0
+        while True:
+            try:
+                length = copy_chunk()
+            except OSError as e:
+                if copied == 0 and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF, errno.ENOTSUP):
+                    with CopyEngine._lock:
+                        unsupported.add(devices)
+                    return False
+                raise
+            if not length:
+                break
+            copied += length
+
+        if copied != size:
+            # some filesystems (or kernels) report the end of the file too early
+            logging.warning("Copied {} of {} bytes with {}, copying with another method instead".format(
+                copied, size, "copy_file_range" if unsupported is CopyEngine._no_copy_file_range else "sendfile"))
+            with CopyEngine._lock:
+                unsupported.add(devices)
+            return False
+        return True
+
+    @staticmethod
+    def _rewind(src_fd, dst_fd):
+        # start over after a failed (or partial) copy
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        os.lseek(dst_fd, 0, os.SEEK_SET)
+        os.ftruncate(dst_fd, 0)
+
+    @staticmethod
+    def copytree(src, dst, ignore=None, file_mode=None, dir_mode=None, preserve_times=True, hardlink=None, previous=None, unchanged=None):
+        """
+        Copy the directory `src` to `dst`, which must not exist. Similar to shutil.copytree, and like
+        shutil.copytree, a shutil.Error with a list of (src, dst, error) is raised if anything fails.
+
+        The directories are created as the tree is walked, and the files are copied by a pool of threads.
+
+        If `previous` is a previous copy of `src`, files where `unchanged(src_file, previous_file)` is True
+        are taken from `previous` instead of from `src`.
+        """
+        errors = []
+        directories = []
+        futures = []
+        options = {"file_mode": file_mode, "preserve_times": preserve_times, "hardlink": hardlink, "unchanged": unchanged}
+
+        with ThreadPoolExecutor(max_workers=max(1, CopyEngine.workers), thread_name_prefix="copy") as executor:
+            CopyEngine._copy_directory(src, dst, previous, ignore, options, executor, futures, directories, errors)
+
+            reused = 0
+            for future, file_src, file_dst in futures:
+                try:
+                    reused += 1 if future.result() else 0
+                except OSError as e:
+                    errors.append((file_src, file_dst, str(e)))
+
+        if previous is not None:
+            logging.debug("Copied {} files from {}, reused {} unchanged files from {}".format(len(futures) - reused, src, reused, previous))
+
+        # the permissions and times of the directories are set last, as copying the files changes the modification times
+        for dir_src, dir_dst in reversed(directories):
+            try:
+                if dir_mode is not None:
+                    os.chmod(dir_dst, dir_mode)
+                elif preserve_times:
+                    shutil.copystat(dir_src, dir_dst)
+                else:
+                    shutil.copymode(dir_src, dir_dst)
+            except OSError as e:
+                errors.append((dir_src, dir_dst, str(e)))
+
+        if errors:
+            raise shutil.Error(errors)
+        return dst
+
+    @staticmethod
+    def _copy_directory(src, dst, previous, ignore, options, executor, futures, directories, errors):
+        try:
+            with os.scandir(src) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+            os.makedirs(dst)
+        except OSError as e:
+            errors.append((src, dst, str(e)))
+            return
+        directories.append((src, dst))
+
+        ignored = ignore(src, [entry.name for entry in entries]) if ignore else set()
+        for entry in entries:
+            if entry.name in ignored:
+                continue
+            entry_dst = os.path.join(dst, entry.name)
+            entry_previous = os.path.join(previous, entry.name) if previous is not None else None
+            try:
+                is_dir = entry.is_dir()  # symlinks are followed, like in shutil.copytree
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                if entry_previous is not None and not os.path.isdir(entry_previous):
+                    entry_previous = None
+                CopyEngine._copy_directory(entry.path, entry_dst, entry_previous, ignore, options, executor, futures, directories, errors)
+            else:
+                future = executor.submit(CopyEngine.copy_or_reuse, entry.path, entry_dst, entry_previous, **options)
+                futures.append((future, entry.path, entry_dst))
+
+    @staticmethod
+    def copy_or_reuse(src, dst, previous, file_mode=None, preserve_times=True, hardlink=None, unchanged=None):
+        """Copy `src` to `dst`, or reuse `previous` if `unchanged(src, previous)`. Returns True if the previous copy was reused."""
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        if previous is not None and unchanged is not None and os.path.isfile(previous) and unchanged(src, previous):
+            try:
+                os.link(previous, dst)  # the previous copy is about to be replaced, so it's fine to share the file with it
+                if file_mode is not None:
+                    os.chmod(dst, file_mode)
+            except OSError:
+                # i.e. the filesystem does not support hardlinks: copy from the previous copy,
+                # which may be done server-side (see _copy_data)
+                CopyEngine.copy_file(previous, dst, file_mode=file_mode, preserve_times=True, hardlink=False)
+            return True
+
+        CopyEngine.copy_file(src, dst, file_mode=file_mode, preserve_times=preserve_times, hardlink=hardlink)
+        return False
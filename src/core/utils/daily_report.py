@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import time
+from threading import RLock, Timer
+
+
+class DailyReport():
+    """
+    Aggregates the outcome of each book, for the daily reports.
+
+    Outcomes are buffered in memory and appended in batches to one JSON-lines file
+    per pipeline and day (<dir_reports>/logs/dagsrapporter/<date>/<uid>.jsonl).
+    A timer makes sure that buffered outcomes are written within a minute, even when no more books finish.
+    The daily report is rendered from these structured records.
+    """
+
+    flush_size = 50  # flush when this many outcomes are buffered…
+    flush_interval = 60  # …or when the oldest buffered outcome is this old (seconds)
+
+    _lock = RLock()
+    _buffer = {}  # { path: [outcome, …] }
+    _oldest = None
+    _timer = None
+
+    @staticmethod
+    def path(dir_reports, uid, date):
+        return os.path.join(dir_reports, "logs", "dagsrapporter", date, "{}.jsonl".format(uid))
+
+    @staticmethod
+    def record(dir_reports, uid, outcome):
+        """Add the outcome of a book (a dict) to the daily report"""
+        outcome = dict(outcome)
+        outcome.setdefault("time", time.time())
+        date = time.strftime("%Y-%m-%d", time.localtime(outcome["time"]))
+
+        with DailyReport._lock:
+            DailyReport._buffer.setdefault(DailyReport.path(dir_reports, uid, date), []).append(outcome)
+            if DailyReport._oldest is None:
+                DailyReport._oldest = time.time()
+            DailyReport._schedule_flush()
+
+            buffered = sum(len(outcomes) for outcomes in DailyReport._buffer.values())
+            if buffered >= DailyReport.flush_size or time.time() - DailyReport._oldest >= DailyReport.flush_interval:
+                DailyReport.flush()
+
+    @staticmethod
+    def flush():
+        with DailyReport._lock:
+            for path in list(DailyReport._buffer.keys()):
+                try:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, "a") as f:
+                        for outcome in DailyReport._buffer[path]:
+                            f.write(json.dumps(outcome) + "\n")
+                    del DailyReport._buffer[path]
+                except Exception:
+                    logging.exception("Could not write daily report: {}".format(path))
+            DailyReport._oldest = time.time() if DailyReport._buffer else None
+
+    @staticmethod
+    def _schedule_flush():
+        # must be called with the lock held
+        if DailyReport._timer is None:
+            DailyReport._timer = Timer(DailyReport.flush_interval, DailyReport._flush_timer)
+            DailyReport._timer.daemon = True
+            DailyReport._timer.start()
+
+    @staticmethod
+    def _flush_timer():
+        with DailyReport._lock:
+            DailyReport._timer = None
+            DailyReport.flush()
+            if DailyReport._buffer:
+                DailyReport._schedule_flush()  # could not write all of it, try again later
+
+    @staticmethod
+    def outcomes(dir_reports, uid, date):
+        """Returns the outcomes recorded for the pipeline on the given date ("YYYY-MM-DD")"""
+        path = DailyReport.path(dir_reports, uid, date)
+        DailyReport.flush()
+
+        outcomes = []
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        outcomes.append(json.loads(line))
+                    except ValueError:
+                        continue  # partially written line
+        return outcomes
+
+    @staticmethod
+    def render(dir_reports, uid, date):
+        """Render the daily report for the pipeline on the given date, as markdown"""
+        outcomes = DailyReport.outcomes(dir_reports, uid, date)
+        failed = [o for o in outcomes if not o.get("success")]
+        succeeded = [o for o in outcomes if o.get("success")]
+
+        lines = ["{} bøker ble behandlet {}: {} lyktes og {} feilet.".format(len(outcomes), date, len(succeeded), len(failed))]
+
+        for heading, group in [("Feilet", failed), ("Lyktes", succeeded)]:
+            if not group:
+                continue
+            lines.append("")
+            lines.append("## {}".format(heading))
+            lines.append("")
+            for outcome in group:
+                line = "- [{}] {}: {}".format(time.strftime("%H:%M:%S", time.localtime(outcome["time"])),
+                                              outcome.get("identifier"),
+                                              outcome.get("title"))
+                if outcome.get("mail"):
+                    line += " ([e-post]({}))".format(outcome["mail"]["smb"])
+                lines.append(line)
+                if outcome.get("error"):
+                    lines.append("    - {}".format(outcome["error"]))
+                for attachment in outcome.get("attachments", []):
+                    lines.append("    - [{}]({}) ({})".format(attachment["title"], attachment["smb"], attachment["unc"]))
+
+        return "\n".join(lines)
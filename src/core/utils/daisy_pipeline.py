@@ -6,6 +6,7 @@ import base64
 import datetime
 import hashlib
 import hmac
+import json
 import os
 import random
 import re
@@ -22,8 +23,10 @@ import requests
 from lxml import etree as ElementTree
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
+from core.config import Config
 from core.utils.timeout_lock import TimeoutLock
 from core.utils.filesystem import Filesystem
+from core.utils.trace import Trace
 
 
 class DaisyPipelineJob():
@@ -42,6 +45,7 @@ class DaisyPipelineJob():
     priority = None
     found_pipeline_version = None
     found_script_version = None
+    keep_job = False  # don't delete the job when done (it has been checkpointed)
 
     # treat these as class variables, specific for local jobs
     pid = None
@@ -53,6 +57,7 @@ class DaisyPipelineJob():
     engines = None
     engine_lock = TimeoutLock()
     engine_jobs = None  # for cleaning up old jobs
+    checkpoint_lock = TimeoutLock()
 
     dp2_ws_namespace = {"d": 'http://www.daisy.org/ns/pipeline/data'}
 
@@ -257,17 +262,18 @@ class DaisyPipelineJob():
         self.priority = priority
         self.pipeline_and_script_version = pipeline_and_script_version
 
+    @Trace.traced("daisy_pipeline")
     def __enter__(self):
         DaisyPipelineJob.init_environment()
 
         self._dir_output_obj = tempfile.TemporaryDirectory(prefix="produksjonssystem-", suffix="-daisy-pipeline-output")
         self.dir_output = self._dir_output_obj.name
 
-        if self.choose_engine():
+        if self.reattach() or self.choose_engine():
             try:
-                self.post_job()
-
-                self.status = "IDLE"
+                if not self.job_id:
+                    self.post_job()
+                    self.status = "IDLE"
                 idle_start = time.time()
                 running_start = time.time()
                 idle_timeout = 3600 * 2.5
@@ -276,7 +282,18 @@ class DaisyPipelineJob():
                 engine_died = False
                 while not timed_out and self.status in ["IDLE", "RUNNING"]:
                     if not self.pipeline.shouldRun:
-                        self.pipeline.utils.report.error("Systemet er i ferd med å slå seg av, og Pipeline 2-jobben ble derfor ikke ferdig.")
+                        if self.checkpoint():
+                            self.pipeline.utils.report.warning("Systemet er i ferd med å slå seg av. Pipeline 2-jobben {} kjører videre, ".format(self.job_id)
+                                                               + "og blir hentet igjen når systemet starter.")
+                            self.pipeline.utils.report.interrupted = True
+                        else:
+                            self.pipeline.utils.report.error("Systemet er i ferd med å slå seg av, og Pipeline 2-jobben ble derfor ikke ferdig.")
+                        self.status = None
+                        break
+
+                    if self.pipeline.is_cancelled():
+                        # the job is deleted in __exit__
+                        self.pipeline.utils.report.warning("Behandlingen ble avbrutt, og Pipeline 2-jobben ble derfor ikke ferdig.")
                         self.status = None
                         break
 
@@ -479,9 +496,106 @@ class DaisyPipelineJob():
         return True, alive, scripts
 
     def __exit__(self, exc_type, exc_value, trace):
-        if self.job_id:
+        if self.job_id and not self.keep_job:
             self.delete_job(self.engine, self.job_id)
 
+    @staticmethod
+    def checkpoint_path(uid):
+        return os.path.join(Config.get_cache_dir(), "dp2-checkpoints.{}.json".format(uid))
+
+    @staticmethod
+    def load_checkpoints(uid):
+        path = DaisyPipelineJob.checkpoint_path(uid)
+        if not os.path.isfile(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except Exception:
+            logging.exception("Could not read Pipeline 2 checkpoints: {}".format(path))
+            return {}
+
+    @staticmethod
+    def save_checkpoints(uid, checkpoints):
+        path = DaisyPipelineJob.checkpoint_path(uid)
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(checkpoints, f, indent=2)
+            os.replace(path + ".tmp", path)
+        except Exception:
+            logging.exception("Could not store Pipeline 2 checkpoints: {}".format(path))
+
+    @staticmethod
+    def fingerprint(path):
+        if not path or not os.path.exists(path):
+            return None
+        md5, _ = Filesystem.path_md5(path=path, shallow=False)
+        return md5
+
+    def checkpoint_key(self):
+        return "{}:{}".format(self.pipeline.book["name"], self.script)
+
+    def checkpoint(self):
+        """
+        Store the job id, so that we can continue waiting for the job when the system starts again,
+        instead of posting a new job. Returns True if the job was checkpointed.
+        """
+        if not self.job_id or not self.engine or not self.pipeline.book:
+            return False
+
+        with DaisyPipelineJob.checkpoint_lock.acquire_timeout(60) as locked:
+            if not locked:
+                return False
+            checkpoints = DaisyPipelineJob.load_checkpoints(self.pipeline.uid)
+            checkpoints[self.checkpoint_key()] = {
+                "job_id": self.job_id,
+                "endpoint": self.engine["endpoint"],
+                "script": self.script,
+                "fingerprint": DaisyPipelineJob.fingerprint(self.pipeline.book["source"]),
+                "time": time.time(),
+            }
+            DaisyPipelineJob.save_checkpoints(self.pipeline.uid, checkpoints)
+
+        self.keep_job = True
+        return True
+
+    def reattach(self):
+        """If a job for this book and script was checkpointed, continue with that job. Returns True if reattached."""
+        if not self.pipeline.book:
+            return False
+
+        with DaisyPipelineJob.checkpoint_lock.acquire_timeout(60) as locked:
+            if not locked:
+                return False
+            checkpoints = DaisyPipelineJob.load_checkpoints(self.pipeline.uid)
+            checkpoint = checkpoints.pop(self.checkpoint_key(), None)
+            if checkpoint is None:
+                return False
+            DaisyPipelineJob.save_checkpoints(self.pipeline.uid, checkpoints)
+
+        engines = [engine for engine in DaisyPipelineJob.engines if engine["endpoint"] == checkpoint["endpoint"]]
+        if not engines:
+            return False
+        engine = engines[0]
+
+        if checkpoint["fingerprint"] != DaisyPipelineJob.fingerprint(self.pipeline.book["source"]):
+            self.pipeline.utils.report.info("Boken er endret siden forrige Pipeline 2-jobb ble startet. Starter en ny jobb.")
+            self.delete_job(engine, checkpoint["job_id"])
+            return False
+
+        self.engine = engine
+        self.job_id = checkpoint["job_id"]
+        self.status = None
+        if self.get_status() is None:
+            # the job no longer exists (for instance if the engine was restarted)
+            self.engine = None
+            self.job_id = None
+            return False
+
+        self.pipeline.utils.report.info("Fortsetter med Pipeline 2-jobben {} på {}, som ble startet før systemet ble startet på nytt.".format(
+            self.job_id, self.engine["endpoint"]))
+        return True
+
     def post_job(self):
         self.pipeline.utils.report.debug("Posting job")
 
@@ -683,6 +797,21 @@ class DaisyPipelineJob():
         except Exception:
             return False
 
+    @staticmethod
+    def count_active_jobs(engine):
+        """Number of jobs that are waiting or running in the engine (None if unknown)"""
+        url = DaisyPipelineJob.encode_url(engine, "/jobs", {})
+        try:
+            response = requests.get(url, timeout=10)
+            if not response.ok:
+                return None
+            xml = ElementTree.XML(str(response.content, 'utf-8').split("?>")[-1])
+        except Exception:
+            return None
+
+        jobs = xml.xpath("/d:jobs/d:job", namespaces=DaisyPipelineJob.dp2_ws_namespace)
+        return len([job for job in jobs if job.attrib.get("status") in ["IDLE", "RUNNING"]])
+
     def get_queue_size(self, engine):
         url = DaisyPipelineJob.encode_url(engine, "/jobs", {})
         try:
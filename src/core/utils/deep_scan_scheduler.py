@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from threading import RLock
+
+
+class DeepScanScheduler():
+    """
+    Decides which books in a directory to deep check, so that the load on the filesystem is predictable.
+
+    Deep checks are paced by an IO budget, measured in stat calls per second. The rate is the lowest of:
+
+    - the budget (DIRECTORY_DEEP_SCAN_BUDGET),
+    - the rate needed to check all books once per cycle (DIRECTORY_DEEP_SCAN_CYCLE),
+      so that small directories are not checked over and over again,
+    - the rate that keeps us waiting on stat calls at most a fraction (DIRECTORY_DEEP_SCAN_DUTY)
+      of the time, based on the measured stat latency, so that slow network filesystems are not saturated.
+
+    The cost of each book is the number of stat calls from its last check (books that have not been checked yet
+    are assumed to cost the average). The total is kept up to date as costs are recorded, so that this
+    stays cheap for directories with many books. Books are checked in order of
+    how overdue they are, and books with recent activity are considered more overdue than books that
+    have not changed in a long time.
+    """
+
+    budget = float(os.getenv("DIRECTORY_DEEP_SCAN_BUDGET", 500))  # max. stat calls per second
+    cycle_time = float(os.getenv("DIRECTORY_DEEP_SCAN_CYCLE", 60 * 60))  # target time (seconds) to deep check all books
+    max_duty = float(os.getenv("DIRECTORY_DEEP_SCAN_DUTY", 0.2))  # max. fraction of time spent on stat calls
+    activity_window = 24 * 60 * 60  # books modified within about this many seconds are prioritized
+    activity_boost = 4  # a book that was just modified is considered this much more overdue
+    max_credit_time = 60  # seconds of unused budget that can be saved up
+    default_cost = 100  # stat calls, for books that have not been checked yet
+    latency_weight = 0.2  # weight of new measurements in the moving average of the stat latency
+
+    latency = None
+    costs = None  # { book: stat calls }, only for books in the directory (forget is called when a book is removed)
+    total_cost = None  # sum of costs
+    credit = None
+    last_update = None
+    _lock = None
+
+    def __init__(self):
+        self.costs = {}
+        self.total_cost = 0
+        self.credit = 0
+        self.last_update = time.time()
+        self._lock = RLock()
+
+    def record(self, book, stats, duration):
+        """Record that a deep check of `book` needed `stats` stat calls and took `duration` seconds"""
+        with self._lock:
+            stats = max(1, stats)
+            self.total_cost += stats - self.costs.get(book, 0)
+            self.costs[book] = stats
+            sample = duration / stats
+            if self.latency is None:
+                self.latency = sample
+            else:
+                self.latency += DeepScanScheduler.latency_weight * (sample - self.latency)
+
+    def forget(self, book):
+        with self._lock:
+            self.total_cost -= self.costs.pop(book, 0)
+
+    def cost(self, book):
+        with self._lock:
+            if book in self.costs:
+                return self.costs[book]
+            return self._average_cost()
+
+    def _average_cost(self):
+        if self.costs:
+            return self.total_cost / len(self.costs)
+        return DeepScanScheduler.default_cost
+
+    def _total_cost(self, books):
+        # the books that have been checked are among `books`, the rest are assumed to cost the average
+        unchecked = max(0, len(books) - len(self.costs))
+        return self.total_cost + unchecked * self._average_cost()
+
+    def rate(self, books):
+        """The number of stat calls per second to use, for a directory with the given books"""
+        with self._lock:
+            total_cost = self._total_cost(books)
+            rate = min(DeepScanScheduler.budget, total_cost / DeepScanScheduler.cycle_time)
+            if self.latency:
+                rate = min(rate, DeepScanScheduler.max_duty / self.latency)
+            return rate
+
+    def priority(self, deep_checked, modified, now=None):
+        """How overdue a book is for a deep check, in (weighted) seconds"""
+        now = now if now is not None else time.time()
+        since_modified = max(0, now - modified)
+        weight = 1 + DeepScanScheduler.activity_boost * DeepScanScheduler.activity_window / (DeepScanScheduler.activity_window + since_modified)
+        return max(0, now - deep_checked) * weight
+
+    def select(self, candidates, books):
+        """
+        Select which books to deep check now.
+
+        `candidates` is a dict of book → (deep_checked, modified) for the books that can be checked,
+        and `books` is all the books in the directory. Returns a list of books, most overdue first.
+        """
+        with self._lock:
+            now = time.time()
+            rate = self.rate(books)
+            self.credit = min(self.credit + (now - self.last_update) * rate,
+                              max(rate * DeepScanScheduler.max_credit_time, 1))
+            self.last_update = now
+
+            selected = []
+            for book in sorted(candidates, key=lambda book: self.priority(*candidates[book], now=now), reverse=True):
+                if self.credit <= 0:
+                    break
+                self.credit -= self.cost(book)  # may go negative for big books, which is paid back before the next check
+                selected.append(book)
+            return selected
+
+    def charge(self, book):
+        """Charge the budget for a book that is checked outside of the schedule (i.e. it was explicitly requested)"""
+        with self._lock:
+            self.credit -= self.cost(book)
+
+    def status(self, books):
+        """Returns the current rate (stat calls per second) and the estimated time to check all books (seconds)"""
+        with self._lock:
+            rate = self.rate(books)
+            total_cost = self._total_cost(books)
+            return rate, total_cost / rate if rate else float("inf")
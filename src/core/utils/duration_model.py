@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import math
+import os
+import zipfile
+from threading import RLock
+
+from core.config import Config
+
+
+class DurationModel():
+    """
+    Persistent model of how long it takes for a pipeline to handle a book.
+
+    For each stage ("total" is the whole book), we keep an exponentially weighted
+    moving average (EWMA) of the duration, as well as a bounded list of recent samples
+    with the size and number of files of the book. Predictions are the quantile of the
+    durations of the samples closest to the book in (log size, log file count), so that
+    a large EPUB is compared with other large EPUBs.
+    """
+
+    alpha = 0.2  # EWMA smoothing factor
+    max_samples = 200  # per stage
+    neighbours = 7  # number of similar books to base a prediction on
+
+    _models = {}
+    _static_lock = RLock()
+
+    uid = None
+    default_duration = None
+    path = None
+    stages = None
+    _lock = None
+
+    def __init__(self, uid, default_duration=60, path=None):
+        self.uid = uid
+        self.default_duration = default_duration
+        self.path = path if path else os.path.join(Config.get_cache_dir(), "durations.{}.json".format(uid))
+        self.stages = {}
+        self._lock = RLock()
+        self.load()
+
+    @staticmethod
+    def get(uid, default_duration=60):
+        """Get the (shared) duration model for the pipeline with the given uid"""
+        with DurationModel._static_lock:
+            if uid not in DurationModel._models:
+                DurationModel._models[uid] = DurationModel(uid, default_duration=default_duration)
+            return DurationModel._models[uid]
+
+    def load(self):
+        with self._lock:
+            if not os.path.isfile(self.path):
+                return
+            try:
+                with open(self.path, "r") as f:
+                    self.stages = json.load(f).get("stages", {})
+            except Exception:
+                logging.exception("Could not load duration model: {}".format(self.path))
+                self.stages = {}
+
+    def save(self):
+        with self._lock:
+            try:
+                temp_path = self.path + ".tmp"
+                with open(temp_path, "w") as f:
+                    json.dump({"uid": self.uid, "stages": self.stages}, f)
+                os.replace(temp_path, self.path)
+            except Exception:
+                logging.exception("Could not store duration model: {}".format(self.path))
+
+    def record(self, duration, size=None, files=None, stage="total", save=True):
+        """Record the duration of `stage` for a book. Use `save=False` when recording several stages, and call `save()` afterwards."""
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = {"ewma": duration, "count": 0, "samples": []}
+            model = self.stages[stage]
+            model["ewma"] = DurationModel.alpha * duration + (1 - DurationModel.alpha) * model["ewma"]
+            model["count"] += 1
+            model["samples"].append([duration, size, files])
+            model["samples"] = model["samples"][-DurationModel.max_samples:]
+            if save:
+                self.save()
+
+    def predict(self, size=None, files=None, stage="total", quantile=0.5):
+        """Predict the duration (in seconds) of `stage` for a book with the given size and file count"""
+        with self._lock:
+            model = self.stages.get(stage)
+            if not model or not model["samples"]:
+                return self.default_duration if stage == "total" else None
+
+            samples = model["samples"]
+            if len(samples) < DurationModel.neighbours:
+                # too few samples for meaningful quantiles of similar books
+                return model["ewma"] if quantile == 0.5 else DurationModel.quantile([s[0] for s in samples], quantile)
+
+            if size is not None:
+                comparable = [s for s in samples if s[1] is not None]
+                if len(comparable) >= DurationModel.neighbours:
+                    def distance(sample):
+                        d = (math.log1p(sample[1]) - math.log1p(size)) ** 2
+                        if files is not None and sample[2] is not None:
+                            d += (math.log1p(sample[2]) - math.log1p(files)) ** 2
+                        return d
+                    samples = sorted(comparable, key=distance)[:DurationModel.neighbours]
+
+            return DurationModel.quantile([s[0] for s in samples], quantile)
+
+    def summary(self):
+        with self._lock:
+            result = {}
+            for stage in self.stages:
+                durations = [s[0] for s in self.stages[stage]["samples"]]
+                result[stage] = {
+                    "count": self.stages[stage]["count"],
+                    "ewma": self.stages[stage]["ewma"],
+                    "p50": DurationModel.quantile(durations, 0.5),
+                    "p90": DurationModel.quantile(durations, 0.9),
+                }
+            return result
+
+    @staticmethod
+    def quantile(values, q):
+        if not values:
+            return None
+        values = sorted(values)
+        position = (len(values) - 1) * q
+        lower = math.floor(position)
+        upper = math.ceil(position)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    @staticmethod
+    def book_features(path):
+        """Returns the size (in bytes) and number of files of the book at `path`, as a tuple"""
+        if not path or not os.path.exists(path):
+            return None, None
+
+        try:
+            if os.path.isfile(path):
+                files = 1
+                if zipfile.is_zipfile(path):
+                    with zipfile.ZipFile(path) as archive:
+                        files = len(archive.namelist())
+                return os.path.getsize(path), files
+
+            size = 0
+            files = 0
+            for dirPath, subdirList, fileList in os.walk(path):
+                for f in fileList:
+                    try:
+                        size += os.path.getsize(os.path.join(dirPath, f))
+                        files += 1
+                    except OSError:
+                        pass  # the file may have been deleted while we were iterating
+            return size, files
+
+        except Exception:
+            logging.exception("Could not determine size of book: {}".format(path))
+            return None, None
@@ -1,21 +1,34 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import ctypes
+import fnmatch
 import hashlib
 import logging
 import os
 import re
 import requests
+import selectors
 import shutil
 import socket
 import subprocess
 import tempfile
-import threading
 import time
 import traceback
 import urllib.parse
 import urllib.request
+import uuid
 import zipfile
+from collections import OrderedDict
 from pathlib import Path
+from stat import S_ISDIR, S_ISREG
+from threading import RLock
+
+import psutil
+
+from core.utils.copy_engine import CopyEngine
+from core.utils.process_output import ProcessOutput
+from core.utils.trace import Trace
 
 
 class Filesystem():
@@ -23,34 +36,106 @@ class Filesystem():
 
     pipeline = None
     last_reported_md5 = None  # avoid reporting change for same book multiple times
+    empty_md5 = "d41d8cd98f00b204e9800998ecf8427e"  # MD5 of an empty string
     hosts = {}  # hosts cache
-
-    shutil_ignore_patterns = shutil.ignore_patterns(  # supports globs: shutil.ignore_patterns('*.pyc', 'tmp*')
+    mounts = None  # /proc/mounts cache: { "/mount/point": ("device", "fstype") }
+    mounts_last_updated = 0
+    network_filesystems = ["nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs", "fuse.gvfsd-fuse"]
+    local_ip = None
+    local_ip_last_updated = 0
+    content_hash_chunk_size = 1024 * 1024  # bytes read at a time when hashing file contents
+    content_hash_cache_size = 10000  # max. number of cached content checksums
+    _content_hash_cache = OrderedDict()  # { (path, algorithm, size, mtime_ns, inode): checksum }
+    _content_hash_lock = RLock()
+    store_delta = os.getenv("STORE_BOOK_DELTA", "true").lower() == "true"  # only copy the files that have changed when storing books
+    staging_max_age = int(os.getenv("STORE_BOOK_STAGING_MAX_AGE", 6 * 60 * 60))  # seconds before a staged copy is considered abandoned
+    _libc = None
+
+    ignore_patterns = [  # files and directories that are ignored everywhere (supports globs, like shutil.ignore_patterns)
         "Thumbs.db", "*.swp", "ehthumbs.db", "ehthumbs_vista.db", "*.stackdump", "Desktop.ini", "desktop.ini",
         "$RECYCLE.BIN", "*~", ".fuse_hidden*", ".directory", ".Trash-*", ".nfs*", ".DS_Store", ".AppleDouble",
         ".LSOverride", "._*", ".DocumentRevisions-V100", ".fseventsd", ".Spotlight-V100", ".TemporaryItems",
         ".Trashes", ".VolumeIcon.icns", ".com.apple.timemachine.donotpresent", ".AppleDB", ".AppleDesktop",
         "Network Trash Folder", "Temporary Items", ".apdisk", "Dolphin check log.txt", "*dirmodified", "dds-temp",
         "*.crdownload"
-    )
+    ]
+    _ignore_regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in ignore_patterns))  # all patterns, compiled once
 
     def __init__(self, pipeline):
         self.pipeline = pipeline
 
     @staticmethod
     def file_content_md5(path):
-        if not os.path.isfile(path):
-            return "d41d8cd98f00b204e9800998ecf8427e"  # MD5 of an empty string
+        return Filesystem.file_content_hash(path, algorithm="md5")
 
-        return hashlib.md5(open(path, 'rb').read()).hexdigest()
+    @staticmethod
+    def file_content_hash(path, algorithm="md5"):
+        """
+        Returns a checksum of the contents of a file, using the given algorithm (any algorithm supported by
+        hashlib, i.e. "md5" for compatibility, or "blake2b" which is faster on 64-bit systems).
+
+        The file is read in chunks, so that big files (i.e. audio books) are never read into memory.
+        Results are cached by path, size, modification time and inode, so unchanged files are only read once.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if stat is None or not S_ISREG(stat.st_mode):
+            return hashlib.new(algorithm).hexdigest()  # checksum of an empty string
+
+        key = (path, algorithm, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        with Filesystem._content_hash_lock:
+            if key in Filesystem._content_hash_cache:
+                Filesystem._content_hash_cache.move_to_end(key)
+                return Filesystem._content_hash_cache[key]
+
+        digest = hashlib.new(algorithm)
+        buffer = bytearray(Filesystem.content_hash_chunk_size)
+        view = memoryview(buffer)
+        with open(path, "rb") as f:
+            while True:
+                length = f.readinto(buffer)
+                if not length:
+                    break
+                digest.update(view[:length])
+        digest = digest.hexdigest()
+
+        after = os.stat(path)
+        if (after.st_size, after.st_mtime_ns, after.st_ino) == key[2:]:  # don't cache files that were modified while reading
+            with Filesystem._content_hash_lock:
+                Filesystem._content_hash_cache[key] = digest
+                while len(Filesystem._content_hash_cache) > Filesystem.content_hash_cache_size:
+                    Filesystem._content_hash_cache.popitem(last=False)
+
+        return digest
+
+    @staticmethod
+    def is_ignored(name):
+        """Whether a file or directory with the given name should be ignored (see ignore_patterns)"""
+        return Filesystem._ignore_regex.match(name) is not None
+
+    @staticmethod
+    def ignored_names(dir, names):
+        """Returns the names that should be ignored. Can be used as the `ignore` argument to shutil.copytree."""
+        return set(name for name in names if Filesystem._ignore_regex.match(name))
 
     @staticmethod
     def should_ignore(path):
-        return bool(Filesystem.shutil_ignore_patterns(os.path.dirname(path), [os.path.basename(path)]))
+        return Filesystem.is_ignored(os.path.basename(path))
 
     @staticmethod
     def path_md5(path, shallow, expect=None):
-        attributes = []
+        """
+        Returns a checksum of the files in `path`, and the time of the last modification.
+
+        With shallow=True, only the first file in each directory is included.
+
+        The attributes are streamed into the hash while walking the directory with os.scandir,
+        so that the stat results from scandir can be reused and no big list or string has to be built.
+        The checksums are the same as before (absolute paths, the MD5 of str() of a list of all the
+        attributes), so that stored checksums remain valid.
+        """
 
         # In addition to the path, we use these stat attributes:
         # st_mode: File mode: file type and file mode bits (permissions).
@@ -58,70 +143,190 @@ class Filesystem():
         #          The size of a symbolic link is the length of the pathname it contains, without a terminating null byte.
         # st_mtime: Time of most recent content modification expressed in seconds.
 
+        md5 = hashlib.md5()
+        count = 0
         modified = 0
-        if not os.path.exists(path):
-            md5 = "d41d8cd98f00b204e9800998ecf8427e"  # MD5 of an empty string
-
-        else:
-            if os.path.isfile(path) and not Filesystem.should_ignore(path):
-                stat = os.stat(path)
-                st_size = stat.st_size if os.path.isfile(path) else 0
-                st_mtime = round(stat.st_mtime)
-                attributes.extend([path, st_mtime, st_size, stat.st_mode])
-                modified = stat.st_mtime
-
-            if not shallow or not modified:
+        preview = []  # the start of what is hashed, for logging
+
+        def add(file_path, st_mtime, st_size, st_mode):
+            nonlocal count
+            chunk = ("[" if not count else ", ") + "{!r}, {!r}, {!r}, {!r}".format(file_path, st_mtime, st_size, st_mode)
+            md5.update(chunk.encode())
+            if count < 10:
+                preview.append(chunk)
+            count += 1
+
+        def walk(dir_path):
+            # the same order as os.walk: the files in each directory, and then each subdirectory, sorted by name
+            nonlocal modified
+            files = []
+            subdirs = []
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        (subdirs if is_dir else files).append(entry)
+            except OSError:
+                return  # i.e. deleted while walking (os.walk skips these as well)
+
+            for entry in sorted(files, key=lambda entry: entry.name):
+                if Filesystem.is_ignored(entry.name):
+                    continue  # skip ignored files
                 try:
-                    for dirPath, subdirList, fileList in os.walk(path):
-                        fileList.sort()
-                        subdirList.sort()
-                        ignore = Filesystem.shutil_ignore_patterns(dirPath, fileList + subdirList)
-                        for s in reversed(range(len(subdirList))):
-                            if subdirList[s] in ignore:
-                                del subdirList[s]  # remove ignored folders in-place
-                        for f in fileList:
-                            if f in ignore:
-                                continue  # skip ignored files
-                            filePath = os.path.join(dirPath, f)
-                            stat = None
-
-                            # try handling FileNotFoundError: [Errno 2] No such file or directory
-                            stat_retries = 3
-                            while stat_retries > 0:
-                                try:
-                                    stat_retries -= 1
-                                    stat = os.stat(filePath)
-                                except FileNotFoundError as e:
-                                    if stat_retries >= 0:
-                                        logging.warning("Filen eller mappen ble ikke funnet ({}). Prøver igjen…".format(f))
-                                        # time.sleep(1)
-                                    else:
-                                        raise e
-
-                            if stat is not None:
-                                attributes.extend([filePath, round(stat.st_mtime), stat.st_size, stat.st_mode])
-                            else:
-                                attributes.extend([filePath, 0, 0, 0])
-                            modified = max(modified, stat.st_mtime if stat is not None else 0)
-                            if shallow:
-                                break
-                except FileNotFoundError as e:
-                    logging.exception("Filen eller mappen ble ikke funnet. Kanskje noen slettet den?")
-                    raise e
+                    file_stat = entry.stat()  # cached by scandir when possible
+                    add(entry.path, round(file_stat.st_mtime), file_stat.st_size, file_stat.st_mode)
+                    modified = max(modified, file_stat.st_mtime)
+                except FileNotFoundError:
+                    add(entry.path, 0, 0, 0)  # deleted while walking
+                if shallow:
+                    break
 
-            if attributes:
-                md5 = hashlib.md5(str(attributes).encode()).hexdigest()
-            else:
-                md5 = "d41d8cd98f00b204e9800998ecf8427e"  # MD5 of an empty string
+            for entry in sorted(subdirs, key=lambda entry: entry.name):
+                if not Filesystem.is_ignored(entry.name) and not entry.is_symlink():  # symlinks are not followed, like in os.walk
+                    walk(entry.path)
+
+        try:
+            root_stat = os.stat(path)
+        except OSError:
+            root_stat = None
+
+        if root_stat is not None:
+            if S_ISREG(root_stat.st_mode) and not Filesystem.should_ignore(path):
+                add(path, round(root_stat.st_mtime), root_stat.st_size, root_stat.st_mode)
+                modified = root_stat.st_mtime
+
+            if (not shallow or not modified) and S_ISDIR(root_stat.st_mode):
+                walk(path)
+
+        if count:
+            md5.update("]".encode())
+        md5 = md5.hexdigest() if count else Filesystem.empty_md5
 
         if expect and expect != md5 and md5 != Filesystem.last_reported_md5:
             Filesystem.last_reported_md5 = md5
-            text = "MD5 changed for " + str(path) + " (was: {}, is: {}): ".format(expect, md5)
-            logging.info(text + str(attributes)[:1000] + ("…" if len(str(attributes)) > 1000 else ""))
-            logging.debug(text + str(attributes))
+            text = "MD5 changed for " + str(path) + " (was: {}, is: {}, {} files): ".format(expect, md5, count)
+            logging.info(text + "".join(preview)[:1000] + ("…" if count > len(preview) else ""))
 
         return md5, modified
 
+    @staticmethod
+    def path_tree_md5(path, tree=None, prune=True, max_age=24 * 60 * 60, expect=None):
+        """
+        Returns a shallow and a deep checksum for the book at `path` from a single walk, as well as the
+        time of the last modification and a tree that can be passed to the next call.
+
+        The tree is a Merkle-style tree with the mtime and a digest of the files in each directory.
+        With prune=True, the files in a directory are only statted again if the mtime of the directory
+        has changed (i.e. files have been added, removed or renamed), or if they have not been statted
+        for `max_age` seconds (as files that are modified in place do not change the mtime of the directory).
+        Every directory is still statted, so the cost is proportional to the number of directories
+        rather than the number of files.
+
+        The checksums use relative paths, and are not compatible with path_md5.
+        """
+        if not os.path.exists(path):
+            return Filesystem.empty_md5, Filesystem.empty_md5, 0, None
+
+        if not os.path.isdir(path):
+            stat = os.stat(path)
+            attributes = [os.path.basename(path), round(stat.st_mtime), stat.st_size, stat.st_mode]
+            md5 = hashlib.md5(str(attributes).encode()).hexdigest() if not Filesystem.should_ignore(path) else Filesystem.empty_md5
+            return md5, md5, stat.st_mtime, None
+
+        tree = Filesystem._walk_tree(path, tree, prune, max_age)
+        if tree is None:
+            return Filesystem.empty_md5, Filesystem.empty_md5, 0, None  # deleted while walking
+        shallow_md5, deep_md5, modified = Filesystem._tree_digests(tree)
+
+        if expect and expect != deep_md5 and deep_md5 != Filesystem.last_reported_md5:
+            Filesystem.last_reported_md5 = deep_md5
+            logging.info("MD5 changed for {} (was: {}, is: {})".format(path, expect, deep_md5))
+
+        return shallow_md5, deep_md5, modified, tree
+
+    @staticmethod
+    def _walk_tree(dir_path, node, prune, max_age):
+        try:
+            stat = os.stat(dir_path)
+        except FileNotFoundError:
+            return None  # deleted while walking
+
+        if prune and node and node["mtime"] == stat.st_mtime_ns and time.time() - node["checked"] < max_age:
+            # nothing has been added, removed or renamed in this directory: only visit the subdirectories
+            node = dict(node)
+            subdirs = sorted(node["dirs"])
+
+        else:
+            files = []
+            subdirs = []
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif not entry.is_dir():
+                            files.append(entry.name)
+            except FileNotFoundError:
+                return None  # deleted while walking
+
+            files = sorted(f for f in files if not Filesystem.is_ignored(f))
+            subdirs = sorted(d for d in subdirs if not Filesystem.is_ignored(d))
+
+            attributes = []
+            modified = 0
+            for f in files:
+                try:
+                    file_stat = os.stat(os.path.join(dir_path, f))
+                    attributes.append([f, round(file_stat.st_mtime), file_stat.st_size, file_stat.st_mode])
+                    modified = max(modified, file_stat.st_mtime)
+                except FileNotFoundError:
+                    attributes.append([f, 0, 0, 0])  # deleted while walking
+
+            node = {
+                "mtime": stat.st_mtime_ns,
+                "checked": time.time(),
+                "files": hashlib.md5(str(attributes).encode()).hexdigest() if attributes else "",
+                "first": hashlib.md5(str(attributes[0]).encode()).hexdigest() if attributes else "",
+                "count": len(attributes),
+                "modified": modified,
+                "dirs": (node or {}).get("dirs", {}),
+            }
+
+        children = {}
+        for name in subdirs:
+            child = Filesystem._walk_tree(os.path.join(dir_path, name), node["dirs"].get(name), prune, max_age)
+            if child is not None:
+                children[name] = child
+        node["dirs"] = children
+        return node
+
+    @staticmethod
+    def tree_size(tree):
+        """Number of files and directories in a tree from path_tree_md5 (i.e. the number of stat calls needed for a full walk)"""
+        if tree is None:
+            return 1  # the book is a single file
+        return 1 + tree.get("count", 0) + sum(Filesystem.tree_size(child) for child in tree["dirs"].values())
+
+    @staticmethod
+    def _tree_digests(node):
+        # Combine the digests of a directory and its subdirectories. Returns (shallow, deep, modified).
+        shallow = [node["first"]]
+        deep = [node["files"]]
+        modified = node["modified"]
+        for name in sorted(node["dirs"]):
+            child_shallow, child_deep, child_modified = Filesystem._tree_digests(node["dirs"][name])
+            shallow.append(name + ":" + child_shallow)
+            deep.append(name + ":" + child_deep)
+            modified = max(modified, child_modified)
+        if not node["files"] and not node["dirs"]:
+            return Filesystem.empty_md5, Filesystem.empty_md5, modified  # empty directory
+        return (hashlib.md5("/".join(shallow).encode()).hexdigest(),
+                hashlib.md5("/".join(deep).encode()).hexdigest(),
+                modified)
+
     @staticmethod
     def touch(path):
         """ Touch a file, or the first file in a directory """
@@ -143,12 +348,9 @@ class Filesystem():
                 for dirPath, subdirList, fileList in os.walk(path):
                     fileList.sort()
                     subdirList.sort()
-                    ignore = Filesystem.shutil_ignore_patterns(dirPath, fileList + subdirList)
-                    for s in reversed(range(len(subdirList))):
-                        if subdirList[s] in ignore:
-                            del subdirList[s]  # remove ignored folders in-place
+                    subdirList[:] = [d for d in subdirList if not Filesystem.is_ignored(d)]  # remove ignored folders in-place
                     for f in fileList:
-                        if f in ignore:
+                        if Filesystem.is_ignored(f):
                             continue  # skip ignored files
                         filePath = os.path.join(dirPath, f)
                         Path(filePath).touch()
@@ -162,20 +364,26 @@ class Filesystem():
             raise e
 
     @staticmethod
-    def copytree(report, src, dst):
+    def copytree(report, src, dst, file_mode=None, dir_mode=None, hardlink=None, previous=None):
+        """
+        Copy (or merge) the directory `src` into `dst`. Permissions are set while copying if file_mode/dir_mode are given.
+
+        If `dst` does not exist and `previous` is a previous copy of `src`, unchanged files are reused from there.
+        """
         assert os.path.isdir(src)
+        options = {"file_mode": file_mode, "dir_mode": dir_mode, "hardlink": hardlink}
 
         # check if ancestor directory should be ignored
         src_parts = os.path.abspath(src).split("/")
-        for i in range(1, len(src_parts)):
-            ignore = Filesystem.shutil_ignore_patterns("/" + "/".join(src_parts[1:i]), [src_parts[i]])
-            if ignore:
+        for part in src_parts[1:]:
+            if Filesystem.is_ignored(part):
                 return dst
 
         # use shutil.copytree if the target does not exist yet (no need to merge copy)
         if not os.path.exists(dst):
             try:
-                return shutil.copytree(src, dst, ignore=Filesystem.shutil_ignore_patterns)
+                return CopyEngine.copytree(src, dst, ignore=Filesystem.ignored_names, previous=previous,
+                                           unchanged=Filesystem.is_unchanged_file if previous else None, **options)
             except shutil.Error:
                 short_src = os.path.sep.join(src.split(os.path.sep)[:3]) + os.path.sep + "…"
                 short_dst = os.path.sep.join(dst.split(os.path.sep)[:3]) + os.path.sep + "…"
@@ -185,7 +393,7 @@ class Filesystem():
         dst_list = os.listdir(dst)
         src_list.sort()
         dst_list.sort()
-        ignore = Filesystem.shutil_ignore_patterns(src, src_list)
+        ignore = Filesystem.ignored_names(src, src_list)
 
         for item in src_list:
             src_subpath = os.path.join(src, item)
@@ -194,23 +402,23 @@ class Filesystem():
                 if os.path.isdir(src_subpath):
                     if item not in dst_list:
                         try:
-                            shutil.copytree(src_subpath, dst_subpath, ignore=Filesystem.shutil_ignore_patterns)
+                            CopyEngine.copytree(src_subpath, dst_subpath, ignore=Filesystem.ignored_names, **options)
                         except shutil.Error:
                             short_src = os.path.sep.join(src.split(os.path.sep)[:3]) + os.path.sep + "…"
                             short_dst = os.path.sep.join(dst.split(os.path.sep)[:3]) + os.path.sep + "…"
                             raise Exception("An error occured while copying from {} to {}".format(short_src, short_dst))
 
                     else:
-                        Filesystem.copytree(report, src_subpath, dst_subpath)
+                        Filesystem.copytree(report, src_subpath, dst_subpath, **options)
                 else:
                     # Report files that have changed but where the target could not be overwritten
                     if os.path.exists(dst_subpath):
-                        src_md5 = Filesystem.path_md5(src_subpath, shallow=False)
-                        dst_md5 = Filesystem.path_md5(dst_subpath, shallow=False)
-                        if src_md5 != dst_md5:
+                        src_stat = os.stat(src_subpath)
+                        dst_stat = os.stat(dst_subpath)
+                        if (src_stat.st_size, round(src_stat.st_mtime)) != (dst_stat.st_size, round(dst_stat.st_mtime)):
                             report.error("Klarte ikke å erstatte filen med nyere versjon: " + dst_subpath)
                     else:
-                        shutil.copy(src_subpath, dst_subpath)
+                        CopyEngine.copy_file(src_subpath, dst_subpath, file_mode=file_mode, preserve_times=False, hardlink=hardlink)
 
         # Report files and folders that could not be removed and were not supposed to be replaced
         for item in dst_list:
@@ -227,8 +435,14 @@ class Filesystem():
         return dst
 
     @staticmethod
-    def copy(report, source, destination):
-        """Copy the `source` file or directory to the `destination`"""
+    def copy(report, source, destination, file_mode=None, dir_mode=None, hardlink=None, previous=None):
+        """
+        Copy the `source` file or directory to the `destination`.
+
+        If file_mode/dir_mode are given, the permissions are set while copying. If hardlink is True,
+        files are hardlinked when possible (see CopyEngine). If `previous` is a previous copy of `source`,
+        files that are unchanged are reused from there instead of copied from `source`.
+        """
         assert source, "Filesystem.copy(): source must be specified"
         assert destination, "Filesystem.copy(): destination must be specified"
         assert os.path.isdir(source) or os.path.isfile(source), "Filesystem.copy(): source must be either a file or a directory: " + str(source)
@@ -248,7 +462,7 @@ class Filesystem():
                             os.path.dirname(destination))
                         )
                     shutil.rmtree(destination, ignore_errors=True)
-                Filesystem.copytree(report, source, destination)
+                Filesystem.copytree(report, source, destination, file_mode=file_mode, dir_mode=dir_mode, hardlink=hardlink, previous=previous)
             except shutil.Error as errors:
                 warnings = []
                 for arg in errors.args[0]:
@@ -264,7 +478,8 @@ class Filesystem():
                 if None in warnings:
                     raise
         else:
-            shutil.copy(source, destination)
+            CopyEngine.copy_or_reuse(source, destination, previous, file_mode=file_mode, preserve_times=False, hardlink=hardlink,
+                                     unchanged=Filesystem.is_unchanged_file)
 
         if len(files_source) >= 2:
             files_dir_out = os.listdir(destination)
@@ -275,8 +490,16 @@ class Filesystem():
         elif os.path.isfile(source) and not os.path.isfile(destination):
             report.warn("WARNING: Det ser ut som det mangler noen filer som ble kopiert av Filesystem.copy(): " + str(source))
 
-    def storeBook(self, source, book_id, overwrite=True, move=False, parentdir=None, dir_out=None, file_extension=None, subdir=None, fix_permissions=True):
-        """Store `book_id` from `source` into `pipeline.dir_out`"""
+    @Trace.traced("store_book")
+    def storeBook(self, source, book_id, overwrite=True, move=False, parentdir=None, dir_out=None, file_extension=None, subdir=None, fix_permissions=True,
+                  delta=None):
+        """
+        Store `book_id` from `source` into `pipeline.dir_out`
+
+        The book is first stored next to the target, and then renamed into place, so that the stored
+        book is never missing or partially written. With delta=True (the default, see STORE_BOOK_DELTA),
+        files that are unchanged since the book was last stored are reused instead of copied again.
+        """
         assert book_id
         assert book_id.strip()
         assert book_id != "."
@@ -306,32 +529,44 @@ class Filesystem():
             target = target + "/" + subdir
         if os.path.isfile(source) and file_extension:
             target += "." + str(file_extension)
+        previous = None
         if os.path.exists(target):
             if overwrite is True:
-                self.pipeline.utils.report.info("{} finnes i {} fra før. Eksisterende kopi blir slettet.".format(book_id, dir_nicename))
-                try:
-                    if os.path.isdir(target):
-                        shutil.rmtree(target)
-                    else:
-                        os.remove(target)
-                except (OSError, NotADirectoryError):
-                    self.pipeline.utils.report.error(
-                        "En feil oppstod ved sletting av mappen {}. Kanskje noen har en fil eller mappe åpen på datamaskinen sin?".format(target)
-                    )
-                    self.pipeline.utils.report.debug(traceback.format_exc(), preformatted=True)
-                    raise
+                self.pipeline.utils.report.info("{} finnes i {} fra før. Eksisterende kopi blir erstattet.".format(book_id, dir_nicename))
+                previous = target if (Filesystem.store_delta if delta is None else delta) else None
             else:
                 self.pipeline.utils.report.warn("{} finnes fra før i {} og skal ikke overskrives.".format(book_id, dir_nicename))
                 return target, False
-        if move:
-            shutil.move(source, target)
-        else:
-            Filesystem.copy(self.pipeline.utils.report, source, target)
 
-        Filesystem.touch(target)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        Filesystem.remove_stale_staged(target)
+        staged = Filesystem.staging_path(target, "new")
+        try:
+            if move:
+                shutil.move(source, staged)
+            elif fix_permissions:
+                Filesystem.copy(self.pipeline.utils.report, source, staged, file_mode=0o664, dir_mode=0o777, previous=previous)  # the same permissions as fix_permissions
+            else:
+                Filesystem.copy(self.pipeline.utils.report, source, staged, previous=previous)
 
-        if fix_permissions:
-            Filesystem.fix_permissions(target)
+            if fix_permissions and move:
+                Filesystem.fix_permissions(staged)
+
+        except Exception:
+            Filesystem._remove_staged(staged)
+            raise
+
+        try:
+            Filesystem.publish(staged, target)
+        except OSError:
+            Filesystem._remove_staged(staged)
+            self.pipeline.utils.report.error(
+                "En feil oppstod ved erstatting av {}. Kanskje noen har en fil eller mappe åpen på datamaskinen sin?".format(target)
+            )
+            self.pipeline.utils.report.debug(traceback.format_exc(), preformatted=True)
+            raise
+
+        Filesystem.touch(target)
 
         self.pipeline.utils.report.info("{} ble lagt til i {}.".format(book_id, dir_nicename))
 
@@ -349,6 +584,110 @@ class Filesystem():
 
         return target, True
 
+    @staticmethod
+    def staging_path(target, kind):
+        """A temporary path next to `target` (i.e. on the same filesystem). The name is hidden, so it's never listed as a book."""
+        return os.path.join(os.path.dirname(target), ".{}.{}-{}".format(os.path.basename(target), kind, uuid.uuid4().hex[:8]))
+
+    @staticmethod
+    def remove_stale_staged(target):
+        """
+        Delete staged copies of `target` (see staging_path) that are left over from earlier attempts,
+        i.e. if the system stopped while a book was being stored. Only copies that have not been
+        modified for staging_max_age seconds are deleted, so that copies in progress are left alone.
+        """
+        directory = os.path.dirname(target)
+        pattern = re.compile(r"^\.{}\.(new|old)-[0-9a-f]{{8}}$".format(re.escape(os.path.basename(target))))
+        try:
+            names = [name for name in os.listdir(directory) if pattern.match(name)]
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if time.time() - os.lstat(path).st_mtime < Filesystem.staging_max_age:
+                    continue
+            except OSError:
+                continue  # deleted in the meantime
+            logging.info("Deleting abandoned staged copy: {}".format(path))
+            Filesystem._remove_staged(path)
+
+    @staticmethod
+    def publish(staged, target):
+        """
+        Replace `target` with `staged`, which must be on the same filesystem (see staging_path).
+
+        The two are swapped atomically with renameat2(RENAME_EXCHANGE) where the filesystem supports it,
+        and files are replaced atomically with os.replace. Otherwise, the target is first renamed out of
+        the way, so that the target is missing for a moment, but it's never partially written.
+        The previous version is deleted afterwards.
+        """
+        if not os.path.lexists(target):
+            os.rename(staged, target)
+            return
+
+        if not os.path.isdir(staged) and not os.path.isdir(target):
+            if os.path.samefile(staged, target):
+                os.remove(staged)  # the file was unchanged and reused (rename does nothing when both are links to the same file)
+            else:
+                os.replace(staged, target)
+            return
+
+        if Filesystem._rename_exchange(staged, target):
+            old = staged  # now contains the previous version
+        else:
+            old = Filesystem.staging_path(target, "old")
+            os.rename(target, old)
+            try:
+                os.rename(staged, target)
+            except OSError:
+                os.rename(old, target)
+                raise
+
+        Filesystem._remove_staged(old)
+
+    @staticmethod
+    def _remove_staged(staged):
+        try:
+            if os.path.isdir(staged) and not os.path.islink(staged):
+                shutil.rmtree(staged)
+            elif os.path.lexists(staged):
+                os.remove(staged)
+        except OSError:
+            logging.exception("Could not delete: {}".format(staged))
+
+    @staticmethod
+    def _rename_exchange(path_a, path_b):
+        # atomically swap two paths with renameat2 (Linux 3.15+, glibc 2.28+). Returns False if not supported.
+        try:
+            if Filesystem._libc is None:
+                Filesystem._libc = ctypes.CDLL(None, use_errno=True)
+            renameat2 = Filesystem._libc.renameat2
+        except (OSError, AttributeError):
+            return False
+
+        AT_FDCWD = -100
+        RENAME_EXCHANGE = 2
+        if renameat2(AT_FDCWD, os.fsencode(path_a), AT_FDCWD, os.fsencode(path_b), RENAME_EXCHANGE) == 0:
+            return True
+        error = ctypes.get_errno()
+        logging.debug("Could not swap {} and {} atomically: {}".format(path_a, path_b, os.strerror(error)))
+        return False
+
+    @staticmethod
+    def is_unchanged_file(path, previous):
+        """Whether `previous` is an unchanged copy of the file `path` (same size, and same modification time or contents)"""
+        try:
+            path_stat = os.stat(path)
+            previous_stat = os.stat(previous)
+        except OSError:
+            return False
+        if not S_ISREG(previous_stat.st_mode) or path_stat.st_size != previous_stat.st_size:
+            return False
+        if round(path_stat.st_mtime) == round(previous_stat.st_mtime):
+            return True
+        return Filesystem.file_content_hash(path, algorithm="blake2b") == Filesystem.file_content_hash(previous, algorithm="blake2b")
+
     def deleteSource(self):
         if os.path.isdir(self.pipeline.book["source"]):
             shutil.rmtree(self.pipeline.book["source"])
@@ -406,13 +745,68 @@ class Filesystem():
                    check=True,
                    stdout_level="DEBUG",
                    stderr_level="DEBUG"):
-        """Convenience method for subprocess.run, with our own defaults"""
+        """
+        Convenience method for subprocess.run, with our own defaults
+
+        The output is read while the process is running, and passed on to the report line by line
+        (see ProcessOutput). The returned CompletedProcess has the output as bytes in `stdout` and `stderr`,
+        as with subprocess.run, but if the output is very long, only the start and the end is kept
+        (the full output is then in the files `stdout_spill`/`stderr_spill`, in the report directory of the book).
+
+        The process (including its child processes) is killed if the pipeline is cancelled while the process is running.
+        """
 
         (report if report else logging).debug("Kjører: "+(" ".join(args) if isinstance(args, list) else args))
 
+        outputs = {}
         completedProcess = None
         try:
-            completedProcess = subprocess.run(args, stdout=stdout, stderr=stderr, shell=shell, cwd=cwd, timeout=timeout, check=check)
+            with subprocess.Popen(args, stdout=stdout, stderr=stderr, shell=shell, cwd=cwd) as process:
+                with selectors.DefaultSelector() as selector:
+                    for stream, name, level in [(process.stdout, "stdout", stdout_level), (process.stderr, "stderr", stderr_level)]:
+                        if stream is not None:
+                            outputs[name] = ProcessOutput(name, report, level)
+                            selector.register(stream, selectors.EVENT_READ, outputs[name])
+
+                    start = time.time()
+                    cancelled = False
+                    timed_out = False
+                    while selector.get_map():
+                        for key, _ in selector.select(timeout=1):
+                            data = os.read(key.fd, 64 * 1024)
+                            if data:
+                                key.data.feed(data)
+                            else:
+                                selector.unregister(key.fileobj)
+
+                        cancelled = Filesystem.is_cancelled(report)
+                        timed_out = timeout is not None and time.time() - start > timeout
+                        if cancelled or timed_out:
+                            Filesystem.kill_process_tree(process)
+                            break
+
+                    # the process may close (or redirect) its output and keep running
+                    while not cancelled and not timed_out:
+                        try:
+                            process.wait(timeout=1)
+                            break
+                        except subprocess.TimeoutExpired:
+                            cancelled = Filesystem.is_cancelled(report)
+                            timed_out = timeout is not None and time.time() - start > timeout
+                            if cancelled or timed_out:
+                                Filesystem.kill_process_tree(process)
+
+                    process.wait()
+
+            out, err = Filesystem._close_outputs(process, outputs)
+            if timed_out:
+                raise subprocess.TimeoutExpired(process.args, timeout, output=out, stderr=err)
+            if cancelled:
+                (report if report else logging).warning("Behandlingen ble avbrutt, og prosessen ble derfor stoppet.")
+
+            completedProcess = subprocess.CompletedProcess(process.args, process.returncode, out, err)
+            if check and process.returncode and not Filesystem.is_cancelled(report):
+                raise subprocess.CalledProcessError(process.returncode, process.args, output=out, stderr=err)
 
         except subprocess.CalledProcessError as e:
             if report:
@@ -421,21 +815,121 @@ class Filesystem():
                 logging.error("exception occured", exc_info=True)
             completedProcess = e
 
-        (report if report else logging).debug("---- stdout: ----")
-        if report:
-            report.add_message(stdout_level, completedProcess.stdout.decode("utf-8").strip(), add_empty_line_between=True)
-        else:
-            logging.info(completedProcess.stdout.decode("utf-8"))
-        (report if report else logging).debug("-----------------")
-        (report if report else logging).debug("---- stderr: ----")
-        if report:
-            report.add_message(stderr_level, completedProcess.stderr.decode("utf-8").strip(), add_empty_line_between=True)
+        completedProcess.stdout_spill = outputs["stdout"].spill_path if "stdout" in outputs else None
+        completedProcess.stderr_spill = outputs["stderr"].spill_path if "stderr" in outputs else None
+        return completedProcess
+
+    @staticmethod
+    async def run_static_async(args,
+                               cwd,
+                               report=None,
+                               shell=False,
+                               timeout=600,
+                               check=True,
+                               stdout_level="DEBUG",
+                               stderr_level="DEBUG"):
+        """
+        The same as run_static, but as a coroutine, so that many processes can be supervised from one thread (with asyncio).
+
+        stdout and stderr are always captured.
+        """
+
+        (report if report else logging).debug("Kjører: "+(" ".join(args) if isinstance(args, list) else args))
+
+        if shell:
+            process = await asyncio.create_subprocess_shell(args if isinstance(args, str) else " ".join(args), cwd=cwd,
+                                                            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
         else:
-            logging.info(completedProcess.stderr.decode("utf-8"))
-        (report if report else logging).debug("-----------------")
+            process = await asyncio.create_subprocess_exec(*args, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
 
+        outputs = {
+            "stdout": ProcessOutput("stdout", report, stdout_level),
+            "stderr": ProcessOutput("stderr", report, stderr_level),
+        }
+
+        async def read(stream, output):
+            while True:
+                data = await stream.read(64 * 1024)
+                if not data:
+                    break
+                output.feed(data)
+
+        readers = asyncio.gather(read(process.stdout, outputs["stdout"]), read(process.stderr, outputs["stderr"]))
+        start = time.time()
+        cancelled = False
+        timed_out = False
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(readers), timeout=1)
+                break
+            except asyncio.TimeoutError:
+                cancelled = Filesystem.is_cancelled(report)
+                timed_out = timeout is not None and time.time() - start > timeout
+                if cancelled or timed_out:
+                    Filesystem.kill_process_tree(process)
+                    await readers
+                    break
+
+        # the process may close (or redirect) its output and keep running
+        while not cancelled and not timed_out:
+            try:
+                await asyncio.wait_for(process.wait(), timeout=1)
+                break
+            except asyncio.TimeoutError:
+                cancelled = Filesystem.is_cancelled(report)
+                timed_out = timeout is not None and time.time() - start > timeout
+                if cancelled or timed_out:
+                    Filesystem.kill_process_tree(process)
+
+        await process.wait()
+
+        out, err = Filesystem._close_outputs(process, outputs)
+        if timed_out:
+            raise subprocess.TimeoutExpired(args, timeout, output=out, stderr=err)
+        if cancelled:
+            (report if report else logging).warning("Behandlingen ble avbrutt, og prosessen ble derfor stoppet.")
+
+        completedProcess = subprocess.CompletedProcess(args, process.returncode, out, err)
+        if check and process.returncode and not Filesystem.is_cancelled(report):
+            try:
+                raise subprocess.CalledProcessError(process.returncode, args, output=out, stderr=err)
+            except subprocess.CalledProcessError as e:
+                if report:
+                    report.error(traceback.format_exc(), preformatted=True)
+                else:
+                    logging.error("exception occured", exc_info=True)
+                completedProcess = e
+
+        completedProcess.stdout_spill = outputs["stdout"].spill_path
+        completedProcess.stderr_spill = outputs["stderr"].spill_path
         return completedProcess
 
+    @staticmethod
+    def _close_outputs(process, outputs):
+        out = outputs["stdout"].close() if "stdout" in outputs else None
+        err = outputs["stderr"].close() if "stderr" in outputs else None
+        return out, err
+
+    @staticmethod
+    def is_cancelled(report):
+        """Whether the pipeline that `report` belongs to has been cancelled"""
+        pipeline = report.pipeline if report else None
+        return callable(getattr(type(pipeline), "is_cancelled", None)) and pipeline.is_cancelled()
+
+    @staticmethod
+    def kill_process_tree(process):
+        """Kill a process started with subprocess.Popen, as well as all of its child processes"""
+        try:
+            children = psutil.Process(process.pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            children = []
+        for child in children:
+            try:
+                child.kill()
+            except psutil.NoSuchProcess:
+                pass
+        process.kill()
+
     @staticmethod
     def zip(report, directory, file):
         """Zip the contents of `dir`"""
@@ -482,19 +976,17 @@ class Filesystem():
     def getdevice(path):
         path = os.path.normpath(path)
 
-        with open('/proc/mounts', 'r') as f:
-            for line in f.readlines():
-                line = line.split()
-                if line[1] == path:
-                    # line[1] = "/mount/point"
+        mount = Filesystem.get_mounts().get(path)
+        if mount:
+            device, fstype = mount
 
-                    if line[2] == "nfs":
-                        # line[0] = a.b.c:/path/subpath
-                        return "nfs://{}".format(line[0])
+            if fstype == "nfs":
+                # device = a.b.c:/path/subpath
+                return "nfs://{}".format(device)
 
-                    elif line[0].startswith("/") and line[1] == path:
-                        # line[0] = "//x.x.x.x/sharename/optionalsubpath"
-                        return re.sub("^//", "smb://", line[0])
+            elif device.startswith("/"):
+                # device = "//x.x.x.x/sharename/optionalsubpath"
+                return re.sub("^//", "smb://", device)
 
         x_dir = os.getenv("XDG_RUNTIME_DIR")
         if x_dir and os.path.isdir(os.path.join(x_dir, "gvfs")):
@@ -522,10 +1014,7 @@ class Filesystem():
                 smb = smb + path[len(possible_mount_point):]
                 break
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        localhost = s.getsockname()[0]
-        s.close()
+        localhost = Filesystem.get_local_ip()
 
         if smb is None:
             smb = "smb://" + localhost + path
@@ -539,6 +1028,47 @@ class Filesystem():
         unc = re.sub("/", r"\\", re.sub(r"^(smb|nfs):", r"", smb))
         return smb, file, unc
 
+    @staticmethod
+    def get_local_ip():
+        # the IP address of the network interface used for outgoing traffic (cached for an hour)
+        if not Filesystem.local_ip or time.time() - Filesystem.local_ip_last_updated > 3600:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.connect(("8.8.8.8", 80))
+                Filesystem.local_ip = s.getsockname()[0]
+            finally:
+                s.close()
+            Filesystem.local_ip_last_updated = time.time()
+        return Filesystem.local_ip
+
+    @staticmethod
+    def get_mounts():
+        # parsed version of /proc/mounts (cached for a minute)
+        if Filesystem.mounts is None or time.time() - Filesystem.mounts_last_updated > 60:
+            mounts = {}
+            with open('/proc/mounts', 'r') as f:
+                for line in f.readlines():
+                    line = line.split()
+                    # line[0] = device, line[1] = "/mount/point", line[2] = filesystem type
+                    if len(line) >= 3:
+                        mounts[line[1]] = (line[0], line[2])
+            Filesystem.mounts = mounts
+            Filesystem.mounts_last_updated = time.time()
+        return Filesystem.mounts
+
+    @staticmethod
+    def is_network_path(path):
+        """Whether the path is on a network filesystem (where i.e. inotify does not see changes made by other hosts)"""
+        mounts = Filesystem.get_mounts()
+        mount_point = os.path.normpath(path)
+        while True:
+            if mount_point in mounts:
+                return mounts[mount_point][1] in Filesystem.network_filesystems
+            parent = os.path.dirname(mount_point)
+            if parent == mount_point:
+                return False
+            mount_point = parent
+
     @staticmethod
     def get_host_from_url(addr):
         if not Filesystem.hosts:
@@ -578,33 +1108,26 @@ class Filesystem():
                     combined.append(os.path.join(subdir, filename))
             return combined
 
-        dirlist = os.listdir(dir)
-
-        if threading.current_thread().getName().endswith("event in nlbpub") and dir.endswith("master/NLBPUB/"):  # debugging strange bug
-            logging.debug(dir)
-            logging.debug("Filesystem.list_book_dir: '{}' in dirlist == {}".format("558282402019", "558282402019" in dirlist))
-
         filtered = []
-        for dirname in dirlist:
-            if Filesystem.should_ignore(os.path.join(dir, dirname)):
-                # debugging strange bug
-                if "master/NLBPUB" in dir and threading.current_thread().getName().endswith("event in nlbpub") and "558282402019" in dirname:
-                    logging.debug("Filesystem.list_book_dir: '{}' is filtered out as a common system file".format(dirname))
-                # Filter out common system files
-                continue
+        for dirname in os.listdir(dir):
             if len(dirname) == 0 or (dirname[0] not in "0123456789" and not dirname.startswith("TEST")):
-                # debugging strange bug
-                if "master/NLBPUB" in dir and threading.current_thread().getName().endswith("event in nlbpub") and "558282402019" in dirname:
-                    logging.debug("Filesystem.list_book_dir: '{}' is filtered out because it doesn't start with a number".format(dirname))
                 # Book identifiers must start with a number
                 continue
+            if Filesystem.is_ignored(dirname):
+                # Filter out common system files
+                continue
 
             filtered.append(dirname)
 
-        if threading.current_thread().getName().endswith("event in nlbpub") and dir.endswith("master/NLBPUB/"):  # debugging strange bug
-            logging.debug("Filesystem.list_book_dir: '{}' in filtered == {}".format("558282402019", "558282402019" in filtered))
         return filtered
 
+    @staticmethod
+    def is_book_name(dir, name):
+        """Whether `name` in `dir` would be listed as a book by list_book_dir"""
+        if len(name) == 0 or (name[0] not in "0123456789" and not name.startswith("TEST")):
+            return False
+        return not Filesystem.is_ignored(name)
+
     @staticmethod
     def book_path_in_dir(dir, identifiers, subdirs=None):
         # check "pipeline parent directories" (i.e. subdirectories)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import pickle
+import sqlite3
+from threading import RLock
+
+
+class KeyValueStore():
+    """
+    Small persistent key-value store, backed by SQLite in WAL mode.
+
+    Values are pickled. Changes are written in a single transaction, so that only the
+    entries that have changed are written, and a crash never leaves a partially written store.
+    """
+
+    path = None
+    _connection = None
+    _lock = None
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = RLock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with self._lock:
+            self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    def items(self):
+        """Returns all entries as a dict. Entries that can't be unpickled are skipped."""
+        items = {}
+        with self._lock:
+            rows = self._connection.execute("SELECT key, value FROM entries").fetchall()
+        for key, value in rows:
+            try:
+                items[key] = pickle.loads(value)
+            except Exception:
+                logging.exception("Could not read {} from {}".format(key, self.path))
+        return items
+
+    def update(self, changed=None, deleted=None):
+        """Store the entries in `changed` (a dict) and delete the keys in `deleted`, in one transaction"""
+        rows = [(key, pickle.dumps(value, -1)) for key, value in (changed or {}).items()]
+        deleted = [(key,) for key in (deleted or [])]
+        if not rows and not deleted:
+            return
+
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany("INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)", rows)
+                self._connection.executemany("DELETE FROM entries WHERE key = ?", deleted)
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = None
@@ -1,10 +1,10 @@
 import copy
 import datetime
+import json
 import logging
 import os
 import pickle
 import re
-import tempfile
 import threading
 import time
 import traceback
@@ -17,7 +17,9 @@ from lxml import etree as ElementTree
 
 from core.config import Config
 from core.utils.epub import Epub
+from core.utils.kv_store import KeyValueStore
 from core.utils.report import Report
+from core.utils.trace import Trace
 
 
 class Metadata:
@@ -34,6 +36,7 @@ class Metadata:
 
     signatures_cache = {}
     signatures_last_update = 0
+    signatures_store = None  # KeyValueStore with the signatures cache, persisted in the cache dir
     _signatures_cachelock = threading.RLock()
     _signatures_updater_cachelock = threading.RLock()
 
@@ -757,6 +760,7 @@ class Metadata:
         return False
 
     @staticmethod
+    @Trace.traced("metadata")
     def get_metadata_from_book(report, path, force_update=False):
         book_metadata = Metadata._get_metadata_from_book(report, path, force_update)
 
@@ -948,6 +952,53 @@ class Metadata:
 
         return name
 
+    @staticmethod
+    def get_signatures_store():
+        with Metadata._signatures_cachelock:
+            if Metadata.signatures_store is None:
+                cache_dir = Config.get_cache_dir()
+                try:
+                    Metadata.signatures_store = KeyValueStore(os.path.join(cache_dir, "signatures.sqlite"))
+                    if not len(Metadata.signatures_store):
+                        Metadata.migrate_signatures_pickle(os.path.join(cache_dir, "signatures.pickle"))
+                except Exception:
+                    logging.exception("Could not open signatures cache in: {}".format(cache_dir))
+            return Metadata.signatures_store
+
+    @staticmethod
+    def migrate_signatures_pickle(pickle_file):
+        # the signatures used to be stored as a pickled dict ({ path: { identifier: signatures } })
+        if not os.path.isfile(pickle_file):
+            return
+        try:
+            with open(pickle_file, 'rb') as f:
+                signatures_cache = pickle.load(f)
+            changed, _ = Metadata.diff_signatures({}, signatures_cache)
+            Metadata.signatures_store.update(changed)
+            logging.info("Migrated {} to {}".format(pickle_file, Metadata.signatures_store.path))
+        except Exception:
+            logging.exception("Could not migrate signatures cache: {}".format(pickle_file))
+        try:
+            os.remove(pickle_file)  # if the migration failed, the signatures are read from the Quickbase dumps again
+        except OSError:
+            logging.exception("Could not delete old signatures cache: {}".format(pickle_file))
+
+    @staticmethod
+    def diff_signatures(previous_cache, signatures_cache):
+        """Returns the signatures that have changed ({ key: signatures }) and the keys that have been deleted"""
+        changed = {}
+        deleted = []
+        for path in signatures_cache:
+            previous = previous_cache.get(path, {})
+            for identifier in signatures_cache[path]:
+                if previous.get(identifier) != signatures_cache[path][identifier]:
+                    changed[json.dumps([path, identifier])] = signatures_cache[path][identifier]
+        for path in previous_cache:
+            for identifier in previous_cache[path]:
+                if identifier not in signatures_cache.get(path, {}):
+                    deleted.append(json.dumps([path, identifier]))
+        return changed, deleted
+
     @staticmethod
     def get_signatures_from_quickbase(edition_identifiers, library=None, report=logging, refresh=False):
         if not edition_identifiers:
@@ -1009,28 +1060,20 @@ class Metadata:
                 if refresh or not Metadata.signatures_cache:  # check this again, in case the condition has changed since we got the lock
                     signatures_cache = {}
 
-                    signatures_cache_file = None
-                    cache_dir = Config.get("cache_dir", None)
-                    if not cache_dir:
-                        cache_dir = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "prodsys-cache"))
-                        if not os.path.isdir(cache_dir):
-                            os.makedirs(cache_dir, exist_ok=True)
-                        Config.set("cache_dir", cache_dir)
-                    signatures_cache_file = os.path.join(cache_dir, "signatures.pickle")
-
-                    # try to load from dump file if there are nothing cached in memory
-                    if not Metadata.signatures_cache and signatures_cache_file:
-                        if os.path.isfile(signatures_cache_file):
-                            try:
-                                with open(signatures_cache_file, 'rb') as f:
-                                    loaded_cache = pickle.load(f)
-                                    with Metadata._signatures_cachelock:
-                                        Metadata.signatures_cache = loaded_cache
-                                    report.debug("Loaded signatures cache from: {}".format(signatures_cache_file))
-                            except Exception as e:
-                                logging.exception("Cache file found, but could not parse it", e)
-                        else:
-                            logging.debug("Can't find cache file")
+                    signatures_store = Metadata.get_signatures_store()
+
+                    # try to load from the cache file if there are nothing cached in memory
+                    if not Metadata.signatures_cache and signatures_store is not None:
+                        try:
+                            loaded_cache = {}
+                            for key, signatures in signatures_store.items().items():
+                                path, identifier = json.loads(key)
+                                loaded_cache.setdefault(path, {})[identifier] = signatures
+                            with Metadata._signatures_cachelock:
+                                Metadata.signatures_cache = loaded_cache
+                            report.debug("Loaded signatures cache from: {}".format(signatures_store.path))
+                        except Exception:
+                            logging.exception("Cache file found, but could not parse it: {}".format(signatures_store.path))
 
                     for dump in bookguru_dumps:
                         if not Config.get("system.shouldRun"):
@@ -1086,11 +1129,18 @@ class Metadata:
 
                     report.debug("Done parsing all Quickbase-dumps.")
                     with Metadata._signatures_cachelock:
+                        previous_cache = Metadata.signatures_cache
                         Metadata.signatures_cache = signatures_cache
                         Metadata.signatures_last_update = time.time()
-                        with open(signatures_cache_file, 'wb') as f:
-                            pickle.dump(Metadata.signatures_cache, f, -1)
-                            report.debug("Stored signatures cache as: {}".format(signatures_cache_file))
+
+                    if signatures_store is not None:
+                        # only write the signatures that have changed
+                        changed, deleted = Metadata.diff_signatures(previous_cache, signatures_cache)
+                        try:
+                            signatures_store.update(changed, deleted)
+                            report.debug("Stored {} changed and {} deleted signatures in: {}".format(len(changed), len(deleted), signatures_store.path))
+                        except Exception:
+                            logging.exception("Could not store signatures cache: {}".format(signatures_store.path))
 
         if not Config.get("system.shouldRun"):
             return []  # exit from this function here if we're shutting down the system
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+from threading import RLock
+
+
+class Metrics():
+    """Simple in-memory counters, for things that are interesting to monitor over time"""
+
+    _lock = RLock()
+    _counters = {}
+
+    @staticmethod
+    def increment(name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + value
+
+    @staticmethod
+    def get(name=None):
+        """Returns the counters as a list of dicts: [{"name": …, "labels": {…}, "value": …}]"""
+        with Metrics._lock:
+            return [{"name": key[0], "labels": dict(key[1]), "value": Metrics._counters[key]}
+                    for key in sorted(Metrics._counters)
+                    if name is None or key[0] == name]
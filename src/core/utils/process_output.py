@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import tempfile
+import time
+
+
+class ProcessOutput():
+    """
+    Captures one output stream (stdout or stderr) of a process, as it is produced.
+
+    Lines are passed on to the report (or the log) while the process is running, in batches.
+    Only the first `head` and the last `tail` bytes are kept in memory. If the output is longer
+    than that, the full output is written to a spill file, and only the tail is reported when
+    the process is done, so that huge logs (i.e. from Saxon or Pipeline 2) don't use a lot of memory.
+
+    The spill file is stored in the report directory of the book, so that it's cleaned up together
+    with the report, and at most `spill_max` bytes are written to it. When there is no report
+    directory, a temporary file is used instead, which is deleted when the process is done.
+    """
+
+    head = int(os.getenv("RUN_OUTPUT_HEAD", 1024 * 1024))  # bytes kept from the start of the output
+    tail = int(os.getenv("RUN_OUTPUT_TAIL", 1024 * 1024))  # bytes kept from the end of the output
+    spill_max = int(os.getenv("RUN_OUTPUT_SPILL_MAX_MB", 100)) * 1024 * 1024  # max. bytes written to the spill file
+    flush_interval = 1  # max. seconds before lines are passed on to the report
+    flush_lines = 100  # max. lines that are passed on to the report at a time
+    max_line_length = 64 * 1024  # longer lines are split
+
+    name = None
+    report = None
+    level = None
+    size = None
+    spill_path = None  # the full output, if it was too long to keep in memory (None if it was not kept)
+    _head = None
+    _tail = None
+    _spill = None
+    _spill_size = 0
+    _spill_temporary = False
+    _partial = None
+    _lines = None
+    _last_flush = None
+
+    def __init__(self, name, report=None, level="DEBUG"):
+        self.name = name
+        self.report = report
+        self.level = level
+        self.size = 0
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._partial = bytearray()
+        self._lines = []
+        self._last_flush = time.time()
+
+    def feed(self, data):
+        """Add output from the process"""
+        if not data:
+            return
+        self.size += len(data)
+
+        if self._spill is None and len(self._head) + len(data) <= ProcessOutput.head:
+            self._head += data
+            self._add_lines(data)
+
+        else:
+            if self._spill is None:
+                # the output is too long to keep: write all of it to a file instead
+                self._open_spill()
+                self._write_spill(self._head)
+                room = ProcessOutput.head - len(self._head)
+                self._head += data[:room]
+                self._add_lines(data[:room])
+                self._flush(final_partial=True)
+                if self._spill_temporary:
+                    self._lines.append("[… utdata er for lang, så bare starten og slutten blir vist …]")
+                else:
+                    self._lines.append("[… utdata er for lang, og blir lagret i {} …]".format(self.spill_path))
+                self._flush()
+            self._write_spill(data)
+            self._tail += data
+            if len(self._tail) > ProcessOutput.tail:
+                del self._tail[:len(self._tail) - ProcessOutput.tail]
+
+        if len(self._lines) >= ProcessOutput.flush_lines or time.time() - self._last_flush >= ProcessOutput.flush_interval:
+            self._flush()
+
+    def _open_spill(self):
+        report_dir = None
+        if self.report:
+            try:
+                report_dir = self.report.reportDir()
+            except Exception:
+                report_dir = None  # i.e. a pipeline without a report directory
+
+        if report_dir:
+            self.spill_path = os.path.join(report_dir, "run-{}-{}.{}.log".format(time.strftime("%Y-%m-%d_%H-%M-%S"), os.getpid(), self.name))
+            self._spill = open(self.spill_path, "ab")
+        else:
+            self._spill = tempfile.NamedTemporaryFile(prefix="run-", suffix=".{}.log".format(self.name))  # deleted when closed
+            self._spill_temporary = True
+
+    def _write_spill(self, data):
+        if self._spill_size >= ProcessOutput.spill_max:
+            return
+        room = ProcessOutput.spill_max - self._spill_size
+        self._spill.write(data[:room])
+        self._spill_size += min(len(data), room)
+        if self._spill_size >= ProcessOutput.spill_max:
+            self._spill.write("\n[… the rest of the output is omitted, as it is longer than {} bytes …]\n".format(ProcessOutput.spill_max).encode("utf-8"))
+
+    def close(self):
+        """Called when the process is done. Reports what's left, and returns the output that is kept (bytes)."""
+        if self._spill is None:
+            self._flush(final_partial=True)
+            return bytes(self._head)
+
+        self._spill.close()
+        tail = bytes(self._tail)
+        omitted = max(0, self.size - len(self._head) - len(tail))
+        if self._spill_temporary:
+            self._lines.append("[… {} bytes er utelatt …]".format(omitted))
+            marker = "\n[… {} bytes omitted …]\n".format(omitted)
+        else:
+            self._lines.append("[… {} bytes er utelatt, se {} …]".format(omitted, self.spill_path))
+            marker = "\n[… {} bytes omitted, see {} …]\n".format(omitted, self.spill_path)
+        self._lines.extend(tail.decode("utf-8", errors="replace").splitlines())
+        self._flush()
+        return bytes(self._head) + marker.encode("utf-8") + tail
+
+    def _add_lines(self, data):
+        self._partial += data
+        *lines, partial = self._partial.split(b"\n")
+        if len(partial) > ProcessOutput.max_line_length:
+            lines.append(partial)
+            partial = b""
+        self._partial = bytearray(partial)
+        self._lines.extend(line.decode("utf-8", errors="replace").rstrip("\r") for line in lines)
+
+    def _flush(self, final_partial=False):
+        if final_partial and self._partial:
+            self._lines.append(self._partial.decode("utf-8", errors="replace").rstrip("\r"))
+            self._partial = bytearray()
+
+        self._last_flush = time.time()
+        if not self._lines:
+            return
+        lines = self._lines
+        self._lines = []
+
+        if self.report:
+            self.report.add_message(self.level, "\n".join(lines), add_empty_line_last=False, add_empty_line_between=True)
+        else:
+            logging.info("\n".join(lines))
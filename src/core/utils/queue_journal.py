@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from threading import RLock
+
+from core.config import Config
+
+
+class QueueJournal():
+    """
+    Append-only journal of queue events for a pipeline.
+
+    Every change to the queue is appended as a single JSON line ("enqueue", "dequeue",
+    "start" or "finish"), so that the queue can be restored after a restart without
+    rescanning the input directory. The journal is compacted on startup, and whenever
+    it grows much larger than the number of books it describes.
+    """
+
+    compact_threshold = 1000  # minimum number of obsolete lines before compacting
+
+    def __init__(self, uid, path=None):
+        self.uid = uid
+        self.path = path if path else os.path.join(Config.get_cache_dir(), "queue.{}.journal".format(uid))
+        self._lock = RLock()
+        self._file = None
+        self._lines = 0
+        self._pending = OrderedDict()  # books waiting in the queue
+        self._in_flight = OrderedDict()  # books that have been started, but not finished
+
+    def restore(self):
+        """
+        Replay the journal, and return the books that were queued and in-flight
+        when the journal was last written, as a tuple: (pending, in_flight).
+        """
+        with self._lock:
+            self._pending = OrderedDict()
+            self._in_flight = OrderedDict()
+
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path, "r") as f:
+                        for line in f:
+                            try:
+                                entry = json.loads(line)
+                            except ValueError:
+                                continue  # most likely a partially written line from a crash; skip it
+                            self._replay(entry)
+                except Exception:
+                    logging.exception("Could not read queue journal: {}".format(self.path))
+
+            self._compact()
+
+            return deepcopy(list(self._pending.values())), deepcopy(list(self._in_flight.values()))
+
+    def _replay(self, entry):
+        event = entry.get("event")
+        name = entry.get("name")
+        if event == "enqueue":
+            self._pending[name] = entry["book"]
+        elif event == "dequeue":
+            self._pending.pop(name, None)
+        elif event == "start":
+            self._pending.pop(name, None)
+            self._in_flight[name] = entry["book"]
+        elif event == "finish":
+            self._in_flight.pop(name, None)
+
+    def _write(self, entry):
+        with self._lock:
+            self._replay(entry)
+
+            if self._file is None:
+                return  # journal not opened (or closed): only keep the in-memory state
+
+            try:
+                self._file.write(json.dumps(entry) + "\n")
+                self._file.flush()
+                self._lines += 1
+            except Exception:
+                logging.exception("Could not write to queue journal: {}".format(self.path))
+
+            if self._lines - len(self._pending) - len(self._in_flight) > QueueJournal.compact_threshold:
+                self._compact()
+
+    def _compact(self):
+        # write the current state to a new file, then atomically replace the old journal
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                temp_path = self.path + ".tmp"
+                with open(temp_path, "w") as f:
+                    for name in self._pending:
+                        f.write(json.dumps({"time": time.time(), "event": "enqueue", "name": name, "book": self._pending[name]}) + "\n")
+                    for name in self._in_flight:
+                        f.write(json.dumps({"time": time.time(), "event": "start", "name": name, "book": self._in_flight[name]}) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+                self._lines = len(self._pending) + len(self._in_flight)
+                self._file = open(self.path, "a")
+
+            except Exception:
+                logging.exception("Could not compact queue journal: {}".format(self.path))
+
+    def enqueue(self, book):
+        self._write({"time": time.time(), "event": "enqueue", "name": book["name"], "book": deepcopy(book)})
+
+    def dequeue(self, name):
+        self._write({"time": time.time(), "event": "dequeue", "name": name})
+
+    def start(self, book):
+        self._write({"time": time.time(), "event": "start", "name": book["name"], "book": deepcopy(book)})
+
+    def finish(self, name):
+        self._write({"time": time.time(), "event": "finish", "name": name})
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -19,6 +19,7 @@ from dotmap import DotMap
 from core.config import Config
 from core.utils.filesystem import Filesystem
 from core.utils.slack import Slack
+from core.utils.trace import Trace
 
 
 class Report():
@@ -30,6 +31,7 @@ class Report():
     should_email = True
     should_message_slack = True
     mailpath = ()  # smb, file, unc
+    interrupted = False  # processing was interrupted by a shutdown, and will be resumed when the system starts again
     _report_dir = None
     _messages = None
     img_string = ("<img src=\"data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAABAAAAAYCAYAAADzoH0MAAAABmJLR0QA/wD/AP+gvaeTAAAACXBIWXMAAA"
@@ -274,6 +276,7 @@ class Report():
 
         Slack.slack(text=subject, attachments=None)
 
+    @Trace.traced("email")
     def email(self, recipients, subject=None, should_email=True, should_message_slack=True, should_attach_log=True, should_escape_chars=True):
         if not subject:
             assert isinstance(self.title, str) or self.pipeline is not None, "either title or pipeline must be specified when subject is missing"
@@ -469,6 +472,7 @@ class Report():
                     yesterday = datetime.now() - timedelta(1)
                     yesterday = str(yesterday.strftime("%Y-%m-%d"))
                     path_mail = os.path.join(self.pipeline.dir_reports, "logs", "dagsrapporter", yesterday, self.pipeline.uid + ".html")
+                    os.makedirs(os.path.dirname(path_mail), exist_ok=True)
                     shutil.copy(temp_html_obj.name, path_mail)
                     self.mailpath = Filesystem.networkpath(path_mail)
 
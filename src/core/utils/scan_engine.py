@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import logging
+import os
+import queue
+import time
+from threading import Condition, RLock, Thread, current_thread
+
+from core.utils.filesystem import Filesystem
+from core.utils.inotify import Inotify
+
+
+class ScanEngine():
+    """
+    Shared engine for scanning all the watched directories.
+
+    Instead of each directory having its own threads, each directory registers a task (a function)
+    that does one step of scanning and returns the number of seconds until it should run again.
+    The tasks are run by a small pool of worker threads, in order of when they are due (and then by priority),
+    so the number of threads does not grow with the number of directories.
+
+    In addition:
+
+    - all directories share a single inotify instance (so that fs.inotify.max_user_instances is not reached
+      when there are many directories): a single thread reads the events, routes them to the directories
+      by watch descriptor, and wakes up the task of a directory when there are events for it,
+    - a single thread calls the event handlers of all directories, in the order the events happened,
+    - listings of the same directory are shared between the directory scans and the pipelines.
+    """
+
+    workers = int(os.getenv("SCAN_ENGINE_WORKERS", 4))
+    event_delay = 0.05  # seconds to wait for more inotify events, so that bursts are handled together
+    poll_timeout = 0.5  # max. seconds before the inotify instance is noticed when it is first created
+
+    _lock = RLock()
+    _condition = Condition(_lock)
+    _heap = []  # (due, priority, sequence number, key)
+    _tasks = {}  # { key: task }
+    _sequence = itertools.count()
+    _threads = []
+    _inotify = None  # shared by all tasks (see add_watch)
+    _wds = {}  # { watch descriptor: set of keys }, several directories can watch the same path (i.e. nested directories)
+    _inotify_events = {}  # { key: [(wd, mask, cookie, name), …] }, events that have not been read by the task yet
+    _events = queue.Queue()
+
+    _listings_lock = RLock()
+    _listings = {}  # { path: (time, names) }
+    _listing_locks = {}  # { path: lock }
+
+    @staticmethod
+    def _start():
+        # start the threads the first time a task is added
+        with ScanEngine._lock:
+            if ScanEngine._threads:
+                return
+
+            for i in range(max(1, ScanEngine.workers)):
+                ScanEngine._threads.append(Thread(target=ScanEngine._worker_thread, name="scan engine {}".format(i)))
+            ScanEngine._threads.append(Thread(target=ScanEngine._inotify_thread, name="scan engine inotify"))
+            ScanEngine._threads.append(Thread(target=ScanEngine._dispatch_thread, name="scan engine events"))
+            for thread in ScanEngine._threads:
+                thread.setDaemon(True)
+                thread.start()
+
+    @staticmethod
+    def add(key, fn, priority=0, delay=0):
+        """Add a task. `fn` is called without arguments, and returns the seconds until it should be called again (or None to stop)."""
+        with ScanEngine._lock:
+            assert key not in ScanEngine._tasks, "There is already a task for {}".format(key)
+            ScanEngine._tasks[key] = {"fn": fn, "priority": priority, "due": None, "running": False, "wake": None, "thread": None}
+            ScanEngine._schedule(key, time.time() + delay)
+        ScanEngine._start()
+
+    @staticmethod
+    def remove(key):
+        """Remove a task. If the task is running, this waits until it is done (unless called from the task itself)."""
+        with ScanEngine._lock:
+            task = ScanEngine._tasks.pop(key, None)
+            ScanEngine.rm_watches(key)
+            if task is None or task.get("thread") is current_thread():
+                return
+            while task["running"]:
+                ScanEngine._condition.wait(timeout=1)
+
+    @staticmethod
+    def wake(key, delay=0):
+        """Run the task within `delay` seconds, even if it is not due yet"""
+        with ScanEngine._lock:
+            task = ScanEngine._tasks.get(key)
+            if task is None:
+                return
+            due = time.time() + delay
+            if task["running"]:
+                task["wake"] = min(task["wake"], due) if task["wake"] else due  # run again as soon as it is done
+            elif task["due"] is None or due < task["due"]:
+                ScanEngine._schedule(key, due)
+
+    @staticmethod
+    def _schedule(key, due):
+        task = ScanEngine._tasks[key]
+        task["due"] = due
+        heapq.heappush(ScanEngine._heap, (due, task["priority"], next(ScanEngine._sequence), key))
+        ScanEngine._condition.notify()
+
+    @staticmethod
+    def _next_task():
+        # wait for the next task that is due. Entries in the heap that are outdated are skipped.
+        with ScanEngine._lock:
+            while True:
+                while ScanEngine._heap:
+                    due, _, _, key = ScanEngine._heap[0]
+                    task = ScanEngine._tasks.get(key)
+                    if task is None or task["running"] or task["due"] != due:
+                        heapq.heappop(ScanEngine._heap)  # removed, or rescheduled
+                        continue
+                    break
+
+                if not ScanEngine._heap:
+                    ScanEngine._condition.wait()
+                    continue
+
+                due, _, _, key = ScanEngine._heap[0]
+                if due > time.time():
+                    ScanEngine._condition.wait(timeout=due - time.time())
+                    continue
+
+                heapq.heappop(ScanEngine._heap)
+                task["running"] = True
+                task["due"] = None
+                task["thread"] = current_thread()
+                return key, task
+
+    @staticmethod
+    def _worker_thread():
+        while True:
+            key, task = ScanEngine._next_task()
+
+            delay = 1
+            try:
+                delay = task["fn"]()
+            except Exception:
+                logging.exception("An error occured while scanning {}".format(key))
+
+            with ScanEngine._lock:
+                task["running"] = False
+                task["thread"] = None
+                if ScanEngine._tasks.get(key) is task and delay is not None:
+                    due = time.time() + max(0, delay)
+                    ScanEngine._schedule(key, min(due, task["wake"]) if task["wake"] else due)
+                elif ScanEngine._tasks.get(key) is task:
+                    del ScanEngine._tasks[key]
+                task["wake"] = None
+                ScanEngine._condition.notify_all()  # also notifies threads waiting in remove()
+
+    @staticmethod
+    def add_watch(key, path, mask):
+        """
+        Watch `path` with the shared inotify instance, and wake up the task `key` when there are events.
+        The events are read with `read_events(key)`. Returns the watch descriptor.
+        """
+        with ScanEngine._lock:
+            if ScanEngine._inotify is None:
+                ScanEngine._inotify = Inotify()
+            # the same path gives the same watch descriptor, so add to the mask of the other tasks watching it instead of replacing it
+            wd = ScanEngine._inotify.add_watch(path, mask | Inotify.IN_MASK_ADD)
+            ScanEngine._wds.setdefault(wd, set()).add(key)
+        ScanEngine._start()
+        return wd
+
+    @staticmethod
+    def rm_watches(key):
+        """Stop watching all the paths watched for the task `key`"""
+        with ScanEngine._lock:
+            for wd in list(ScanEngine._wds):
+                keys = ScanEngine._wds[wd]
+                if key not in keys:
+                    continue
+                keys.discard(key)
+                if not keys:
+                    del ScanEngine._wds[wd]
+                    ScanEngine._inotify.rm_watch(wd)
+            ScanEngine._inotify_events.pop(key, None)
+
+    @staticmethod
+    def read_events(key):
+        """Returns the inotify events for the task `key` since the last time they were read"""
+        with ScanEngine._lock:
+            return ScanEngine._inotify_events.pop(key, [])
+
+    @staticmethod
+    def _inotify_thread():
+        while True:
+            with ScanEngine._lock:
+                inotify = ScanEngine._inotify
+
+            if inotify is None:
+                time.sleep(ScanEngine.poll_timeout)
+                continue
+
+            try:
+                events = inotify.read_events(timeout=ScanEngine.poll_timeout)
+            except OSError:
+                logging.exception("Could not read inotify events")
+                time.sleep(ScanEngine.poll_timeout)
+                continue
+
+            with ScanEngine._lock:
+                woken = set()
+                for event in events:
+                    wd, mask = event[0], event[1]
+                    if mask & Inotify.IN_Q_OVERFLOW:
+                        keys = set().union(*ScanEngine._wds.values())  # events are lost: let all tasks know
+                    else:
+                        keys = ScanEngine._wds.get(wd, ())
+                    for key in keys:
+                        if key in ScanEngine._tasks:
+                            ScanEngine._inotify_events.setdefault(key, []).append(event)
+                            woken.add(key)
+                    if mask & Inotify.IN_IGNORED:
+                        ScanEngine._wds.pop(wd, None)  # the watch has been removed by the kernel
+
+                for key in woken:
+                    ScanEngine.wake(key, delay=ScanEngine.event_delay)
+
+    @staticmethod
+    def post(fn, *args):
+        """Call `fn(*args)` from the event thread. Functions are called in the order they are posted."""
+        ScanEngine._events.put((fn, args))
+        ScanEngine._start()
+
+    @staticmethod
+    def _dispatch_thread():
+        while True:
+            fn, args = ScanEngine._events.get()
+            try:
+                fn(*args)
+            except Exception:
+                logging.exception("An error occured while handling an event")
+
+    @staticmethod
+    def list_book_dir(path, max_age=1):
+        """
+        List the books in `path` (see Filesystem.list_book_dir), reusing a listing that is at most `max_age` seconds old.
+
+        If the directory is already being listed, this waits for that listing instead of listing it again.
+        """
+        path = os.path.normpath(path)
+        requested = time.time()
+        with ScanEngine._listings_lock:
+            lock = ScanEngine._listing_locks.setdefault(path, RLock())
+
+        with lock:
+            with ScanEngine._listings_lock:
+                listing = ScanEngine._listings.get(path)
+            if listing and listing[0] >= requested - max_age:
+                return list(listing[1])
+
+            started = time.time()
+            names = Filesystem.list_book_dir(path)
+            with ScanEngine._listings_lock:
+                ScanEngine._listings[path] = (started, names)
+            return list(names)
+
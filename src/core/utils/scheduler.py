@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import time
+from threading import RLock
+
+from core.utils.daisy_pipeline import DaisyPipelineJob
+
+
+class TokenBucket():
+    """Token bucket, used to limit the rate of something to `rate` per hour, with bursts of up to `capacity`"""
+
+    rate = None
+    capacity = None
+    tokens = None
+    last_refill = None
+    _lock = None
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.time()
+        self._lock = RLock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate / 3600)
+        self.last_refill = now
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens >= 1
+
+    def consume(self):
+        with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class LoadScheduler():
+    """
+    Decides when pipelines are allowed to handle autotriggered books, based on the actual load.
+
+    With AUTOTRIGGER_SCHEDULER=load, autotriggered books are admitted whenever there is headroom: CPU and IO pressure on the host
+    is below a threshold, the Pipeline 2 engines are not busy, and there are not many manually
+    triggered books waiting. In addition, each pipeline has a token bucket limiting how many
+    autotriggered books it can start per hour.
+
+    By default (AUTOTRIGGER_SCHEDULER=hours), the fixed working hours of each pipeline are used instead.
+    """
+
+    mode = os.getenv("AUTOTRIGGER_SCHEDULER", "hours")  # "load" or "hours"
+    max_cpu_pressure = float(os.getenv("AUTOTRIGGER_MAX_CPU_PRESSURE", 50))  # percent
+    max_io_pressure = float(os.getenv("AUTOTRIGGER_MAX_IO_PRESSURE", 30))  # percent
+    max_dp2_queue = int(os.getenv("AUTOTRIGGER_MAX_DP2_QUEUE", 2))  # jobs waiting or running in each engine
+    max_manual_backlog = int(os.getenv("AUTOTRIGGER_MAX_MANUAL_BACKLOG", 3))  # manually triggered books waiting in all pipelines
+    default_rate = float(os.getenv("AUTOTRIGGER_RATE", 30))  # books per hour per pipeline
+    default_burst = float(os.getenv("AUTOTRIGGER_BURST", 5))
+
+    host_cache_time = 10  # seconds
+    dp2_cache_time = 60  # seconds
+
+    _lock = RLock()
+    _buckets = {}
+    _host = None
+    _host_time = 0
+    _dp2_queue = None
+    _dp2_time = 0
+    _last_reason = {}
+
+    @staticmethod
+    def bucket(uid, rate=None, burst=None):
+        with LoadScheduler._lock:
+            if uid not in LoadScheduler._buckets:
+                LoadScheduler._buckets[uid] = TokenBucket(rate if rate else LoadScheduler.default_rate,
+                                                          burst if burst else LoadScheduler.default_burst)
+            return LoadScheduler._buckets[uid]
+
+    @staticmethod
+    def read_pressure(resource):
+        """Returns the share of time (in percent, averaged over 60 seconds) where some tasks were stalled on `resource`"""
+        try:
+            with open("/proc/pressure/{}".format(resource)) as f:
+                for line in f:
+                    fields = line.split()
+                    if fields and fields[0] == "some":
+                        return float(dict(field.split("=") for field in fields[1:])["avg60"])
+        except Exception:
+            pass
+
+        if resource == "cpu":
+            # pressure stall information not available (old kernel); approximate with the load average
+            try:
+                return 100 * os.getloadavg()[1] / (os.cpu_count() or 1)
+            except OSError:
+                return None
+
+        return None
+
+    @staticmethod
+    def host_pressure():
+        with LoadScheduler._lock:
+            if time.time() - LoadScheduler._host_time > LoadScheduler.host_cache_time:
+                LoadScheduler._host = {
+                    "cpu": LoadScheduler.read_pressure("cpu"),
+                    "io": LoadScheduler.read_pressure("io"),
+                }
+                LoadScheduler._host_time = time.time()
+            return LoadScheduler._host
+
+    @staticmethod
+    def dp2_queue():
+        """Number of active jobs in the least busy Pipeline 2 engine (None if Pipeline 2 is not used or not available)"""
+        if not DaisyPipelineJob.engines:
+            return None  # no Pipeline 2 jobs has been run yet
+
+        with LoadScheduler._lock:
+            if time.time() - LoadScheduler._dp2_time > LoadScheduler.dp2_cache_time:
+                queue_sizes = [DaisyPipelineJob.count_active_jobs(engine) for engine in list(DaisyPipelineJob.engines)]
+                queue_sizes = [size for size in queue_sizes if size is not None]
+                LoadScheduler._dp2_queue = min(queue_sizes) if queue_sizes else None
+                LoadScheduler._dp2_time = time.time()
+            return LoadScheduler._dp2_queue
+
+    @staticmethod
+    def refuse_reason(uid, manual_backlog=0):
+        """Returns the reason why `uid` should not start an autotriggered book now, or None if it may"""
+        if manual_backlog > LoadScheduler.max_manual_backlog:
+            return "{} manually triggered books are waiting".format(manual_backlog)
+
+        host = LoadScheduler.host_pressure()
+        if host["cpu"] is not None and host["cpu"] > LoadScheduler.max_cpu_pressure:
+            return "CPU pressure is {:.0f} %".format(host["cpu"])
+        if host["io"] is not None and host["io"] > LoadScheduler.max_io_pressure:
+            return "IO pressure is {:.0f} %".format(host["io"])
+
+        dp2_queue = LoadScheduler.dp2_queue()
+        if dp2_queue is not None and dp2_queue >= LoadScheduler.max_dp2_queue:
+            return "{} jobs are active in Pipeline 2".format(dp2_queue)
+
+        if not LoadScheduler.bucket(uid).available():
+            return "the rate limit for autotriggered books is reached"
+
+        return None
+
+    @staticmethod
+    def admit(uid, manual_backlog=0):
+        """Whether `uid` may start an autotriggered book now. Call `consume` when actually starting one."""
+        reason = LoadScheduler.refuse_reason(uid, manual_backlog=manual_backlog)
+
+        if reason != LoadScheduler._last_reason.get(uid):
+            LoadScheduler._last_reason[uid] = reason
+            if reason:
+                logging.debug("Not handling autotriggered books in {}: {}".format(uid, reason))
+            else:
+                logging.debug("Handling autotriggered books in {}".format(uid))
+
+        return reason is None
+
+    @staticmethod
+    def consume(uid):
+        return LoadScheduler.bucket(uid).consume()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class StackSampler():
+    """
+    Samples the stacks of all threads in the current process, using sys._current_frames.
+
+    The result is written in the "collapsed stack" format (one line per distinct stack,
+    with frames separated by semicolons and followed by the number of samples), which
+    can be turned into a flame graph with i.e. flamegraph.pl or speedscope.
+    """
+
+    @staticmethod
+    def collapse(frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+            frame = frame.f_back
+        return ";".join(reversed(frames))
+
+    @staticmethod
+    def sample(duration=5, interval=0.05):
+        """Sample all threads (except the current one) every `interval` seconds for `duration` seconds"""
+        stacks = Counter()
+        current = threading.get_ident()
+        end = time.time() + duration
+
+        while True:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == current:
+                    continue
+                stacks[names.get(thread_id, str(thread_id)) + ";" + StackSampler.collapse(frame)] += 1
+
+            if time.time() >= end:
+                break
+            time.sleep(interval)
+
+        return stacks
+
+    @staticmethod
+    def write_profile(path, duration=5, interval=0.05):
+        """Sample all threads and write the collapsed stacks to `path`. Returns the path, or None on failure."""
+        try:
+            stacks = StackSampler.sample(duration=duration, interval=interval)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write("{} {}\n".format(stack, count))
+            return path
+
+        except Exception:
+            logging.exception("Could not write stack profile: {}".format(path))
+            return None
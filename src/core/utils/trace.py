@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import RLock
+
+from core.config import Config
+
+
+class Span():
+    """
+    A timed stage while handling a book. Spans can be nested.
+
+    `wall` is the elapsed time, `cpu` is the CPU time used by the current thread, and
+    `children` is the CPU time used by child processes (i.e. Java) that finished during the span.
+    Child process time is measured for the whole process, so it may include child processes
+    of other threads. All times are in seconds.
+    """
+
+    name = None
+    attributes = None
+    spans = None
+    start = None
+    wall = None
+    cpu = None
+    children = None
+    _cpu_start = None
+    _children_start = None
+    _token = None
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.spans = []
+        self.start = time.time()
+        self._cpu_start = time.thread_time()
+        self._children_start = Span._children_time()
+
+    @staticmethod
+    def _children_time():
+        times = os.times()
+        return times.children_user + times.children_system
+
+    def finish(self):
+        if self.wall is not None:
+            return  # already finished
+        self.wall = time.time() - self.start
+        self.cpu = time.thread_time() - self._cpu_start
+        self.children = Span._children_time() - self._children_start
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "start": self.start,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "children": self.children,
+            "attributes": self.attributes,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+
+class Trace():
+    """
+    Lightweight tracing of where the time goes when handling a book.
+
+    The handler thread starts a trace for each book with `Trace.begin`. Stages are
+    recorded with the `Trace.traced` decorator or the `Trace.span` context manager,
+    and are nested under the innermost active span. When no trace is active,
+    nothing is recorded.
+    """
+
+    _current = contextvars.ContextVar("trace_span", default=None)
+    _aggregate_lock = RLock()
+
+    @staticmethod
+    def begin(name, **attributes):
+        """Start a new trace in the current context, and return its root span"""
+        root = Span(name, **attributes)
+        root._token = Trace._current.set(root)
+        return root
+
+    @staticmethod
+    def end(root):
+        """Finish the trace started with `begin`"""
+        root.finish()
+        if root._token is not None:
+            try:
+                Trace._current.reset(root._token)
+            except ValueError:
+                Trace._current.set(None)  # ended from a different context
+            root._token = None
+        return root
+
+    @staticmethod
+    def current():
+        return Trace._current.get()
+
+    @staticmethod
+    @contextmanager
+    def span(name, **attributes):
+        parent = Trace._current.get()
+        if parent is None:
+            yield None
+            return
+
+        span = Span(name, **attributes)
+        parent.spans.append(span)
+        token = Trace._current.set(span)
+        try:
+            yield span
+        finally:
+            span.finish()
+            Trace._current.reset(token)
+
+    @staticmethod
+    def traced(name):
+        """Decorator recording each call to the decorated function or coroutine as a span"""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with Trace.span(name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Trace.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def attach(spans):
+        """Add spans recorded elsewhere (i.e. as dicts in a worker process) to the current span"""
+        parent = Trace._current.get()
+        if parent is None:
+            return
+        for data in spans:
+            parent.spans.append(Trace.from_dict(data))
+
+    @staticmethod
+    def from_dict(data):
+        span = Span(data["name"], **data.get("attributes", {}))
+        span.start = data["start"]
+        span.wall = data["wall"]
+        span.cpu = data["cpu"]
+        span.children = data["children"]
+        span.spans = [Trace.from_dict(child) for child in data.get("spans", [])]
+        return span
+
+    @staticmethod
+    def store(root, report_dir, uid):
+        """Write the trace to trace.json in the report directory, and add it to the aggregated traces for the pipeline"""
+        try:
+            with open(os.path.join(report_dir, "trace.json"), "w") as f:
+                json.dump(root.to_dict(), f, indent=2)
+        except Exception:
+            logging.exception("Could not store trace in: {}".format(report_dir))
+
+        Trace.aggregate(root, uid)
+
+    @staticmethod
+    def aggregate_path(uid):
+        return os.path.join(Config.get_cache_dir(), "trace.{}.json".format(uid))
+
+    @staticmethod
+    def aggregate(root, uid):
+        """
+        Add the durations in the trace to the aggregated durations for the pipeline.
+
+        Stages are identified by their path from the root ("check_epub/xslt"), so that
+        the same function called from different stages can be told apart.
+        """
+        path = Trace.aggregate_path(uid)
+
+        with Trace._aggregate_lock:
+            stages = {}
+            if os.path.isfile(path):
+                try:
+                    with open(path) as f:
+                        stages = json.load(f).get("stages", {})
+                except Exception:
+                    logging.exception("Could not read aggregated traces: {}".format(path))
+
+            def add(span, prefix):
+                stage = prefix + span.name
+                if stage not in stages:
+                    stages[stage] = {"count": 0, "wall": 0, "cpu": 0, "children": 0, "max_wall": 0}
+                stats = stages[stage]
+                stats["count"] += 1
+                stats["wall"] += span.wall or 0
+                stats["cpu"] += span.cpu or 0
+                stats["children"] += span.children or 0
+                stats["max_wall"] = max(stats["max_wall"], span.wall or 0)
+                for child in span.spans:
+                    add(child, stage + "/")
+
+            for span in root.spans:
+                add(span, "")
+
+            try:
+                temp_path = path + ".tmp"
+                with open(temp_path, "w") as f:
+                    json.dump({"uid": uid, "stages": stages}, f, indent=2)
+                os.replace(temp_path, path)
+            except Exception:
+                logging.exception("Could not store aggregated traces: {}".format(path))
+
+    @staticmethod
+    def load_aggregate(uid):
+        """Returns the aggregated durations for the pipeline, as a dict: { "stage": {"count": …, "wall": …, …} }"""
+        path = Trace.aggregate_path(uid)
+        if not os.path.isfile(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f).get("stages", {})
+        except Exception:
+            logging.exception("Could not read aggregated traces: {}".format(path))
+            return {}
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+from threading import RLock
+
+from core.utils.filesystem import Filesystem
+from core.utils.inotify import Inotify
+from core.utils.scan_engine import ScanEngine
+
+
+class TriggerWatcher():
+    """
+    Watches trigger directories for trigger files, for all pipelines.
+
+    A trigger file is named after the book to trigger. If its first line is "autotriggered",
+    the book is autotriggered. The file is deleted, and the callbacks registered for the
+    directory are called with the name of the book and whether it was autotriggered.
+
+    Each directory is a task in the ScanEngine. Directories are watched with the inotify instance
+    shared with the book directories, so that triggers are handled immediately. Directories
+    on network filesystems (where inotify does not see changes made by other hosts), or when
+    inotify is not available, are polled instead.
+    """
+
+    poll_interval = 5  # seconds between each listing of polled directories
+    rescan_interval = 60  # seconds between each listing of inotify-watched directories (in case an event is lost)
+    inotify_mask = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_ONLYDIR
+    priority = -1  # handle triggers before book directory scans that are due at the same time
+
+    _lock = RLock()
+    _callbacks = {}  # { path: [callback, …] }
+    _polled = set()
+
+    @staticmethod
+    def watch(path, callback):
+        """Call `callback(name, autotriggered)` for each trigger file that appears in `path`"""
+        path = os.path.normpath(path)
+        os.makedirs(path, exist_ok=True)
+
+        with TriggerWatcher._lock:
+            callbacks = TriggerWatcher._callbacks.setdefault(path, [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+            if len(callbacks) == 1:
+                TriggerWatcher._add(path)
+
+        # handle trigger files that were created before we started watching
+        TriggerWatcher._handle_dir(path)
+
+    @staticmethod
+    def unwatch(path, callback):
+        path = os.path.normpath(path)
+        with TriggerWatcher._lock:
+            callbacks = TriggerWatcher._callbacks.get(path, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if callbacks:
+                return
+
+            TriggerWatcher._callbacks.pop(path, None)
+            TriggerWatcher._polled.discard(path)
+
+        # outside the lock, since this waits for the task, which takes the lock in _handle_dir
+        ScanEngine.remove(TriggerWatcher._key(path))  # also removes the inotify watch
+
+    @staticmethod
+    def _key(path):
+        return "trigger:{}".format(path)
+
+    @staticmethod
+    def _add(path):
+        key = TriggerWatcher._key(path)
+        polled = True
+        ScanEngine.add(key, lambda: TriggerWatcher._scan_step(path), priority=TriggerWatcher.priority, delay=TriggerWatcher.poll_interval)
+
+        if Inotify.available() and not Filesystem.is_network_path(path):
+            try:
+                ScanEngine.add_watch(key, path, TriggerWatcher.inotify_mask)
+                polled = False
+            except OSError:
+                logging.exception("Could not watch {} with inotify, polling it instead".format(path))
+
+        if polled:
+            TriggerWatcher._polled.add(path)
+
+    @staticmethod
+    def _scan_step(path):
+        # Called by the ScanEngine, when the directory is due to be polled or rescanned,
+        # or (after ScanEngine.event_delay, so that bursts are handled together) when there are inotify events.
+        key = TriggerWatcher._key(path)
+        ScanEngine.read_events(key)  # all events mean the same thing: list the directory
+        with TriggerWatcher._lock:
+            if path not in TriggerWatcher._callbacks:
+                return None
+            polled = path in TriggerWatcher._polled
+
+        TriggerWatcher._handle_dir(path)
+        return TriggerWatcher.poll_interval if polled else TriggerWatcher.rescan_interval
+
+    @staticmethod
+    def _handle_dir(path):
+        with TriggerWatcher._lock:
+            callbacks = list(TriggerWatcher._callbacks.get(path, []))
+        if not callbacks or not os.path.isdir(path):
+            return
+
+        for name in os.listdir(path):
+            if name == "_name":
+                continue
+            triggerfile = os.path.join(path, name)
+            if not os.path.isfile(triggerfile):
+                continue
+
+            try:
+                autotriggered = False
+                with open(triggerfile, "r") as tf:
+                    first_line = tf.readline().strip()
+                    if first_line == "autotriggered":
+                        autotriggered = True
+                os.remove(triggerfile)
+            except FileNotFoundError:
+                continue  # already handled
+            except Exception:
+                logging.exception("An error occured while trying to delete triggerfile: " + triggerfile)
+                continue
+
+            for callback in callbacks:
+                try:
+                    callback(name, autotriggered)
+                except Exception:
+                    logging.exception("An error occured while triggering {} from {}".format(name, path))
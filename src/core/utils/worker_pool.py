@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from pprint import pformat
+from threading import RLock
+
+import psutil
+
+from core.utils.filesystem import Filesystem
+from core.utils.report import Report
+from core.utils.stack_sampler import StackSampler
+from core.utils.trace import Trace
+
+
+class StreamingReport(Report):
+    """Report used inside worker processes. Messages are sent to the parent process instead of being logged."""
+
+    connection = None
+    connection_lock = None
+
+    def __init__(self, pipeline, connection, connection_lock, report_dir):
+        super().__init__(pipeline)
+        self.connection = connection
+        self.connection_lock = connection_lock
+        self._report_dir = report_dir
+
+    def add_message(self, severity, message, message_type="message", preformatted=False, add_empty_line_last=True, add_empty_line_between=False):
+        # only send what we know can be pickled
+        if isinstance(message, list):
+            message = [line if isinstance(line, str) else pformat(line) for line in message]
+        elif not isinstance(message, str):
+            message = pformat(message)
+
+        super().add_message(severity, message, message_type=message_type, preformatted=preformatted,
+                            add_empty_line_last=add_empty_line_last, add_empty_line_between=add_empty_line_between)
+
+        with self.connection_lock:
+            self.connection.send(("message", (severity, message, message_type, preformatted, add_empty_line_last, add_empty_line_between)))
+
+    def log_to_logging(self, severity, message):
+        pass  # the parent process logs the message when it receives it
+
+
+class WorkerPool():
+    """
+    Pool of pre-started worker processes, used to handle books in isolation from the main process.
+
+    Each book is handled in a worker process, so that a crash or a memory leak while handling
+    a pathological book does not affect the other pipelines. Report messages are streamed back
+    to the parent process as they are created. The parent keeps the queue, and sends the e-mails.
+
+    The workers are started from a fork server, not forked from the main process: the main process
+    runs many threads (other pipelines, the scan engine, the web server), and a lock that one of them
+    holds at the time of a fork (i.e. in logging) would never be released in the child.
+    The pipeline is pickled and sent to the worker, without its runtime state (see Pipeline.__getstate__).
+
+    The memory and CPU limits include the child processes of the worker (i.e. Saxon or Java).
+    """
+
+    pipeline = None
+    size = None
+    max_jobs = None
+    max_rss = None
+    max_cpu = None
+
+    _context = None
+    _workers = None
+    _lock = None
+
+    def __init__(self, pipeline, size=None, max_jobs=None, max_rss=None, max_cpu=None):
+        self.pipeline = pipeline
+        self.size = size if size else int(os.getenv("PIPELINE_WORKERS", 1))
+        self.max_jobs = max_jobs if max_jobs is not None else int(os.getenv("PIPELINE_WORKER_MAX_JOBS", 20))  # recycle after N jobs (0: never)
+        self.max_rss = max_rss if max_rss is not None else int(os.getenv("PIPELINE_WORKER_MAX_RSS_MB", 0)) * 1024**2  # bytes (0: unlimited)
+        self.max_cpu = max_cpu if max_cpu is not None else int(os.getenv("PIPELINE_WORKER_MAX_CPU_SECONDS", 0))  # per job (0: unlimited)
+        self._context = multiprocessing.get_context("forkserver")
+        self._workers = []
+        self._lock = RLock()
+
+    def start(self):
+        with self._lock:
+            while len(self._workers) < self.size:
+                self._workers.append(self._spawn())
+
+    def _spawn(self):
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target=WorkerPool._worker_main,
+                                        args=(self.pipeline, child_connection, self.max_jobs, logging.getLogger().level),
+                                        name="worker for {}".format(self.pipeline.uid),
+                                        daemon=True)
+        process.start()
+        child_connection.close()
+        logging.debug("Started worker process {} for {}".format(process.pid, self.pipeline.uid))
+        return {"process": process, "connection": parent_connection, "busy": False}
+
+    def _acquire(self):
+        with self._lock:
+            self._workers = [worker for worker in self._workers if worker["process"].is_alive()]
+            self.start()
+            for worker in self._workers:
+                if not worker["busy"]:
+                    worker["busy"] = True
+                    return worker
+
+            # all workers are busy; start an extra one
+            worker = self._spawn()
+            worker["busy"] = True
+            self._workers.append(worker)
+            return worker
+
+    def _release(self, worker, retired=False):
+        with self._lock:
+            if retired or not worker["process"].is_alive():
+                WorkerPool._terminate(worker)
+                self._workers = [w for w in self._workers if w is not worker]
+                self.start()  # start a replacement so that it's ready for the next book
+            worker["busy"] = False
+
+    def run(self, book, event, report):
+        """Handle `book` in a worker process, and return the result of the book event handler"""
+
+        worker = self._acquire()
+        process = psutil.Process(worker["process"].pid)
+        _, cpu_start = WorkerPool._usage(process)
+        result = None
+        finished = False
+        retired = False
+
+        try:
+            worker["connection"].send(("job", book, event, report.reportDir(), self.pipeline.book_features))
+
+            while True:
+                self.pipeline.watchdog_bark()  # keep the pipeline alive while waiting for the worker
+
+                if worker["connection"].poll(1):
+                    try:
+                        message = worker["connection"].recv()
+                    except EOFError:
+                        report.error("Arbeidsprosessen avsluttet uventet (kode: {})".format(worker["process"].exitcode))
+                        break
+
+                    if message[0] == "message":
+                        severity, text, message_type, preformatted, add_empty_line_last, add_empty_line_between = message[1]
+                        report.add_message(severity, text, message_type=message_type, preformatted=preformatted,
+                                           add_empty_line_last=add_empty_line_last, add_empty_line_between=add_empty_line_between)
+
+                    elif message[0] == "done":
+                        result, state, retired, spans = message[1], message[2], message[3], message[4]
+                        for key in state:
+                            setattr(report, key, state[key])
+                        Trace.attach(spans)  # add the stages from the worker to the trace of the book
+                        finished = True
+                        break
+
+                    continue
+
+                if not worker["process"].is_alive():
+                    report.error("Arbeidsprosessen avsluttet uventet (kode: {})".format(worker["process"].exitcode))
+                    break
+
+                try:
+                    rss, cpu = WorkerPool._usage(process)
+                    cpu -= cpu_start
+                except psutil.NoSuchProcess:
+                    continue  # will be handled as a crash in the next iteration
+
+                if self.max_rss and rss > self.max_rss:
+                    report.error("Arbeidsprosessen brukte for mye minne ({} MiB) og ble derfor stoppet".format(int(rss / 1024**2)))
+                    break
+
+                if self.max_cpu and cpu > self.max_cpu:
+                    report.error("Arbeidsprosessen brukte for mye CPU-tid ({} s) og ble derfor stoppet".format(int(cpu)))
+                    break
+
+        finally:
+            if not finished:
+                retired = True  # don't reuse a worker that did not finish the job properly
+            self._release(worker, retired=retired)
+
+        return result
+
+    @staticmethod
+    def _usage(process):
+        # memory (bytes) and CPU time (seconds) used by the worker and its child processes
+        rss = process.memory_info().rss
+        cpu = sum(process.cpu_times()[:4])  # includes child processes that have terminated
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+                cpu += sum(child.cpu_times()[:2])
+            except psutil.NoSuchProcess:
+                pass  # terminated in the meantime
+        return rss, cpu
+
+    def signal_workers(self, signum=signal.SIGTERM):
+        """Send a signal to all busy workers (SIGTERM makes the worker stop gracefully, as when the system shuts down)"""
+        with self._lock:
+            for worker in self._workers:
+                if worker["busy"] and worker["process"].is_alive():
+                    os.kill(worker["process"].pid, signum)
+
+    def sample_workers(self):
+        """Ask the busy workers to sample their stacks (they write the profile to the report directory of the book)"""
+        self.signal_workers(signal.SIGUSR2)
+
+    def cancel_workers(self):
+        """Ask the busy workers to cancel the book they are currently processing"""
+        self.signal_workers(signal.SIGUSR1)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                WorkerPool._terminate(worker)
+            self._workers = []
+
+    @staticmethod
+    def _terminate(worker):
+        try:
+            children = psutil.Process(worker["process"].pid).children(recursive=True)
+        except psutil.Error:
+            children = []
+        try:
+            if worker["process"].is_alive() and not worker["busy"]:
+                # idle worker: ask it to stop
+                worker["connection"].send(("stop",))
+                worker["process"].join(timeout=10)
+        except Exception:
+            pass
+        if worker["process"].is_alive():
+            # busy or unresponsive worker: SIGTERM gives it a chance to clean up (i.e. delete Pipeline 2 jobs)
+            worker["process"].terminate()
+            worker["process"].join(timeout=10)
+        if worker["process"].is_alive():
+            worker["process"].kill()
+        for child in children:
+            try:
+                child.kill()  # i.e. a Saxon or Java process that the worker did not get to stop
+            except psutil.Error:
+                pass
+        worker["connection"].close()
+
+    @staticmethod
+    def _worker_main(pipeline, connection, max_jobs, log_level):
+        logging.basicConfig(stream=sys.stdout,
+                            level=log_level,
+                            format="%(asctime)s %(levelname)-8s [%(processName)-30s] %(message)s")
+
+        # stop gracefully when the parent asks us to (for instance when the system is shutting down)
+        def stop(signum, frame):
+            pipeline.shouldRun = False
+        signal.signal(signal.SIGTERM, stop)
+
+        # cancel the current book when the parent asks us to (see Pipeline.cancel)
+        def cancel(signum, frame):
+            pipeline._cancelled.set()
+        signal.signal(signal.SIGUSR1, cancel)
+
+        # sample our own stacks when the parent detects that we're stalled (see Pipeline._check_stall)
+        def sample(signum, frame):
+            if isinstance(pipeline.utils.report, StreamingReport):
+                path = os.path.join(pipeline.utils.report.reportDir(), "stall-{}.folded".format(time.strftime("%Y-%m-%d_%H-%M-%S")))
+                threading.Thread(target=StackSampler.write_profile, args=(path,), name="stack sampler", daemon=True).start()
+        signal.signal(signal.SIGUSR2, sample)
+
+        connection_lock = threading.Lock()
+        jobs = 0
+        while True:
+            try:
+                message = connection.recv()
+            except EOFError:
+                break  # parent process is gone
+
+            if message[0] == "stop":
+                break
+
+            _, book, event, report_dir, book_features = message
+            jobs += 1
+            retire = bool(max_jobs) and jobs >= max_jobs
+
+            pipeline.book = book
+            pipeline.book_features = book_features
+            pipeline._cancelled.clear()
+            pipeline.utils.report = StreamingReport(pipeline, connection, connection_lock, report_dir)
+            pipeline.utils.filesystem = Filesystem(pipeline)
+
+            result = None
+            trace = Trace.begin("worker")
+            try:
+                if event == "created":
+                    result = pipeline.on_book_created()
+
+                elif event == "deleted":
+                    result = pipeline.on_book_deleted()
+
+                else:
+                    result = pipeline.on_book_modified()
+
+            except Exception:
+                pipeline.utils.report.error("An error occured while handling the book")
+                pipeline.utils.report.error(traceback.format_exc(), preformatted=True)
+
+            Trace.end(trace)
+            spans = [span.to_dict() for span in trace.spans]
+
+            state = {
+                "title": pipeline.utils.report.title,
+                "should_email": pipeline.utils.report.should_email,
+                "should_message_slack": pipeline.utils.report.should_message_slack,
+                "interrupted": pipeline.utils.report.interrupted,
+            }
+            with connection_lock:
+                connection.send(("done", result, state, retire, spans))
+
+            if retire or not pipeline.shouldRun:
+                break
+
+        connection.close()
+        time.sleep(0.1)
+        os._exit(0)  # don't run atexit handlers (i.e. the ones that clean up temporary directories of the pipeline)
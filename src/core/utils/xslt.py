@@ -6,6 +6,7 @@ import traceback
 
 from core.utils.daisy_pipeline import DaisyPipelineJob
 from core.utils.filesystem import Filesystem
+from core.utils.trace import Trace
 
 
 class Xslt():
@@ -64,7 +65,8 @@ class Xslt():
                 command.append(param + "=" + parameters[param])
 
             report.debug("Running XSLT")
-            process = Filesystem.run_static(command, cwd, report, stdout_level=stdout_level, stderr_level=stderr_level)
+            with Trace.span("xslt", stylesheet=os.path.basename(stylesheet)):
+                process = Filesystem.run_static(command, cwd, report, stdout_level=stdout_level, stderr_level=stderr_level)
             self.success = process.returncode == 0
 
         except subprocess.TimeoutExpired:
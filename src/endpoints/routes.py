@@ -4,6 +4,7 @@ import os
 import requests
 import server
 
+from core.utils.metrics import Metrics
 from incoming_nordic import IncomingNordic
 
 def return_response(response):
@@ -30,3 +31,8 @@ def process_edition(editionId):
 
     # Return the report
     return return_response({ "success": process.run()})
+
+
+@server.route(server.root_path + '/metrics', methods=["GET"], require_auth=None)
+def metrics():
+    return server.jsonify(Metrics.get())
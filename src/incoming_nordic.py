@@ -12,6 +12,7 @@ from core.utils.daisy_pipeline import DaisyPipelineJob
 from core.utils.epub import Epub
 from core.utils.filesystem import Filesystem
 from core.utils.mathml_to_text import Mathml_validator
+from core.utils.trace import Trace
 from core.utils.xslt import Xslt
 
 
@@ -24,7 +25,7 @@ class IncomingNordic(Pipeline):
     epubTitle = ""
     labels = ["EPUB", "Statped"]
     publication_format = None
-    expected_processing_time = 1400
+    expected_processing_time = 1400  # only used until the duration model has measured some books
     epub = None
     epub_fixed = None
     epub_fixed_obj = None
@@ -54,6 +55,8 @@ class IncomingNordic(Pipeline):
         """
         Run the pipeline
         """
+        # the tasks below are created within the trace, so their stages are recorded in it
+        trace = Trace.begin(self.editionId or self.uid, pipeline=self.uid, event="api")
         try:
             logging.info(f"Running pipeline: '{self.uid}'")
             loop = asyncio.get_event_loop()
@@ -77,10 +80,13 @@ class IncomingNordic(Pipeline):
             raise e
         finally:
             logging.info(f"Finished pipeline: '{self.uid}'")
+            Trace.end(trace)
+            Trace.aggregate(trace, self.uid)  # there is no report directory to store the trace in
             loop.close()
             return True
 
     @asyncio.coroutine
+    @Trace.traced("check_epub")
     async def check_epub(self):
         """
         Check the EPUB
@@ -108,6 +114,7 @@ class IncomingNordic(Pipeline):
         return complete.return_value
 
     @asyncio.coroutine
+    @Trace.traced("copy_epub_and_replace_images")
     async def copy_epub_and_replace_images(self):
         """
         Create a copy of the EPUB with empty images and replace them with empty images
@@ -249,6 +256,7 @@ class IncomingNordic(Pipeline):
         return complete.return_value
 
     @asyncio.coroutine
+    @Trace.traced("validate_epub")
     async def validate_epub(self, temp_noimages_epub):
         """
         Validate the EPUB.
@@ -301,6 +309,7 @@ class IncomingNordic(Pipeline):
         return True
 
     @asyncio.coroutine
+    @Trace.traced("validate_mathml")
     async def validate_mathml(self, epub_fixed, epub_unzipped, nav_path):
         """
         Validate MathML in the epub.
@@ -341,6 +350,7 @@ class IncomingNordic(Pipeline):
         return mathML_validation_result
 
     @asyncio.coroutine
+    @Trace.traced("validate_epub_with_daisy_ace")
     async def validate_epub_with_daisy_ace(self, epub_fixed):
         """
         Validate the EPUB with Daisy ACE.
@@ -357,6 +367,7 @@ class IncomingNordic(Pipeline):
         return True
 
     @asyncio.coroutine
+    @Trace.traced("finalize")
     async def finalize(self):
         """ 
         Finalize the EPUB.
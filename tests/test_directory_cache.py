@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import pytest
+
+from core.config import Config
+from core.directory import Directory
+from core.utils.kv_store import KeyValueStore
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    previous = Config.get("cache_dir", None)
+    Config.set("cache_dir", str(tmp_path / "cache"))
+    os.makedirs(Config.get("cache_dir"))
+    yield Config.get("cache_dir")
+    Config.set("cache_dir", previous)
+
+
+def start_and_wait(dir_path, timeout=30):
+    directory = Directory.start_watching(dir_path)
+    deadline = time.time() + timeout
+    while directory.is_starting():
+        assert time.time() < deadline, "the initial scan of {} did not finish".format(dir_path)
+        time.sleep(0.1)
+    return directory
+
+
+def test_checksums_are_stored_in_an_empty_cache_and_reloaded(cache_dir, tmp_path):
+    dir_path = str(tmp_path / "books")
+    for book in ["123456", "234567"]:
+        os.makedirs(os.path.join(dir_path, book, "EPUB"))
+        with open(os.path.join(dir_path, book, "EPUB", "package.opf"), "w") as f:
+            f.write(book)
+
+    Directory.dirs_flat["test_cache"] = dir_path  # a known id, so that the checksums are cached
+    try:
+        directory = start_and_wait(dir_path)
+        cache_file = directory.cache_file
+        checksums = {book: entry["shallow"] for book, entry in directory._md5.items()}
+        Directory.stop(dir_path)
+
+        store = KeyValueStore(cache_file)
+        try:
+            stored = store.items()
+        finally:
+            store.close()
+        assert sorted(stored) == ["123456", "234567"]
+
+        directory = start_and_wait(dir_path)
+        assert {book: entry["shallow"] for book, entry in directory._md5.items()} == checksums
+        Directory.stop(dir_path)
+
+    finally:
+        Directory.stop(dir_path)
+        del Directory.dirs_flat["test_cache"]